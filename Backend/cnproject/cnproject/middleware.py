@@ -5,9 +5,8 @@ import jwt
 class JWTAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         from django.contrib.auth.models import AnonymousUser  # Lazy import
-        from securechatapp.models import CustomUser as User   # Lazy import
+        from securechatapp.authcache import auth_cache  # Lazy import
         from django.conf import settings
-        from channels.db import database_sync_to_async
 
         # Extract token from query string (e.g., ws://...?token=XYZ)
         query_string = scope.get("query_string", b"").decode()
@@ -18,17 +17,11 @@ class JWTAuthMiddleware(BaseMiddleware):
             token = token_list[0]  # First value in case multiple tokens
 
             try:
-                payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-                user_id = payload.get("user_id")
-
-                @database_sync_to_async
-                def get_user():
-                    try:
-                        return User.objects.get(id=user_id)
-                    except User.DoesNotExist:
-                        return AnonymousUser()
-
-                scope["user"] = await get_user()
+                # Tokens already verified and users already loaded come from the auth cache
+                user_id = auth_cache.user_id_for(
+                    token, lambda token: jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+                )
+                scope["user"] = await auth_cache.get_user(user_id) or AnonymousUser()
 
             except Exception as e:
                 scope["user"] = AnonymousUser()
@@ -106,6 +106,10 @@ CHANNEL_LAYERS = {
         # For production, use Redis:
         # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
         # 'CONFIG': {"hosts": [('127.0.0.1', 6379)]},
+        # Several workers on one host, with `manage.py run_channel_broker` running:
+        # 'BACKEND': 'securechatapp.unixlayer.UnixSocketChannelLayer',
+        # Socket in $XDG_RUNTIME_DIR/securechat/ or run/securechat/ by default, any
+        # other "path" must be in a directory only the app user can reach (0700)
     },
 }
 
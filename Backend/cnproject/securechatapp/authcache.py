@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+import time
+from channels.db import database_sync_to_async
+from django.conf import settings
+from securechatapp.lru import LRUCache
+from securechatapp.metrics import metrics
+
+
+class AuthCache:
+    """
+    Verified websocket tokens and the users they belong to. A token is
+    remembered by its SHA-256 digest until its exp, so a reconnect storm
+    decodes each token once. Users are kept WS_AUTH_USER_CACHE_TTL seconds
+    and dropped when the CustomUser row is saved or deleted. Concurrent
+    handshakes for the same user share one database lookup.
+    """
+
+    def __init__(self):
+        self.tokens = LRUCache(getattr(settings, 'WS_AUTH_TOKEN_CACHE_SIZE', 10000))
+        self.users = LRUCache(getattr(settings, 'WS_AUTH_USER_CACHE_SIZE', 10000),
+                              getattr(settings, 'WS_AUTH_USER_CACHE_TTL', 30))
+        self._pending = {}
+        self._invalidations = 0
+
+    def user_id_for(self, token, decode):
+        """user_id of a token, decode(token) -> payload runs only for unseen tokens and raises if invalid"""
+        digest = hashlib.sha256(token.encode()).digest()
+        user_id = self.tokens.get(digest)
+        if user_id is not None:
+            metrics.incr('auth.token_cache_hits')
+            return user_id
+        metrics.incr('auth.token_cache_misses')
+        payload = decode(token)
+        user_id = payload.get('user_id')
+        # Newer simplejwt versions put the id in the token as a string
+        user_id = int(user_id) if user_id is not None else None
+        exp = payload.get('exp')
+        if user_id is not None and exp is not None:
+            self.tokens.set(digest, user_id, ttl=exp - time.time())
+        return user_id
+
+    async def get_user(self, user_id):
+        """The user with this id, None if there is none"""
+        user = self.users.get(user_id)
+        if user is not None:
+            return user
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = asyncio.ensure_future(self._load(user_id))
+            pending.add_done_callback(lambda _: self._pending.pop(user_id, None))
+        return await asyncio.shield(pending)
+
+    async def _load(self, user_id):
+        from securechatapp.models import CustomUser
+
+        invalidations = self._invalidations
+        metrics.incr('auth.user_lookups')
+        user = await database_sync_to_async(CustomUser.objects.filter(id=user_id).first)()
+        # Not cached if the row changed while we were reading it
+        if user is not None and invalidations == self._invalidations:
+            self.users.set(user_id, user)
+        return user
+
+    def invalidate_user(self, user_id):
+        self._invalidations += 1
+        self.users.pop(user_id)
+
+    def clear(self):
+        self.tokens.clear()
+        self.users.clear()
+
+
+class TokenVersionCache:
+    """
+    (token_version, is_active, username) per user for stateless REST
+    authentication, kept JWT_TOKEN_VERSION_TTL seconds and dropped when the
+    CustomUser row is saved or deleted. Other processes see a change once
+    their entry expires.
+    """
+
+    def __init__(self):
+        self.versions = LRUCache(getattr(settings, 'JWT_TOKEN_VERSION_CACHE_SIZE', 10000),
+                                 getattr(settings, 'JWT_TOKEN_VERSION_TTL', 60))
+
+    def get(self, user_id):
+        """Current state of a user, None if there is none. Hits the database on a miss."""
+        from securechatapp.models import CustomUser
+
+        state = self.versions.get(user_id)
+        if state is None:
+            metrics.incr('auth.token_version_lookups')
+            state = CustomUser.objects.filter(id=user_id).values_list('token_version', 'is_active', 'username').first()
+            if state is not None:
+                self.versions.set(user_id, state)
+        return state
+
+    def invalidate(self, user_id):
+        self.versions.pop(user_id)
+
+
+auth_cache = AuthCache()
+token_versions = TokenVersionCache()
+metrics.register_gauge('auth.cached_tokens', lambda: len(auth_cache.tokens))
+metrics.register_gauge('auth.cached_users', lambda: len(auth_cache.users))
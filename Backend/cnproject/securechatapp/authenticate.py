@@ -1,4 +1,65 @@
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject, empty
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from securechatapp.authcache import token_versions
+
+
+def add_user_claims(token, user):
+    """Claims StatelessUser is built from, put in refresh tokens and copied to their access tokens"""
+    token['username'] = user.username
+    token['is_active'] = user.is_active
+    token['tv'] = user.token_version
+    return token
+
+
+class StatelessUser(SimpleLazyObject):
+    """
+    request.user built from access token claims. id, pk, username and
+    is_active are answered without a query; anything else loads the
+    CustomUser row on first use and is served from it from then on.
+    """
+
+    def __init__(self, claims):
+        from securechatapp.models import CustomUser
+
+        self.__dict__['_claims'] = claims
+        super().__init__(lambda: CustomUser.objects.get(id=claims['id']))
+
+    @property
+    def __class__(self):
+        from securechatapp.models import CustomUser
+
+        return CustomUser
+
+    def __bool__(self):
+        return True
+
+    # Same identity as the model instance, by primary key
+    def __hash__(self):
+        return hash(self._claims['id'])
+
+    def __eq__(self, other):
+        from securechatapp.models import CustomUser
+
+        return isinstance(other, CustomUser) and other.pk == self._claims['id']
+
+    def __getattr__(self, name):
+        from securechatapp.models import CustomUser
+
+        if self._wrapped is empty:
+            if name in self._claims:
+                return self._claims[name]
+            if name == '_meta':
+                return CustomUser._meta
+            if name in ('_is_pk_set', '_get_pk_val'):
+                # Only read the pk, enough for filter(user=request.user)
+                return getattr(CustomUser, name).__get__(self)
+            if name != '_state' and not hasattr(CustomUser, name):
+                # hasattr() probes from the ORM, e.g. resolve_expression
+                raise AttributeError(name)
+        return super().__getattr__(name)
+
 
 class JWTAuthFromCookie(JWTAuthentication):
     def authenticate(self, request):
@@ -15,4 +76,34 @@ class JWTAuthFromCookie(JWTAuthentication):
             return None
 
         validated_token = self.get_validated_token(raw_token)
+        if getattr(settings, 'JWT_STATELESS_USER', False) and 'tv' in validated_token:
+            return self.get_stateless_user(validated_token), validated_token
         return self.get_user(validated_token), validated_token
+
+    def get_stateless_user(self, validated_token):
+        """A StatelessUser for the token, checked against the cached token version instead of a query"""
+        user_id = int(validated_token['user_id'])
+        state = check_token_version(user_id, validated_token['tv'])
+        token_version, is_active, username = state
+        return StatelessUser({
+            'id': user_id,
+            'pk': user_id,
+            # The cached row wins over the claim, a rename shows up without a new token
+            'username': username,
+            'is_active': is_active,
+            'token_version': token_version,
+            'is_authenticated': True,
+            'is_anonymous': False,
+        })
+
+
+def check_token_version(user_id, token_version):
+    """(token_version, is_active, username) of the user, raises if the token was revoked or the user can't log in"""
+    state = token_versions.get(user_id)
+    if state is None:
+        raise AuthenticationFailed("User not found", code="user_not_found")
+    if state[0] != token_version:
+        raise AuthenticationFailed("Token has been revoked", code="token_revoked")
+    if not state[1]:
+        raise AuthenticationFailed("User is inactive", code="user_inactive")
+    return state
@@ -0,0 +1,103 @@
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func, iterations, warmup=1, units_per_call=1):
+    """
+    Time func() over a number of iterations. Returns ops/sec and latency
+    percentiles in milliseconds. units_per_call lets a batch call count as
+    many operations, e.g. decrypting a whole history.
+    """
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    total = sum(timings)
+    return {
+        'iterations': iterations,
+        'ops_per_sec': (iterations * units_per_call) / total if total else 0.0,
+        'mean_ms': statistics.fmean(timings) * 1000,
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+    }
+
+
+def run_metadata():
+    try:
+        from Cryptodome import __version__ as cryptodome_version
+    except ImportError:
+        cryptodome_version = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'pycryptodome': cryptodome_version,
+    }
+
+
+def result_key(result):
+    return (result['op'], result.get('size'))
+
+
+def write_report(path, suite, results):
+    with open(path, 'w') as f:
+        json.dump({'suite': suite, 'meta': run_metadata(), 'results': results}, f, indent=2)
+
+
+def compare(baseline_path, results, max_regression):
+    """
+    Compare ops/sec against an earlier report. Returns a list of
+    (result key, baseline ops/sec, current ops/sec, change) for every
+    operation that got slower by more than max_regression (a fraction).
+    """
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get(result_key(result))
+        if not before or not before['ops_per_sec']:
+            continue
+        change = result['ops_per_sec'] / before['ops_per_sec'] - 1
+        if change < -max_regression:
+            regressions.append((result_key(result), before['ops_per_sec'], result['ops_per_sec'], change))
+    return regressions
+
+
+def add_compare_arguments(parser):
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Earlier report to compare ops/sec against")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="Allowed slowdown against the baseline, as a fraction")
+
+
+def finish(command, options, suite, results):
+    """
+    Write the report of a benchmark command to --output, then exit with
+    status 1 if --compare was given and an operation regressed.
+    """
+    write_report(options['output'], suite, results)
+    command.stdout.write(command.style.SUCCESS(f"Wrote {options['output']}"))
+
+    if options['compare']:
+        regressions = compare(options['compare'], results, options['max_regression'])
+        for (op, size), before, after, change in regressions:
+            command.stdout.write(command.style.ERROR(
+                f"Regression {op}[{size}]: {before:.1f} -> {after:.1f} ops/s ({change:+.0%})"
+            ))
+        if regressions:
+            sys.exit(1)
@@ -1,10 +1,13 @@
+import asyncio
 import json
 import urllib.parse
 import base64
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.utils import timezone
-from securechatapp.models import Message, CustomUser, ChatRoomMembership, EncryptionKey
+from django.utils.dateparse import parse_datetime
+from django.db.models import Q
+from securechatapp.models import Message, CustomUser, ChatRoom, ChatRoomMembership, EncryptionKey, ReadWatermark
 from securechatapp.serializer import MessageSerializer
 from asgiref.sync import sync_to_async
 from Cryptodome.Cipher import PKCS1_OAEP, AES
@@ -13,112 +16,26 @@ from Cryptodome.Random import get_random_bytes
 from Cryptodome.Util.Padding import pad, unpad
 from asgiref.sync import SyncToAsync 
 from asgiref.sync import sync_to_async
-
-class EncryptionManager:
-    """
-    Handles encryption and decryption of messages.
-    Uses RSA for key exchange and AES for message encryption.
-    """
-    @staticmethod
-    def generate_key_pair():
-        """Generate a new RSA key pair"""
-        private_key = RSA.generate(2048)
-        public_key = private_key.publickey()
-        
-        # Convert to string format
-        private_key_str = private_key.export_key().decode('utf-8')
-        public_key_str = public_key.export_key().decode('utf-8')
-        
-        return private_key_str, public_key_str
-
-    def get_or_create_user_key(user):
-        try:
-            # print("User key found in database.", user)
-            CustomUser.objects.get(username=user.username)
-            key_obj = EncryptionKey.objects.filter(user=user).values('private_key', 'public_key').first()
-            # print("ljhjadh", key_obj)
-            if key_obj is None:
-                raise EncryptionKey.DoesNotExist("No key found for user.")
-            private_key =key_obj['private_key']
-            public_key = key_obj['public_key']
-        except EncryptionKey.DoesNotExist:
-            private_key_str, public_key_str = EncryptionManager.generate_key_pair()
-            EncryptionKey.objects.create(
-                user=user,
-                private_key=private_key_str,
-                public_key=public_key_str
-            )
-            private_key = RSA.import_key(private_key_str)
-            public_key = RSA.import_key(public_key_str)
-        
-        return private_key, public_key
-    
-    
-    @staticmethod
-    def encrypt_message(message, recipient_public_key_str):
-        """
-        Encrypt a message using hybrid encryption (RSA + AES)
-        - Generate a random AES key
-        - Encrypt the message with AES
-        - Encrypt the AES key with recipient's public RSA key
-        - Return both encrypted key and encrypted message
-        """
-        # Convert message to bytes if it's a string
-        # print(f"Recipient's public key: {recipient_public_key_str}")
-        if isinstance(message, str):
-            message = message.encode('utf-8')
-        else:
-            raise ValueError("Message must be a string")
-            
-        # Import recipient's public key
-        recipient_public_key = RSA.import_key(recipient_public_key_str)
-        # Generate a random AES session key
-        aes_key = get_random_bytes(16)  # 128 bits
-        
-        # Encrypt the message with AES
-        cipher_aes = AES.new(aes_key, AES.MODE_CBC)
-        padded_message = pad(message, AES.block_size)
-        encrypted_message = cipher_aes.encrypt(padded_message)
-        
-        # Encrypt the AES key with recipient's public key
-        cipher_rsa = PKCS1_OAEP.new(recipient_public_key)
-        encrypted_aes_key = cipher_rsa.encrypt(aes_key)
-        
-        # Encode everything to base64 for safe transport
-        encrypted_data = {
-            'key': base64.b64encode(encrypted_aes_key).decode('utf-8'),
-            'iv': base64.b64encode(cipher_aes.iv).decode('utf-8'),
-            'message': base64.b64encode(encrypted_message).decode('utf-8')
-        }
-        data = json.dumps(encrypted_data)
-        # print(data)
-        return data
-    
-    @staticmethod
-    def decrypt_message(encrypted_data_str, private_key_str):
-        try:
-            if isinstance(encrypted_data_str, str):
-                encrypted_data = json.loads(encrypted_data_str)
-            elif isinstance(encrypted_data_str, dict) and 'content' in encrypted_data_str:
-                encrypted_data = json.loads(encrypted_data_str['content'])
-            else:
-                raise ValueError("Invalid encrypted message format")
-           
-            encrypted_aes_key = base64.b64decode(encrypted_data['key'])
-            iv = base64.b64decode(encrypted_data['iv'])
-            encrypted_message = base64.b64decode(encrypted_data['message'])
-            private_key = RSA.import_key(private_key_str)
-            cipher_rsa = PKCS1_OAEP.new(private_key)
-            aes_key = cipher_rsa.decrypt(encrypted_aes_key)
-
-            cipher_aes = AES.new(aes_key, AES.MODE_CBC, iv)
-            padded_message = cipher_aes.decrypt(encrypted_message)
-            message = unpad(padded_message, AES.block_size)
-
-            return {"content": message.decode('utf-8')}
-        except Exception as e:
-            print(f"Error decrypting message: {e}")
-            # return {"content": "[Decryption failed]"}
+from django.conf import settings
+from securechatapp.sessionkeys import session_keys
+from securechatapp.encryption import EncryptionManager
+from securechatapp.cryptoservice import crypto_service
+from securechatapp import envelope
+from securechatapp.receipts import ReceiptAggregator, advance_read_watermark, room_watermarks, is_read
+from securechatapp.typingstate import typing_tracker, typing_event
+from securechatapp.writebehind import message_writer
+from securechatapp.presence import presence
+from securechatapp.events import message_event
+from securechatapp import frames
+from securechatapp.outbound import OutboundQueue
+from securechatapp.keydirectory import key_directory
+from securechatapp.metrics import metrics
+
+def parse_message_id(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -135,7 +52,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
             # In a real app, you would retrieve the private key from secure storage
             user = self.scope['user']
 
-            private_key, public_key = EncryptionManager.get_or_create_user_key(user)
+            entry = key_directory.get_id(user.id)
+            if entry is not None:
+                private_key, public_key = entry.private_key, entry.public_key
+            else:
+                private_key, public_key = EncryptionManager.get_or_create_user_key(user)
             
             # Save the user's public key to the database
             # EncryptionKey.objects.update_or_create(
@@ -148,134 +69,272 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.public_key = public_key
         
         return self.private_key
-    @database_sync_to_async
-    def get_recipient_public_key(self, username):
+    async def get_recipient_public_key(self, username):
         try:
-            if hasattr(self, 'reci_public_key'):
-                return self.reci_public_key
-            recipient = CustomUser.objects.filter(username=username).values('id').first()
-            if recipient is None:
-                return None
-            key = EncryptionKey.objects.filter(user_id=recipient['id']).first()
-            # print(f"Recipient's public key: {key}")
-            if key:
-                self.reci_public_key = key.public_key
-                return self.reci_public_key
-            else:
+            # Shared by every socket in the process, see keydirectory
+            entry = key_directory.cached(username) or await database_sync_to_async(key_directory.get)(username)
+            if entry is None:
                 # print(f"No encryption key found for user: {username}")
                 return None
+            self.reci_user_id = entry.user_id
+            return entry.public_key
         except Exception as e:
             print(f"Could not find public key for {username}: {e}")
             return None
 
-    @sync_to_async
+    async def get_group_recipients(self):
+        """(user_id, public_key) for every member of a group room, one query"""
+        if not hasattr(self, 'group_recipients'):
+            entries = await database_sync_to_async(key_directory.warm_room)(self.room_id)
+            self.group_recipients = [(entry.user_id, entry.public_key) for entry in entries]
+        return self.group_recipients
+
     def serialize_message(self, message):
         if not message:
             return None
-        try:
-            serializer = MessageSerializer(message)
-            serialized_data = serializer.data
-            return {
-                'id': serialized_data['id'],
-                'sender': serialized_data['sender']['username'],
-                'content': serialized_data['content'],
-                'timestamp': serialized_data['timestamp'],
-                'is_read': serialized_data['is_read'],
-                'is_delivered': serialized_data['is_delivered'],
-                'chat_room': serialized_data['chat_room']['id'],
-            }
-        except Exception as e:
-            print(f"Error serializing message: {e}")
-            return None
+        # Built from known fields, no queries on the send path
+        return message_event(message, self.scope['user'].username)
 
     @database_sync_to_async
-    def mark_message_as_delivered(self, message_id):
-        if not message_id:
-            return None
-        try:
-            message = Message.objects.get(id=message_id)
-            message.is_delivered = True
-            message.save(update_fields=['is_delivered'])
-            # print(f"Message {message_id} marked as delivered.")
-            return message
-        except Message.DoesNotExist:
-            print(f"Message with ID {message_id} does not exist.")
-        except Exception as e:
-            print(f"Error marking message as delivered: {e}")
-        return None
+    def mark_messages_as_delivered(self, message_ids):
+        """One UPDATE for a batch of ids, limited to other people's messages in this room"""
+        if message_writer.enabled:
+            message_writer.mark_delivered(message_ids, self.room_id, self.scope['user'].id)
+        return Message.objects.filter(
+            id__in=message_ids, chat_room_id=self.room_id, is_delivered=False
+        ).exclude(sender_id=self.scope['user'].id).update(is_delivered=True)
+
+    async def flush_delivery_receipts(self, message_ids):
+        await self.mark_messages_as_delivered(message_ids)
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            frames.broadcast({
+                'type': 'delivery_receipts',
+                'message_ids': message_ids,
+                'sender': self.scope['user'].username,
+                'sender_channel_name': self.channel_name,
+                'room_id': self.room_id,
+            }, {
+                'type': 'delivery-receipts',
+                'message_ids': message_ids,
+                'sender': self.scope['user'].username,
+            })
+        )
     
     @database_sync_to_async
-    def mark_message_as_read(self, message_id):
-        if not message_id:
-            return None
-        try:
-            message = Message.objects.get(id=message_id)
-            message.is_read = True
-            message.save(update_fields=['is_read'])
-            # print(f"Message {message_id} marked as read.")
-            return message
-        except Message.DoesNotExist:
-            print(f"Message with ID {message_id} does not exist.")
-        except Exception as e:
-            print(f"Error marking message as read: {e}")
-        return None
-            
-    
+    def advance_read_watermark(self, message_id):
+        return advance_read_watermark(self.scope['user'].id, self.room_id, message_id)
 
-    async def fetch_chat_history(self, room_id):
-        current_user_id = self.scope["user"].id  # Assuming authenticated user
-        print("Current user ID:", current_user_id)
+    async def flush_read_receipts(self, message_ids):
+        # Only the highest id matters, everything below it is read too
+        message_id = await self.advance_read_watermark(message_ids[-1])
+        if message_id is not None:
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                frames.broadcast({
+                    'type': 'read_watermark',
+                    'message_id': message_id,
+                    'sender': self.scope['user'].username,
+                    'sender_channel_name': self.channel_name,
+                    'room_id': self.room_id,
+                }, {
+                    'type': 'read-watermark',
+                    'message_id': message_id,
+                    'sender': self.scope['user'].username,
+                })
+            )
+
+    async def fetch_chat_history(self, room_id, before=None):
+        """
+        Fetch and decrypt one page of history, newest first by (timestamp, id).
+        before is a cursor from a previous page. Returns the page in
+        chronological order, the cursor for the next older page and whether
+        there is more. A page is cut short once its decrypted content passes
+        CHAT_HISTORY_MAX_PAGE_BYTES to bound the memory a connection holds.
+        """
+        page_size = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+        max_page_bytes = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_BYTES', 1024 * 1024)
 
         @sync_to_async
         def get_messages():
-            return list(Message.objects.filter(chat_room_id=room_id).values(
-                'id', 'sender', 'chat_room_id', 'content', 'timestamp',
-                'is_read', 'is_delivered'
-            ))
-        @sync_to_async
-        def private_key_recipents():
-            recipents_private_key, public_key =  EncryptionManager.get_or_create_user_key( CustomUser.objects.filter(username=self.scope['url_route']['kwargs']['chatwithusername']).first())
-            return recipents_private_key, public_key
-
-        messages = await get_messages()
-        private_key = await self.get_private_key()
-        recipents_private_key, public_key = await private_key_recipents()
+            if before is None:
+                session_keys.prefetch_room(room_id)
+                key_directory.warm_room(room_id)
+            queryset = Message.objects.filter(chat_room_id=room_id)
+            if before is not None:
+                timestamp = parse_datetime(before['timestamp'])
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=before['id'])
+                )
+            return room_watermarks(room_id), list(queryset.order_by('-timestamp', '-id').values(
+                'id', 'sender', 'sender__username', 'chat_room_id', 'content', 'payload', 'timestamp',
+                'is_delivered'
+            )[:page_size + 1])
+
+        watermarks, messages = await get_messages()
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        decrypted_by_id = await self.decrypt_rows(messages)
 
         message_list = []
+        page_bytes = 0
+        cursor = None
         for message in messages:
+            if page_bytes >= max_page_bytes:
+                has_more = True
+                break
+            cursor = {'timestamp': message['timestamp'].isoformat(), 'id': message['id']}
             try:
-                # Only decrypt if the current user is the intended recipient
-                if message['sender'] != current_user_id:
-                    print(message['sender'], current_user_id)
-                    # message['content'] = "[Encrypted message sent by you]"
-                    decrypted =  EncryptionManager.decrypt_message(message, private_key)
-                    print("Decrypted message:", decrypted)
-                    if isinstance(decrypted, dict) and 'content' in decrypted:
-                        message['content'] = decrypted['content']
-                    else:
-                        message['content'] = decrypted.content
-      
-                        
-                else:
-                    # Optional: skip decryption or store as-is
-                    temp_message = EncryptionManager.decrypt_message(message, recipents_private_key)
-                    if isinstance(temp_message, dict) and 'content' in temp_message:
-                        message['content'] = temp_message['content']
-                    else:
-                        message['content'] = EncryptionManager.decrypt_message(message, recipents_private_key)
-                message['timestamp'] = message['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
-                if(message['sender'] == current_user_id):
-                    message['sender'] = self.scope['user'].username
-                else:
-                    message['sender'] = self.scope['url_route']['kwargs']['chatwithusername']
+                self.format_row(message, decrypted_by_id[message['id']], watermarks)
+                page_bytes += len(message['content'])
                 message_list.append(message)
             except Exception as e:
                 print(f"Decryption error for message {message['id']}: {e}")
                 continue  # Skip this message if decryption fails
 
-        # print(f"Private key: {private_key}")
-        return message_list
+        message_list.reverse()
+        return message_list, cursor if has_more else None, has_more
+
+    async def decrypt_rows(self, messages):
+        """{id: decrypted} for message rows as loaded by fetch_chat_history"""
+        current_user_id = self.scope["user"].id
+
+        @sync_to_async
+        def private_key_recipents():
+            recipient = CustomUser.objects.filter(username=self.scope['url_route']['kwargs']['chatwithusername']).first()
+            recipents_private_key, public_key =  EncryptionManager.get_or_create_user_key(recipient)
+            return recipient.id, recipents_private_key, public_key
 
+        private_key = await self.get_private_key()
+        # Warmed with the first page above, the fallback creates a missing key
+        entry = key_directory.cached(self.scope['url_route']['kwargs']['chatwithusername'])
+        if entry is not None:
+            recipient_id, recipents_private_key, public_key = entry.user_id, entry.private_key, entry.public_key
+        else:
+            recipient_id, recipents_private_key, public_key = await private_key_recipents()
+
+        # Decrypt on the crypto pool, one batch per key, both batches concurrently
+        received = [m for m in messages if m['sender'] != current_user_id]
+        sent = [m for m in messages if m['sender'] == current_user_id]
+        received_plain, sent_plain = await asyncio.gather(
+            crypto_service.decrypt_batch([envelope.stored(m) for m in received], private_key, current_user_id),
+            crypto_service.decrypt_batch([envelope.stored(m) for m in sent], recipents_private_key, recipient_id),
+        )
+        decrypted_by_id = {}
+        for message, decrypted in zip(received + sent, received_plain + sent_plain):
+            decrypted_by_id[message['id']] = decrypted
+        return decrypted_by_id
+
+    def format_row(self, message, decrypted, watermarks):
+        """Turn a loaded message row into the dict sent to the client, in place"""
+        del message['payload']
+        message['content'] = decrypted['content']
+        message['timestamp'] = message['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+        message['is_read'] = is_read(message['id'], message['sender'], watermarks)
+        message['sender'] = message.pop('sender__username')
+        return message
+
+    async def fetch_sync(self, room_id, since):
+        """
+        What changed in the room after message since, for a client that
+        reconnects with it: newer messages, read watermarks that moved since
+        it was sent and the user's own messages up to it that are still
+        undelivered. Returns None when since isn't a message of the room or
+        more than CHAT_SYNC_MAX_MESSAGES newer or undelivered ones piled up,
+        the client gets a full page instead.
+        """
+        max_messages = getattr(settings, 'CHAT_SYNC_MAX_MESSAGES', 500)
+        fields = ('id', 'sender', 'sender__username', 'chat_room_id', 'content', 'payload', 'timestamp', 'is_delivered')
+
+        @sync_to_async
+        def get_changes():
+            cursor = Message.objects.filter(id=since, chat_room_id=room_id).values_list('timestamp', flat=True).first()
+            if cursor is None:
+                return None
+            queryset = Message.objects.filter(chat_room_id=room_id)
+            # By (timestamp, id): write-behind ids of different workers are not in send order
+            after = Q(timestamp__gt=cursor) | Q(timestamp=cursor, id__gt=since)
+            newer = list(queryset.filter(after).order_by('timestamp', 'id').values(*fields)[:max_messages + 1])
+            if len(newer) > max_messages:
+                return None
+            undelivered = list(queryset.filter(
+                ~after, sender_id=self.scope['user'].id, is_delivered=False
+            ).order_by('id').values_list('id', flat=True)[:max_messages + 1])
+            if len(undelivered) > max_messages:
+                return None
+            session_keys.prefetch_room(room_id)
+            key_directory.warm_room(room_id)
+            moved = list(ReadWatermark.objects.filter(chat_room_id=room_id, updated_at__gt=cursor).values_list(
+                'user__username', 'last_read_message_id'
+            ))
+            return room_watermarks(room_id), newer, undelivered, moved
+
+        changes = await get_changes()
+        if changes is None:
+            metrics.incr('sync.full_page_fallbacks')
+            return None
+        watermarks, newer, undelivered, moved = changes
+        decrypted_by_id = await self.decrypt_rows(newer)
+        messages = []
+        for message in newer:
+            try:
+                messages.append(self.format_row(message, decrypted_by_id[message['id']], watermarks))
+            except Exception as e:
+                print(f"Decryption error for message {message['id']}: {e}")
+        metrics.incr('sync.incremental')
+        return {
+            "type": "chat_sync",
+            "since": since,
+            "messages": messages,
+            "read_watermarks": [{'sender': username, 'message_id': message_id} for username, message_id in moved],
+            "undelivered": undelivered,
+        }
+
+    async def send_history(self, since=None):
+        """Changes after since when the client has a cursor we can still serve, the newest page otherwise"""
+        if since is not None:
+            sync = await self.fetch_sync(self.room_id, since)
+            if sync is not None:
+                newest = sync['messages'][-1]['id'] if sync['messages'] else since
+                await self.send_frame(sync, newest)
+                return
+        chat_history, history_cursor, history_has_more = await self.fetch_chat_history(self.room_id)
+        await self.send_frame({
+            "type": "chat_history",
+            "messages": chat_history,
+            "cursor": history_cursor,
+            "has_more": history_has_more,
+        }, chat_history[-1]['id'] if chat_history else None)
+
+    async def handle_load_more(self, cursor, pages=1):
+        """
+        Stream older history pages starting at cursor in a background task so
+        live events keep flowing, each page is sent as soon as it is
+        decrypted. Only one load runs per connection at a time, a load_more
+        that arrives meanwhile is dropped.
+        """
+        if not cursor or self.history_loading:
+            return
+        self.history_loading = True
+        self.history_task = asyncio.ensure_future(self.stream_history_pages(cursor, pages))
+
+    async def stream_history_pages(self, cursor, pages):
+        max_pages = getattr(settings, 'CHAT_HISTORY_MAX_PAGES_PER_REQUEST', 5)
+        try:
+            for _ in range(max(1, min(int(pages or 1), max_pages))):
+                messages, cursor, has_more = await self.fetch_chat_history(self.room_id, before=cursor)
+                await self.send_frame({
+                    "type": "chat_history_page",
+                    "messages": messages,
+                    "cursor": cursor,
+                    "has_more": has_more,
+                })
+                if not has_more:
+                    break
+        except Exception as e:
+            print(f"Error loading older history: {e}")
+        finally:
+            self.history_loading = False
 
     async def create_message(self, message_data):
         try:
@@ -300,14 +359,41 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if not recipient_public_key:
                 return None
             print("encrpyting message", decoded_message)
-            encrypted_message = EncryptionManager.encrypt_message(
-                decoded_message, recipient_public_key
-            )
+            if getattr(self, 'is_group', False):
+                # One AES encryption, the key is wrapped per member
+                recipients = await self.get_group_recipients()
+                encrypted_message = await crypto_service.encrypt_for_recipients(decoded_message, recipients)
+            elif getattr(settings, 'ENCRYPTION_SESSION_KEYS', True):
+                conversation = (self.scope['user'].id, self.reci_user_id, self.room_id)
+                session = session_keys.current(*conversation)
+                if session is None:
+                    session = await database_sync_to_async(session_keys.rotate)(*conversation, recipient_public_key)
+                encrypted_message = await crypto_service.encrypt(decoded_message, session=session)
+            else:
+                encrypted_message = await crypto_service.encrypt(
+                    decoded_message, recipient_public_key, getattr(self, 'reci_user_id', None)
+                )
+
+            if message_writer.enabled:
+                # Id assigned here, the row is inserted in a later batch
+                ids = message_writer.ids
+                message_id = ids.next_id() if ids.remaining() else await database_sync_to_async(ids.next_id)()
+                new_message = Message(
+                    id=message_id,
+                    sender=self.scope['user'],
+                    chat_room_id=self.room_id,
+                    payload=encrypted_message,
+                    timestamp=timezone.now(),
+                    is_read=False,
+                    is_delivered=False
+                )
+                await message_writer.submit(new_message)
+                return new_message
 
             new_message = await database_sync_to_async(Message.objects.create)(
                 sender=self.scope['user'],
                 chat_room_id=self.room_id,
-                content=encrypted_message,
+                payload=encrypted_message,
                 timestamp=timezone.now(),
                 is_read=False,
                 is_delivered=False
@@ -324,20 +410,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         try:
             # Find the target user
             user = CustomUser.objects.get(username=username)
-            
-            # Get room IDs for both users
-            room_ids_target = set(
-                ChatRoomMembership.objects.filter(user_id=user).values_list('chat_room_id', flat=True)
-            )
-            room_ids_current = set(
-                ChatRoomMembership.objects.filter(user_id=self.scope['user']).values_list('chat_room_id', flat=True)
-            )
 
-            # Find common room(s)
-            common_rooms = room_ids_target & room_ids_current
-            
-            # Get the first common room
-            self.room_id = next(iter(common_rooms), None)
+            # Direct room through the canonical member key, one indexed lookup
+            member_key = ChatRoom.make_member_key([user.id, self.scope['user'].id])
+            room = ChatRoom.objects.filter(member_key=member_key, is_group=False).values_list('id', 'is_group').first()
+            if room is None:
+                # Any other room both users are in, e.g. a group
+                room = (
+                    ChatRoom.objects.filter(memberships__user=user)
+                    .filter(memberships__user=self.scope['user'])
+                    .order_by('id').values_list('id', 'is_group').first()
+                )
+            self.room_id, self.is_group = room if room else (None, False)
             return str(self.room_id) if self.room_id else None
 
         except CustomUser.DoesNotExist:
@@ -350,6 +434,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # Get the username from the URL route
         chat_with = self.scope['url_route']['kwargs']['chatwithusername']
+        # Binary protocol if the client asked for one we support, JSON text otherwise
+        self.codec = frames.negotiate(self.scope.get('subprotocols'))
  
         # Check if user is authenticated
         if self.scope['user'].is_anonymous:
@@ -376,54 +462,110 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         # Join the room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        self.open_outbound()
+        await self.accept(subprotocol=self.codec.subprotocol)
+        await self.join_room(self.query_since())
+
+    async def join_room(self, since=None):
+        """
+        Keys, history, presence and receipt state for the room, once its group
+        is joined. since is the newest message id the client already has.
+        """
         await self.get_private_key()
-        # Fetch and send chat history
-        chat_history = await self.fetch_chat_history(self.room_id)
+        self.history_loading = False
+        self.delivery_aggregator = ReceiptAggregator(self.flush_delivery_receipts)
+        self.read_aggregator = ReceiptAggregator(self.flush_read_receipts)
+
+        # Announce user presence, only for the first socket this user has in the room
+        username = self.scope['user'].username
+        self.counted_in_presence = True
+        if presence.connect(self.scope['user'].id, username, self.room_id):
+            await self.channel_layer.group_send(self.room_group_name, frames.broadcast({
+                'type': 'online_acknowledge',
+                'message': f"User {username} has joined the chat.",
+                'sender': username,
+                'sender_channel_name': self.channel_name,
+                'origin': presence.process_id,
+                'room_id': self.room_id,
+            }, {
+                'type': 'online-acknowledge',
+                'message': f"User {username} has joined the chat.",
+                'sender': username,
+            }))
+
+        # Members connected to this process, straight from the registry
+        for member in presence.online_in_room(self.room_id):
+            if member != username:
+                await self.send_frame({
+                    'type': 'reply-online-acknowledge',
+                    'message': f"User {member} is online.",
+                    'sender': member,
+                })
         
-
-        # Announce user presence
-        online_message = {
-            "type": "online-acknowledge",
-            "message": f"User {self.scope['user'].username} has joined the chat.",
-            "sender": self.scope['user'].username,
-            'sender_channel_name': self.channel_name,
-        }
-        
-        await self.channel_layer.group_send(self.room_group_name, {
-            'type': 'online_acknowledge',
-            'message': online_message["message"],
-            'sender': online_message["sender"],
-            'sender_channel_name': online_message["sender_channel_name"],
-        })
-        
-        # Send chat history to the client
-        await self.send(text_data=json.dumps({
-            "type": "chat_history",
-            "messages": chat_history,
-        }))
+        # Send chat history to the client, only what changed if it has some
+        await self.send_history(since)
 
     async def disconnect(self, close_code):
         if hasattr(self, 'room_group_name') and self.channel_layer:
-            # Notify others that user has left
-            offline_message = {
-                "type": "offline-acknowledge",
-                "message": f"User {self.scope['user'].username} has left the chat.",
-                "sender": self.scope['user'].username,
-            }
-            
-            await self.channel_layer.group_send(self.room_group_name, {
+            await self.leave_room()
+        if getattr(self, 'outbound', None):
+            self.outbound.stop()
+
+    async def leave_room(self):
+        if getattr(self, 'history_task', None):
+            self.history_task.cancel()
+        # Notify others that user has left, once their last socket in the room is gone
+        username = self.scope['user'].username
+        if getattr(self, 'counted_in_presence', False) and presence.disconnect(self.scope['user'].id, username, self.room_id):
+            await self.channel_layer.group_send(self.room_group_name, frames.broadcast({
                 'type': 'offline_acknowledge',
-                'message': offline_message["message"],
-                'sender': offline_message["sender"],
-            })
-
-            print(f"Disconnecting from room group: {self.room_group_name}")
-            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+                'message': f"User {username} has left the chat.",
+                'sender': username,
+                'room_id': self.room_id,
+            }, {
+                'type': 'offline-acknowledge',
+                'message': f"User {username} has left the chat.",
+                'sender': username,
+            }))
+
+        if typing_tracker.is_typing(self.room_id, self.scope['user'].username):
+            await self.handle_writing_indicator(False)
+        if getattr(self, 'delivery_aggregator', None):
+            await self.delivery_aggregator.flush()
+            await self.read_aggregator.flush()
+        print(f"Disconnecting from room group: {self.room_group_name}")
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    def query_param(self, name):
+        return urllib.parse.parse_qs(self.scope.get('query_string', b'').decode()).get(name, [None])[0]
+
+    def query_since(self):
+        """?since=<message id> from the websocket URL, None if missing or not a number"""
+        return parse_message_id(self.query_param('since'))
+
+    def open_outbound(self):
+        self.outbound = OutboundQueue(self, batch=self.query_param('batch') == '1')
+
+    async def send_frame(self, frame, message_id=None):
+        # Queued, written by the outbound writer task. message_id marks frames
+        # that move the client's resume point.
+        resume = (self.room_id, message_id) if message_id is not None else None
+        self.outbound.put(self.codec.encode(frame), frame['type'], resume)
+
+    async def send_event_frame(self, event, build):
+        # Broadcasts arrive encoded in JSON and the broadcast protocols, see frames.broadcast()
+        self.outbound.put(frames.event_frame(event, self.codec, build), event['type'].replace('_', '-'))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            await self.handle_frame(self.codec.decode(text_data if text_data is not None else bytes_data))
+        except (json.JSONDecodeError, ValueError):
+            print("Invalid frame received")
+        except Exception as e:
+            print(f"Error in receive: {e}")
 
-    async def receive(self, text_data):
+    async def handle_frame(self, data):
         try:
-            data = json.loads(text_data)
             message_type = data.get('type', 'chat_message')
             message = data.get('message')
             message_id = data.get('message_id')
@@ -431,26 +573,30 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if message_type == 'chat_message':
                 # Regular message handling
                 await self.handle_chat_message(message)
-            elif message_type == 'mark_delivered':
+            elif message_type in ('mark_delivered', 'delivery-receipt'):
                 # Handle delivery receipt
                 await self.handle_delivery_receipt(message_id)
-            elif message_type == 'read_receipt':
+            elif message_type in ('read_receipt', 'read_up_to'):
                 # Handle read receipt
                 await self.handle_read_receipt(message_id)
             elif message_type == 'writing_indicator':
-                # Handle typing indicator
-                await self.handle_writing_indicator()
+                # Handle typing indicator, is_typing false when the user stopped
+                await self.handle_writing_indicator(data.get('is_typing', True))
+            elif message_type == 'load_more':
+                # Older history pages before the given cursor
+                await self.handle_load_more(data.get('cursor'), data.get('pages', 1))
+            elif message_type == 'sync':
+                # Changes after the newest message the client has, e.g. after a slow-consumer close
+                await self.send_history(parse_message_id(data.get('since')))
             else:
                 print(f"Unknown message type: {message_type}")
-        except json.JSONDecodeError:
-            print("Invalid JSON received")
         except Exception as e:
             print(f"Error in receive: {e}")
 
     async def handle_chat_message(self, message):
     # Create and save the message in DB first
         created_message = await self.create_message(message)
-        serialized_message = await self.serialize_message(created_message)
+        serialized_message = self.serialize_message(created_message)
 
         if created_message:
             # Broadcast to all users (including sender)
@@ -462,76 +608,45 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'sender_channel_name': self.channel_name,
                     'sender_username': self.scope['user'].username,
                     'message_id': created_message.id,
+                    'payload': created_message.payload,
+                    'room_id': self.room_id,
                 }
             )
     async def handle_delivery_receipt(self, message_id):
-        # Mark message as delivered and notify the room
-        message = await self.mark_message_as_delivered(message_id)
-        if message:
-            serialized_message = await self.serialize_message(message)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'delivery_receipt',
-                    'message_id': message_id,
-                    'sender': self.scope['user'].username,
-                    'serialized_message': serialized_message,
-                }
-            )
+        # Buffered, flushed as one UPDATE and one compact receipt frame
+        parsed = parse_message_id(message_id)
+        if parsed is None:
+            print(f"Invalid message id in delivery receipt: {message_id}")
+            return
+        self.delivery_aggregator.add(parsed)
 
     async def handle_read_receipt(self, message_id):
-        # Mark message as read and notify the room
-        message = await self.mark_message_as_read(message_id)
-        if message:
-            serialized_message = await self.serialize_message(message)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'read_receipt',
-                    'message_id': message_id,
-                    'sender': self.scope['user'].username,
-                    'serialized_message': serialized_message,
-                }
-            )
+        # Advances this user's read watermark, batched like delivery receipts
+        parsed = parse_message_id(message_id)
+        if parsed is None:
+            print(f"Invalid message id in read receipt: {message_id}")
+            return
+        self.read_aggregator.add(parsed)
 
-    async def handle_writing_indicator(self):
-        # Notify the room that user is typing
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'writing_indicator',
-                'message': f"{self.scope['user'].username} is typing...",
-                'sender': self.scope['user'].username,
-            }
-        )
+    async def handle_writing_indicator(self, is_typing=True):
+        # Only state changes, and a keepalive per interval while typing, reach the room
+        username = self.scope['user'].username
+        if typing_tracker.update(self.room_id, username, bool(is_typing)):
+            await self.channel_layer.group_send(self.room_group_name, typing_event(self.room_id, username, bool(is_typing)))
+        # Stale typing state is expired and held-back changes released by the sweeper
+        typing_tracker.ensure_sweeper()
 
         # Skip sending back to the sender
     async def chat_message(self, event):
         if self.channel_name == event.get('sender_channel_name'):
             return  # Skip for the sender
 
-        # Mark as delivered in DB
-        updated_message = await self.mark_message_as_delivered(event['message_id'])
+        # Mark as delivered, batched with other deliveries on this connection
+        self.delivery_aggregator.add(event['message_id'])
         private_key = await self.get_private_key()
         print(self.scope['user'].username, )
         # print("Testing Code",event['message'], private_key)
-        decrypted_content = EncryptionManager.decrypt_message(event['message'], private_key)
-        # Send delivery receipt back to sender's channel
-        if updated_message:
-            #'type': 'delivery-receipt',
-            # 'message_id': event.get('message_id'),
-            # 'sender': event['sender'],
-            # 'serialized_message': event.get('serialized_message'),
-            await self.channel_layer.send(
-                event.get('sender_channel_name'),
-                {
-                    'type': 'delivery.receipt',
-                    'message_id': event['message_id'],
-                    'sender': event['sender_username'],
-                    'serialized_message': decrypted_content,
-                    'message': decrypted_content,
-                }
-            )
+        decrypted_content = await crypto_service.decrypt(event.get('payload') or event['message'], private_key, self.scope['user'].id)
         # print("event", event['message'])
         # Send chat message to receiver
         message = {
@@ -543,65 +658,221 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'is_delivered': event['message'].get('is_delivered', False),
             'chat_room': event['message'].get('chat_room', None),
         }
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             "type": "chat_message",
             "message": message,
             
-        }))
+        }, event['message_id'])
         
     async def online_acknowledge(self, event):
         if self.channel_name == event.get('sender_channel_name'):
             return
-        await self.send(text_data=json.dumps({
+        await self.send_event_frame(event, lambda: {
             'type': 'online-acknowledge',
             'message': event['message'],
             'sender': event['sender'],
-        }))
+        })
 
+        # A joiner on this process already got us from the presence registry
+        if event.get('origin') == presence.process_id:
+            return
         await self.channel_layer.send(
             event.get('sender_channel_name'),
             {
                 'type': 'reply_online_acknowledge',
-                'message': event['message'],
-                'sender': event['sender'],
+                'message': f"User {self.scope['user'].username} is online.",
+                'sender': self.scope['user'].username,
+                'room_id': self.room_id,
             }
         )
     async def reply_online_acknowledge(self, event):
         if self.channel_name == event.get('sender_channel_name'):
             return
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'reply-online-acknowledge',
             'message': event['message'],
             'sender': event['sender'],
-        }))
+        })
 
 
     async def offline_acknowledge(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event_frame(event, lambda: {
             'type': 'offline-acknowledge',
             'message': event['message'],
             'sender': event['sender'],
-        }))
+        })
 
     async def writing_indicator(self, event):
-        await self.send(text_data=json.dumps({
+        if event['sender'] == self.scope['user'].username:
+            return
+        await self.send_event_frame(event, lambda: {
             'type': 'writing-indicator',
             'message': event['message'],
             'sender': event['sender'],
-        }))
+            'is_typing': event.get('is_typing', True),
+        })
 
     async def read_receipt(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event_frame(event, lambda: {
             'type': 'read-receipt',
             'message_id': event.get('message_id'),
             'sender': event['sender'],
             'serialized_message': event.get('serialized_message'),
-        }))
+        })
+
+    async def read_watermark(self, event):
+        if self.channel_name == event.get('sender_channel_name'):
+            return
+        await self.send_event_frame(event, lambda: {
+            'type': 'read-watermark',
+            'message_id': event['message_id'],
+            'sender': event['sender'],
+        })
 
     async def delivery_receipt(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event_frame(event, lambda: {
             'type': 'delivery-receipt',
             'message_id': event.get('message_id'),
             'sender': event['sender'],
             'serialized_message': event.get('serialized_message'),
-        }))
\ No newline at end of file
+        })
+
+    async def delivery_receipts(self, event):
+        if self.channel_name == event.get('sender_channel_name'):
+            return
+        await self.send_event_frame(event, lambda: {
+            'type': 'delivery-receipts',
+            'message_ids': event['message_ids'],
+            'sender': event['sender'],
+        })
+
+
+class RoomSession(ChatConsumer):
+    """
+    One room on a multiplexed socket. Runs the ChatConsumer room logic with
+    the socket's channel, and tags every frame it sends with the room id.
+    """
+
+    def __init__(self, socket, room_id, is_group, chat_with):
+        super().__init__()
+        self.socket = socket
+        self.scope = dict(socket.scope, url_route={'kwargs': {'chatwithusername': chat_with}})
+        self.channel_layer = socket.channel_layer
+        self.channel_name = socket.channel_name
+        self.codec = socket.codec
+        self.outbound = socket.outbound
+        self.room_id = self.room_name = room_id
+        self.is_group = is_group
+        self.room_group_name = f'chat_{room_id}'
+
+    async def get_private_key(self):
+        # Loaded once per socket, not once per room
+        return await self.socket.get_private_key()
+
+    async def send_frame(self, frame, message_id=None):
+        frame['room'] = self.room_id
+        await super().send_frame(frame, message_id)
+
+    async def send_event_frame(self, event, build):
+        def tagged():
+            frame = build()
+            frame['room'] = self.room_id
+            return frame
+        await super().send_event_frame(event, tagged)
+
+    async def start(self, since=None):
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.join_room(since)
+
+    async def stop(self):
+        await self.leave_room()
+
+
+class MultiplexConsumer(ChatConsumer):
+    """
+    One socket per user for all their rooms at chat/. The client sends
+    {"type": "subscribe", "room": id} and {"type": "unsubscribe", "room": id},
+    with "since" in subscribe to only get what changed after a message it
+    already has, and tags every other frame with "room". Frames for a room carry "room"
+    the same way. At most MULTIPLEX_MAX_ROOMS rooms are subscribed at once.
+    """
+
+    @database_sync_to_async
+    def load_memberships(self):
+        """room id -> (is_group, other member usernames) for every room of the user, one query"""
+        memberships = {}
+        rows = ChatRoomMembership.objects.filter(chat_room__memberships__user_id=self.scope['user'].id).values_list(
+            'chat_room_id', 'chat_room__is_group', 'user__username'
+        ).order_by('chat_room_id', 'user_id')
+        for room_id, is_group, username in rows:
+            room = memberships.setdefault(room_id, (is_group, []))
+            if username != self.scope['user'].username:
+                room[1].append(username)
+        self.memberships = memberships
+
+    async def connect(self):
+        self.codec = frames.negotiate(self.scope.get('subprotocols'))
+        self.sessions = {}
+        if self.scope['user'].is_anonymous:
+            await self.close(code=401)
+            return
+        if self.channel_layer is None:
+            print("Error: channel_layer is not configured.")
+            await self.close(code=500)
+            return
+        await self.load_memberships()
+        self.open_outbound()
+        await self.accept(subprotocol=self.codec.subprotocol)
+
+    async def disconnect(self, close_code):
+        for session in list(getattr(self, 'sessions', {}).values()):
+            await session.stop()
+        self.sessions = {}
+        if getattr(self, 'outbound', None):
+            self.outbound.stop()
+
+    async def dispatch(self, message):
+        # Room events go to the room's session, the rest (websocket.*) to us
+        if 'room_id' in message:
+            session = self.sessions.get(message['room_id'])
+            if session is not None:
+                await session.dispatch(message)
+            return
+        await super().dispatch(message)
+
+    async def handle_frame(self, data):
+        message_type = data.get('type')
+        room_id = data.get('room')
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            print(f"Frame without a valid room: {message_type}")
+            return
+        if message_type == 'subscribe':
+            await self.subscribe(room_id, parse_message_id(data.get('since')))
+        elif message_type == 'unsubscribe':
+            session = self.sessions.pop(room_id, None)
+            if session is not None:
+                await session.stop()
+        elif room_id in self.sessions:
+            await self.sessions[room_id].handle_frame(data)
+        else:
+            print(f"Frame for a room that is not subscribed: {room_id}")
+
+    async def subscribe(self, room_id, since=None):
+        if room_id in self.sessions:
+            return
+        if room_id not in self.memberships:
+            # Rooms created since the socket connected
+            await self.load_memberships()
+        error = None
+        if room_id not in self.memberships or not self.memberships[room_id][1]:
+            error = "Not a member of this room"
+        elif len(self.sessions) >= getattr(settings, 'MULTIPLEX_MAX_ROOMS', 100):
+            error = "Too many rooms subscribed"
+        if error:
+            await self.send_frame({'type': 'subscribe-error', 'room': room_id, 'message': error})
+            return
+        is_group, members = self.memberships[room_id]
+        session = self.sessions[room_id] = RoomSession(self, room_id, is_group, members[0])
+        await session.start(since)
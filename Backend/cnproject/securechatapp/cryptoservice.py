@@ -0,0 +1,159 @@
+import asyncio
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from securechatapp.metrics import metrics
+from securechatapp.sessionkeys import session_keys
+
+
+def _init_worker():
+    # Worker processes start without the app registry
+    import django
+    django.setup()
+
+
+def _encrypt(message, public_key, user_id, session):
+    from securechatapp.encryption import EncryptionManager
+
+    if session is not None:
+        return EncryptionManager.encrypt_with_session_key(message, *session)
+    return EncryptionManager.encrypt_message(message, public_key, user_id)
+
+
+def _encrypt_for_recipients(message, recipients):
+    from securechatapp.encryption import EncryptionManager
+
+    return EncryptionManager.encrypt_for_recipients(message, recipients)
+
+
+def _decrypt(encrypted_data, private_key, user_id, wrapped_keys):
+    return _decrypt_batch([encrypted_data], private_key, user_id, wrapped_keys)[0]
+
+
+def _decrypt_batch(encrypted_items, private_key, user_id, wrapped_keys):
+    from securechatapp.encryption import EncryptionManager
+
+    return EncryptionManager.decrypt_many(encrypted_items, lambda item: (private_key, user_id), wrapped_keys)
+
+
+class CryptoService:
+    """
+    Runs EncryptionManager work on a worker pool so RSA and AES never block
+    the event loop. CRYPTO_WORKER_BACKEND picks 'thread' (pycryptodome drops
+    the GIL inside its C code) or 'process'.
+
+    Live work (single encrypt/decrypt) and bulk work (history batches) have
+    separate in-flight caps. Bulk work is held to CRYPTO_MAX_BULK_IN_FLIGHT
+    tasks, below the worker count, so a burst of history loads always leaves
+    workers free for live message delivery.
+
+    Session keys are loaded before work is handed to the pool and passed
+    along with it, so workers never query the database.
+    """
+
+    def __init__(self):
+        self.backend = getattr(settings, 'CRYPTO_WORKER_BACKEND', 'thread')
+        self.max_workers = getattr(settings, 'CRYPTO_MAX_WORKERS', None) or min(8, os.cpu_count() or 1)
+        self.max_in_flight = getattr(settings, 'CRYPTO_MAX_IN_FLIGHT', self.max_workers * 4)
+        self.max_bulk_in_flight = getattr(settings, 'CRYPTO_MAX_BULK_IN_FLIGHT', max(1, self.max_workers // 2))
+        self.batch_size = getattr(settings, 'CRYPTO_BATCH_SIZE', 200)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # asyncio semaphores are bound to one loop, keep a pair per loop
+        self._semaphores = weakref.WeakKeyDictionary()
+        self.queued = {'live': 0, 'bulk': 0}
+        self.in_flight = {'live': 0, 'bulk': 0}
+        # Counters are shared by every loop using the service
+        self._stats_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    if self.backend == 'process':
+                        self._executor = ProcessPoolExecutor(self.max_workers, initializer=_init_worker)
+                    else:
+                        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='crypto')
+        return self._executor
+
+    def _semaphore(self, kind):
+        loop = asyncio.get_running_loop()
+        semaphores = self._semaphores.get(loop)
+        if semaphores is None:
+            semaphores = {
+                'live': asyncio.Semaphore(self.max_in_flight),
+                'bulk': asyncio.Semaphore(self.max_bulk_in_flight),
+            }
+            self._semaphores[loop] = semaphores
+        return semaphores[kind]
+
+    async def _run(self, kind, func, *args):
+        semaphore = self._semaphore(kind)
+        self._count(self.queued, kind, 1)
+        try:
+            await semaphore.acquire()
+        finally:
+            self._count(self.queued, kind, -1)
+        self._count(self.in_flight, kind, 1)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self._count(self.in_flight, kind, -1)
+            semaphore.release()
+            metrics.incr(f'crypto.{kind}.completed')
+
+    def _count(self, counter, kind, delta):
+        with self._stats_lock:
+            counter[kind] += delta
+
+    async def _wrapped_keys(self, encrypted_items):
+        """Wrapped session keys the envelopes refer to, loaded here so workers never query"""
+        from securechatapp.encryption import EncryptionManager
+
+        kids = [kid for kid in map(EncryptionManager.session_key_id, encrypted_items) if kid is not None]
+        if session_keys.missing(kids):
+            await sync_to_async(session_keys.prefetch)(kids)
+        return session_keys.wrapped(kids)
+
+    async def encrypt(self, message, public_key=None, user_id=None, session=None):
+        """Encrypt for one recipient, or with a (kid, aes_key) session key"""
+        return await self._run('live', _encrypt, message, public_key, user_id, session)
+
+    async def encrypt_for_recipients(self, message, recipients):
+        """Encrypt once for a group, recipients is a list of (user_id, public_key)"""
+        return await self._run('live', _encrypt_for_recipients, message, list(recipients))
+
+    async def decrypt(self, encrypted_data, private_key, user_id=None):
+        wrapped_keys = await self._wrapped_keys([encrypted_data])
+        return await self._run('live', _decrypt, encrypted_data, private_key, user_id, wrapped_keys)
+
+    async def decrypt_batch(self, encrypted_items, private_key, user_id=None):
+        """Decrypt many envelopes for one key, in order, as bulk work"""
+        encrypted_items = list(encrypted_items)
+        wrapped_keys = await self._wrapped_keys(encrypted_items)
+        chunks = [encrypted_items[i:i + self.batch_size] for i in range(0, len(encrypted_items), self.batch_size)]
+        results = await asyncio.gather(*[
+            self._run('bulk', _decrypt_batch, chunk, private_key, user_id, wrapped_keys) for chunk in chunks
+        ])
+        return [item for chunk in results for item in chunk]
+
+    def stats(self):
+        with self._stats_lock:
+            queued, in_flight = dict(self.queued), dict(self.in_flight)
+        return {
+            'backend': self.backend,
+            'max_workers': self.max_workers,
+            'queued': queued,
+            'in_flight': in_flight,
+        }
+
+
+crypto_service = CryptoService()
+metrics.register_gauge('crypto.live.queued', lambda: crypto_service.queued['live'])
+metrics.register_gauge('crypto.bulk.queued', lambda: crypto_service.queued['bulk'])
+metrics.register_gauge('crypto.live.in_flight', lambda: crypto_service.in_flight['live'])
+metrics.register_gauge('crypto.bulk.in_flight', lambda: crypto_service.in_flight['bulk'])
@@ -0,0 +1,216 @@
+from Cryptodome.Cipher import PKCS1_OAEP, AES
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Random import get_random_bytes
+from Cryptodome.Util.Padding import pad, unpad
+from securechatapp.models import CustomUser, EncryptionKey
+from securechatapp.keycache import key_cache
+from securechatapp.sessionkeys import session_keys
+from securechatapp.keypool import obtain_key_pair
+from securechatapp import envelope
+
+class EncryptionManager:
+    """
+    Handles encryption and decryption of messages.
+    Uses RSA for key exchange and AES for message encryption.
+    """
+    @staticmethod
+    def generate_key_pair():
+        """Generate a new RSA key pair"""
+        private_key = RSA.generate(2048)
+        public_key = private_key.publickey()
+        
+        # Convert to string format
+        private_key_str = private_key.export_key().decode('utf-8')
+        public_key_str = public_key.export_key().decode('utf-8')
+        
+        return private_key_str, public_key_str
+
+    def get_or_create_user_key(user):
+        try:
+            # print("User key found in database.", user)
+            CustomUser.objects.get(username=user.username)
+            key_obj = EncryptionKey.objects.filter(user=user).values('private_key', 'public_key').first()
+            # print("ljhjadh", key_obj)
+            if key_obj is None:
+                raise EncryptionKey.DoesNotExist("No key found for user.")
+            private_key =key_obj['private_key']
+            public_key = key_obj['public_key']
+        except EncryptionKey.DoesNotExist:
+            private_key_str, public_key_str = obtain_key_pair()
+            EncryptionKey.objects.create(
+                user=user,
+                private_key=private_key_str,
+                public_key=public_key_str
+            )
+            private_key = private_key_str
+            public_key = public_key_str
+        
+        return private_key, public_key
+    
+    
+    @staticmethod
+    def encrypt_message(message, recipient_public_key_str, user_id=None):
+        """
+        Encrypt a message using hybrid encryption (RSA + AES)
+        - Generate a random AES key
+        - Encrypt the message with AES
+        - Encrypt the AES key with recipient's public RSA key
+        - Return both encrypted key and encrypted message
+        """
+        # Convert message to bytes if it's a string
+        # print(f"Recipient's public key: {recipient_public_key_str}")
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        else:
+            raise ValueError("Message must be a string")
+            
+        # Parsed key and OAEP cipher come from the process-wide key cache
+        recipient_key = key_cache.get(recipient_public_key_str, user_id)
+        # Generate a random AES session key
+        aes_key = get_random_bytes(16)  # 128 bits
+        
+        # Encrypt the message with AES
+        cipher_aes = AES.new(aes_key, AES.MODE_CBC)
+        padded_message = pad(message, AES.block_size)
+        encrypted_message = cipher_aes.encrypt(padded_message)
+        
+        # Encrypt the AES key with recipient's public key
+        encrypted_aes_key = recipient_key.cipher.encrypt(aes_key)
+        
+        # Pack everything into a binary envelope for Message.payload
+        return envelope.encode_wrapped(encrypted_aes_key, cipher_aes.iv, encrypted_message)
+    
+    @staticmethod
+    def encrypt_with_session_key(message, kid, aes_key):
+        """
+        Encrypt a message with an already wrapped conversation session key.
+        The envelope carries the session key id instead of a wrapped AES key.
+        """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        else:
+            raise ValueError("Message must be a string")
+
+        cipher_aes = AES.new(aes_key, AES.MODE_CBC)
+        encrypted_message = cipher_aes.encrypt(pad(message, AES.block_size))
+        return envelope.encode_session(kid, cipher_aes.iv, encrypted_message)
+
+    @staticmethod
+    def encrypt_for_recipients(message, recipients):
+        """
+        Encrypt a group message once with AES and wrap only the AES key for
+        each member. recipients is an iterable of (user_id, public_key_pem).
+        Each member later unwraps just their own slot.
+        """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        else:
+            raise ValueError("Message must be a string")
+
+        aes_key = get_random_bytes(16)
+        cipher_aes = AES.new(aes_key, AES.MODE_CBC)
+        encrypted_message = cipher_aes.encrypt(pad(message, AES.block_size))
+        wrapped_keys = {
+            user_id: key_cache.get(public_key, user_id).cipher.encrypt(aes_key)
+            for user_id, public_key in recipients
+        }
+        return envelope.encode_multi(wrapped_keys, cipher_aes.iv, encrypted_message)
+
+    @staticmethod
+    def parse_envelope(encrypted_data):
+        """Decode binary payloads, legacy JSON content and message dicts alike"""
+        return envelope.decode(encrypted_data)
+
+    @staticmethod
+    def session_key_id(encrypted_data):
+        """Session key id referenced by an envelope, None for per-message envelopes"""
+        try:
+            return EncryptionManager.parse_envelope(encrypted_data).kid
+        except Exception:
+            return None
+
+    @staticmethod
+    def decrypt_message(encrypted_data_str, private_key_str, user_id=None):
+        try:
+            encrypted_data = EncryptionManager.parse_envelope(encrypted_data_str)
+
+            iv = encrypted_data.iv
+            encrypted_message = encrypted_data.ciphertext
+            if encrypted_data.kid is not None:
+                aes_key = session_keys.unwrap(encrypted_data.kid, private_key_str, user_id)
+            else:
+                # Per-message envelope, the AES key is wrapped inline
+                private_key = key_cache.get(private_key_str, user_id)
+                aes_key = private_key.cipher.decrypt(encrypted_data.wrapped_key_for(user_id))
+
+            cipher_aes = AES.new(aes_key, AES.MODE_CBC, iv)
+            padded_message = cipher_aes.decrypt(encrypted_message)
+            message = unpad(padded_message, AES.block_size)
+
+            return {"content": message.decode('utf-8')}
+        except Exception as e:
+            print(f"Error decrypting message: {e}")
+            # return {"content": "[Decryption failed]"}
+
+    @staticmethod
+    def decrypt_many(messages, key_resolver, wrapped_keys=None):
+        """
+        Decrypt a batch of envelopes, e.g. a room's history.
+        key_resolver(message) returns the (private_key, user_id) to use for a
+        message. Envelopes are parsed up front, each distinct wrapped key or
+        session key is unwrapped once, then the bodies are decrypted in one
+        loop. Returns results in input order, None for each failed message.
+        Session keys that are not loaded yet are fetched in one query, unless
+        the caller passes the wrapped keys it loaded itself (kid -> bytes).
+        """
+        parsed = []
+        for message in messages:
+            try:
+                encrypted_data = EncryptionManager.parse_envelope(message)
+                private_key_str, user_id = key_resolver(message)
+                private_key = key_cache.get(private_key_str, user_id)
+                parsed.append((encrypted_data, private_key_str, user_id, private_key, encrypted_data.wrap_ref(user_id)))
+            except Exception as e:
+                print(f"Error parsing encrypted message: {e}")
+                parsed.append(None)
+
+        if wrapped_keys is not None:
+            for kid, wrapped_key in wrapped_keys.items():
+                session_keys.remember(kid, wrapped_key)
+        else:
+            missing = session_keys.missing([p[4][1] for p in parsed if p is not None and p[4][0] == 'kid'])
+            if missing:
+                session_keys.prefetch(missing)
+
+        aes_keys = {}
+        for item in parsed:
+            if item is None:
+                continue
+            _, private_key_str, user_id, private_key, wrap_ref = item
+            unwrap_key = (wrap_ref, private_key.fingerprint)
+            if unwrap_key in aes_keys:
+                continue
+            try:
+                if wrap_ref[0] == 'kid':
+                    aes_keys[unwrap_key] = session_keys.unwrap(wrap_ref[1], private_key_str, user_id)
+                else:
+                    aes_keys[unwrap_key] = private_key.cipher.decrypt(wrap_ref[1])
+            except Exception as e:
+                print(f"Error unwrapping message key: {e}")
+                aes_keys[unwrap_key] = None
+
+        results = []
+        for item in parsed:
+            aes_key = aes_keys.get((item[4], item[3].fingerprint)) if item is not None else None
+            if aes_key is None:
+                results.append(None)
+                continue
+            try:
+                encrypted_data = item[0]
+                cipher_aes = AES.new(aes_key, AES.MODE_CBC, encrypted_data.iv)
+                padded_message = cipher_aes.decrypt(encrypted_data.ciphertext)
+                results.append({"content": unpad(padded_message, AES.block_size).decode('utf-8')})
+            except Exception as e:
+                print(f"Error decrypting message: {e}")
+                results.append(None)
+        return results
@@ -0,0 +1,137 @@
+"""
+Binary ciphertext envelopes stored in Message.payload.
+
+    v1  0x01 | wrapped key length (u16) | RSA-OAEP wrapped AES key | IV (16) | ciphertext
+    v2  0x02 | session key id (u64) | IV (16) | ciphertext
+    v3  0x03 | slot count (u16) | slots | IV (16) | ciphertext
+        slot: user id (u32) | wrapped key length (u16) | AES key wrapped for that user
+
+Rows written before this format hold a JSON object of base64 strings in
+Message.content, decode() reads both.
+"""
+import base64
+import json
+import struct
+
+VERSION_WRAPPED = 1
+VERSION_SESSION = 2
+VERSION_MULTI = 3
+IV_SIZE = 16
+
+_U16 = struct.Struct('>H')
+_U64 = struct.Struct('>Q')
+_SLOT = struct.Struct('>IH')
+
+
+class Envelope:
+    """
+    Decoded envelope: a session key id, a wrapped AES key or a table of
+    per-recipient slots, plus IV and ciphertext. Slots are kept as raw bytes
+    and only scanned for the reader that asks, see wrapped_key_for().
+    """
+    __slots__ = ('kid', 'wrapped_key', 'iv', 'ciphertext', 'slots')
+
+    def __init__(self, iv, ciphertext, kid=None, wrapped_key=None, slots=None):
+        self.kid = kid
+        self.wrapped_key = wrapped_key
+        self.iv = iv
+        self.ciphertext = ciphertext
+        self.slots = slots
+
+    def wrapped_key_for(self, user_id):
+        if self.slots is None:
+            return self.wrapped_key
+        count, offset = _U16.unpack_from(self.slots, 0)[0], _U16.size
+        for _ in range(count):
+            slot_user_id, key_length = _SLOT.unpack_from(self.slots, offset)
+            offset += _SLOT.size
+            if slot_user_id == user_id:
+                return self.slots[offset:offset + key_length]
+            offset += key_length
+        raise KeyError(f"No key slot for user {user_id}")
+
+    def wrap_ref(self, user_id=None):
+        """Identifies the key that has to be unwrapped to read this envelope"""
+        if self.kid is not None:
+            return ('kid', self.kid)
+        return ('key', self.wrapped_key_for(user_id))
+
+
+def encode_wrapped(wrapped_key, iv, ciphertext):
+    return b''.join((bytes((VERSION_WRAPPED,)), _U16.pack(len(wrapped_key)), wrapped_key, iv, ciphertext))
+
+
+def encode_session(kid, iv, ciphertext):
+    return b''.join((bytes((VERSION_SESSION,)), _U64.pack(kid), iv, ciphertext))
+
+
+def encode_multi(wrapped_keys, iv, ciphertext):
+    """wrapped_keys maps user id to the AES key wrapped with that user's public key"""
+    parts = [bytes((VERSION_MULTI,)), _U16.pack(len(wrapped_keys))]
+    for user_id, wrapped_key in wrapped_keys.items():
+        parts.append(_SLOT.pack(user_id, len(wrapped_key)))
+        parts.append(wrapped_key)
+    parts.append(iv)
+    parts.append(ciphertext)
+    return b''.join(parts)
+
+
+def _decode_binary(data):
+    version = data[0]
+    if version == VERSION_SESSION:
+        kid, = _U64.unpack_from(data, 1)
+        offset = 1 + _U64.size
+        return Envelope(data[offset:offset + IV_SIZE], data[offset + IV_SIZE:], kid=kid)
+    if version == VERSION_WRAPPED:
+        key_length, = _U16.unpack_from(data, 1)
+        offset = 1 + _U16.size + key_length
+        return Envelope(data[offset:offset + IV_SIZE], data[offset + IV_SIZE:],
+                        wrapped_key=data[1 + _U16.size:offset])
+    if version == VERSION_MULTI:
+        count, = _U16.unpack_from(data, 1)
+        offset = 1 + _U16.size
+        for _ in range(count):
+            offset += _SLOT.size + _SLOT.unpack_from(data, offset)[1]
+        return Envelope(data[offset:offset + IV_SIZE], data[offset + IV_SIZE:], slots=data[1:offset])
+    raise ValueError(f"Unknown envelope version {version}")
+
+
+def _decode_json(text):
+    data = json.loads(text)
+    iv = base64.b64decode(data['iv'])
+    ciphertext = base64.b64decode(data['message'])
+    if 'kid' in data:
+        return Envelope(iv, ciphertext, kid=data['kid'])
+    return Envelope(iv, ciphertext, wrapped_key=base64.b64decode(data['key']))
+
+
+def stored(message):
+    """The envelope of a message row or dict: payload bytes, else legacy content"""
+    payload = message.get('payload') if isinstance(message, dict) else message.payload
+    if payload is not None:
+        return bytes(payload)
+    return message.get('content') if isinstance(message, dict) else message.content
+
+
+def decode(stored):
+    """
+    Decode an envelope from binary payload bytes, a legacy JSON string, or a
+    message dict / event carrying 'payload' or 'content'.
+    """
+    if isinstance(stored, dict):
+        payload = stored.get('payload')
+        stored = payload if payload is not None else stored.get('content')
+    if isinstance(stored, (bytes, bytearray, memoryview)):
+        return _decode_binary(bytes(stored))
+    if isinstance(stored, str):
+        return _decode_json(stored)
+    raise ValueError("Invalid encrypted message format")
+
+
+def to_binary(envelope):
+    """Re-encode a decoded envelope in the binary format"""
+    if envelope.slots is not None:
+        return b''.join((bytes((VERSION_MULTI,)), envelope.slots, envelope.iv, envelope.ciphertext))
+    if envelope.kid is not None:
+        return encode_session(envelope.kid, envelope.iv, envelope.ciphertext)
+    return encode_wrapped(envelope.wrapped_key, envelope.iv, envelope.ciphertext)
@@ -0,0 +1,21 @@
+from rest_framework import serializers
+
+# Same output format as the timestamp field of MessageSerializer
+_timestamp_field = serializers.DateTimeField()
+
+
+def message_event(message, sender_username=None):
+    """
+    The chat message dict sent over the websocket, the same as reducing
+    MessageSerializer output to usernames and ids but built from fields the
+    consumer already holds, so it never touches the database.
+    """
+    return {
+        'id': message.id,
+        'sender': sender_username if sender_username is not None else message.sender.username,
+        'content': message.content,
+        'timestamp': _timestamp_field.to_representation(message.timestamp),
+        'is_read': message.is_read,
+        'is_delivered': message.is_delivered,
+        'chat_room': message.chat_room_id,
+    }
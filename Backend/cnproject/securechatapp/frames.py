@@ -0,0 +1,255 @@
+"""
+Websocket frame encoding. Broadcast events carry their frame already encoded
+in event['frame'], so a room of N members costs one encode instead of N.
+The JSON backend is picked by WEBSOCKET_JSON_BACKEND: 'orjson', 'ujson',
+'json' or 'auto' (the fastest one installed).
+
+Clients can ask for a binary protocol in Sec-WebSocket-Protocol:
+
+    securechat.msgpack    MessagePack, needs the msgpack package
+    securechat.cbor       CBOR, needs the cbor2 package
+
+Binary frames are the same objects with the keys in KEY_CODES and the
+values of 'type' in TYPE_CODES replaced by their numbers, and bytes sent
+as raw binary instead of base64. Anything without a code is left as is.
+Clients that don't ask for a subprotocol keep getting JSON text frames.
+
+Broadcasts are pre-encoded only in JSON and in the binary protocols listed
+in WEBSOCKET_BROADCAST_SUBPROTOCOLS (none by default), each one adds its
+encoding to every channel layer message. Sockets on other protocols encode
+the frame themselves when the event arrives.
+"""
+import json
+from django.conf import settings
+
+
+def _orjson():
+    import orjson
+
+    return lambda obj: orjson.dumps(obj).decode()
+
+
+def _ujson():
+    import ujson
+
+    return lambda obj: ujson.dumps(obj, ensure_ascii=False)
+
+
+def _json():
+    return json.dumps
+
+
+BACKENDS = {'orjson': _orjson, 'ujson': _ujson, 'json': _json}
+
+
+def load_backend(name):
+    """dumps function for a backend name, 'auto' falls back until an import works"""
+    if name != 'auto':
+        return BACKENDS[name]()
+    for candidate in ('orjson', 'ujson', 'json'):
+        try:
+            return BACKENDS[candidate]()
+        except ImportError:
+            continue
+
+
+backend_name = getattr(settings, 'WEBSOCKET_JSON_BACKEND', 'auto')
+dumps = load_backend(backend_name)
+
+TYPE_CODES = {
+    # Client to server
+    'chat_message': 1,
+    'mark_delivered': 2,
+    'delivery-receipt': 3,
+    'read_receipt': 4,
+    'read_up_to': 5,
+    'writing_indicator': 6,
+    'load_more': 7,
+    'subscribe': 8,
+    'unsubscribe': 9,
+    'sync': 10,
+    # Server to client
+    'chat_history': 20,
+    'chat_history_page': 21,
+    'online-acknowledge': 22,
+    'reply-online-acknowledge': 23,
+    'offline-acknowledge': 24,
+    'writing-indicator': 25,
+    'read-receipt': 26,
+    'read-watermark': 27,
+    'delivery-receipts': 28,
+    'subscribe-error': 29,
+    'batch': 30,
+    'slow-consumer': 31,
+    'chat_sync': 32,
+}
+KEY_CODES = {
+    'type': 0,
+    'message': 1,
+    'sender': 2,
+    'message_id': 3,
+    'message_ids': 4,
+    'id': 5,
+    'content': 6,
+    'timestamp': 7,
+    'is_read': 8,
+    'is_delivered': 9,
+    'chat_room': 10,
+    'chat_room_id': 11,
+    'messages': 12,
+    'cursor': 13,
+    'has_more': 14,
+    'is_typing': 15,
+    'serialized_message': 16,
+    'pages': 17,
+    'room': 18,
+    'frames': 19,
+    'resume': 20,
+    'since': 21,
+    'read_watermarks': 23,
+    'undelivered': 24,
+}
+_TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+_KEY_NAMES = {code: name for name, code in KEY_CODES.items()}
+
+
+def _compact(value):
+    if isinstance(value, dict):
+        compacted = {KEY_CODES.get(key, key): _compact(item) for key, item in value.items()}
+        if 'type' in value:
+            compacted[0] = TYPE_CODES.get(value['type'], value['type'])
+        return compacted
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        expanded = {_KEY_NAMES.get(key, key): _expand(item) for key, item in value.items()}
+        if 'type' in expanded:
+            expanded['type'] = _TYPE_NAMES.get(expanded['type'], expanded['type'])
+        return expanded
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+class JsonCodec:
+    subprotocol = None
+    binary = False
+
+    def encode(self, frame):
+        return dumps(frame)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def batch(self, encoded):
+        """One batch frame from already encoded frames, without decoding them"""
+        return '{"type": "batch", "frames": [' + ', '.join(encoded) + ']}'
+
+
+class BinaryCodec:
+    binary = True
+
+    def __init__(self, subprotocol, pack, unpack):
+        self.subprotocol = subprotocol
+        self.pack = pack
+        self.unpack = unpack
+
+    def encode(self, frame):
+        return self.pack(_compact(frame))
+
+    def decode(self, data):
+        return _expand(self.unpack(data))
+
+    def batch(self, encoded):
+        """One batch frame from already encoded frames, without decoding them"""
+        # Both formats encode an empty array and a null in one byte, so the
+        # headers can be cut from packed placeholders
+        prefix = self.pack(_compact({'type': 'batch', 'frames': []}))[:-1]
+        header = self.pack([None] * len(encoded))[:-len(encoded)]
+        return prefix + header + b''.join(encoded)
+
+
+def _msgpack():
+    import msgpack
+
+    return BinaryCodec('securechat.msgpack', msgpack.packb,
+                       lambda data: msgpack.unpackb(data, strict_map_key=False))
+
+
+def _cbor():
+    import cbor2
+
+    return BinaryCodec('securechat.cbor', cbor2.dumps, cbor2.loads)
+
+
+def load_binary_codecs(subprotocols):
+    """Codecs for the configured subprotocols whose package is installed"""
+    factories = {'securechat.msgpack': _msgpack, 'securechat.cbor': _cbor}
+    codecs = {}
+    for subprotocol in subprotocols:
+        try:
+            codecs[subprotocol] = factories[subprotocol]()
+        except ImportError:
+            continue
+    return codecs
+
+
+json_codec = JsonCodec()
+binary_codecs = load_binary_codecs(
+    getattr(settings, 'WEBSOCKET_SUBPROTOCOLS', ['securechat.msgpack', 'securechat.cbor'])
+)
+broadcast_codecs = {
+    name: codec for name, codec in binary_codecs.items()
+    if name in getattr(settings, 'WEBSOCKET_BROADCAST_SUBPROTOCOLS', [])
+}
+
+
+def negotiate(requested):
+    """Codec for the first subprotocol the client offered that we support, JSON otherwise"""
+    for subprotocol in requested or ():
+        if subprotocol in binary_codecs:
+            return binary_codecs[subprotocol]
+    return json_codec
+
+
+def encode(frame):
+    """Text of a websocket frame"""
+    return dumps(frame)
+
+
+def broadcast(event, frame):
+    """
+    Attach the frame encoded in JSON and the broadcast protocols to a
+    channel layer event, returns the event. Frames of room events are
+    tagged with the room.
+    """
+    if 'room_id' in event:
+        frame['room'] = event['room_id']
+    event['frame'] = encode(frame)
+    if broadcast_codecs:
+        event['binary_frames'] = {name: codec.encode(frame) for name, codec in broadcast_codecs.items()}
+    return event
+
+
+def frame_text(event, build):
+    """The pre-encoded frame of an event, or build() encoded for events sent without one"""
+    frame = event.get('frame')
+    return frame if frame is not None else encode(build())
+
+
+def event_frame(event, codec, build):
+    """The pre-encoded frame of an event in the codec's protocol, encoded here if it wasn't sent"""
+    if not codec.binary:
+        return frame_text(event, build)
+    frame = event.get('binary_frames', {}).get(codec.subprotocol)
+    if frame is not None:
+        return frame
+    frame = build()
+    if 'frame' in event and 'room_id' in event:
+        # Tagged like the JSON frame broadcast() encoded
+        frame['room'] = event['room_id']
+    return codec.encode(frame)
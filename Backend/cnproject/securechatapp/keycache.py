@@ -0,0 +1,70 @@
+import hashlib
+from django.conf import settings
+from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+from securechatapp.lru import LRUCache
+
+
+def key_fingerprint(key_pem):
+    """SHA-256 hex digest of a PEM encoded key"""
+    if isinstance(key_pem, str):
+        key_pem = key_pem.encode('utf-8')
+    return hashlib.sha256(key_pem).hexdigest()
+
+
+class ParsedKey:
+    """
+    A parsed RSA key together with its ready-built OAEP cipher.
+    PKCS1_OAEP ciphers keep no per-call state, so one instance can be
+    shared by every caller that uses the same key.
+    """
+    __slots__ = ('key', 'cipher', 'fingerprint')
+
+    def __init__(self, key, fingerprint):
+        self.key = key
+        self.cipher = PKCS1_OAEP.new(key)
+        self.fingerprint = fingerprint
+
+
+class KeyCache:
+    """
+    Bounded LRU cache of parsed RSA keys, keyed by (user id, key fingerprint).
+    Entries for a user are dropped when that user's EncryptionKey row changes.
+    """
+
+    def __init__(self, maxsize=None):
+        self._entries = LRUCache(maxsize or getattr(settings, 'ENCRYPTION_KEY_CACHE_SIZE', 1024))
+
+    def get(self, key_pem, user_id=None):
+        """Return the ParsedKey for a PEM string, parsing it only on a miss"""
+        if isinstance(key_pem, RSA.RsaKey):
+            key_pem = key_pem.export_key().decode('utf-8')
+        fingerprint = key_fingerprint(key_pem)
+        cache_key = (user_id, fingerprint)
+
+        entry = self._entries.get(cache_key)
+        if entry is None:
+            # Parsed outside any lock, a duplicate parse on a race is harmless
+            entry = ParsedKey(RSA.import_key(key_pem), fingerprint)
+            self._entries.set(cache_key, entry)
+        return entry
+
+    def invalidate_user(self, user_id):
+        self._entries.discard_where(lambda cache_key: cache_key[0] == user_id)
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    def __len__(self):
+        return len(self._entries)
+
+
+key_cache = KeyCache()
@@ -0,0 +1,101 @@
+from django.conf import settings
+from securechatapp.lru import LRUCache
+from securechatapp.metrics import metrics
+
+
+class KeyEntry:
+    __slots__ = ('user_id', 'username', 'public_key', 'private_key')
+
+    def __init__(self, user_id, username, public_key, private_key):
+        self.user_id = user_id
+        self.username = username
+        self.public_key = public_key
+        self.private_key = private_key
+
+
+class KeyDirectory:
+    """
+    Process-wide cache of users' EncryptionKey rows, looked up by user id or
+    username. Entries live for KEY_DIRECTORY_TTL seconds in an LRU of
+    KEY_DIRECTORY_SIZE users, and are dropped when the key row is saved or
+    deleted or the user is saved (a username may have changed).
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        maxsize = maxsize or getattr(settings, 'KEY_DIRECTORY_SIZE', 4096)
+        ttl = ttl or getattr(settings, 'KEY_DIRECTORY_TTL', 300)
+        self._by_id = LRUCache(maxsize, ttl)
+        self._ids = LRUCache(maxsize, ttl)
+
+    def _remember(self, rows):
+        entries = [KeyEntry(*row) for row in rows]
+        for entry in entries:
+            self._by_id.set(entry.user_id, entry)
+            self._ids.set(entry.username, entry.user_id)
+        return entries
+
+    def cached(self, username):
+        """Entry for a username if it is cached, never hits the database"""
+        user_id = self._ids.get(username)
+        entry = self._by_id.get(user_id) if user_id is not None else None
+        # A stale alias after a rename counts as a miss
+        return entry if entry is not None and entry.username == username else None
+
+    def cached_id(self, user_id):
+        return self._by_id.get(user_id)
+
+    def get(self, username):
+        """Entry for a username, None when the user has no key. Hits the database on a miss."""
+        from securechatapp.models import EncryptionKey
+
+        entry = self.cached(username)
+        if entry is None:
+            metrics.incr('keydirectory.misses')
+            rows = EncryptionKey.objects.filter(user__username=username).values_list(
+                'user_id', 'user__username', 'public_key', 'private_key'
+            )[:1]
+            entry = next(iter(self._remember(rows)), None)
+        return entry
+
+    def get_id(self, user_id):
+        """Entry for a user id, None when the user has no key. Hits the database on a miss."""
+        from securechatapp.models import EncryptionKey
+
+        entry = self.cached_id(user_id)
+        if entry is None:
+            metrics.incr('keydirectory.misses')
+            rows = EncryptionKey.objects.filter(user_id=user_id).values_list(
+                'user_id', 'user__username', 'public_key', 'private_key'
+            )[:1]
+            entry = next(iter(self._remember(rows)), None)
+        return entry
+
+    def warm_room(self, room_id):
+        """Load the keys of every member of a room in one query, returns their entries. Hits the database."""
+        from securechatapp.models import EncryptionKey
+
+        metrics.incr('keydirectory.room_loads')
+        return self._remember(
+            EncryptionKey.objects.filter(user__chatroommembership__chat_room_id=room_id).values_list(
+                'user_id', 'user__username', 'public_key', 'private_key'
+            )
+        )
+
+    def invalidate(self, user_id, username=None):
+        entry = self._by_id.pop(user_id)
+        if entry is not None:
+            self._ids.pop(entry.username)
+        if username is not None:
+            self._ids.pop(username)
+
+    def clear(self):
+        self._by_id.clear()
+        self._ids.clear()
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+key_directory = KeyDirectory()
+metrics.register_gauge('keydirectory.size', lambda: len(key_directory))
+metrics.register_gauge('keydirectory.hits', lambda: key_directory._by_id.hits)
@@ -0,0 +1,148 @@
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from securechatapp.metrics import metrics
+
+
+def pool_level():
+    from securechatapp.models import PooledKeyPair
+
+    return PooledKeyPair.objects.count()
+
+
+def claim_key_pair():
+    """
+    Atomically take one key pair out of the pool, or return None when the
+    pool is empty. Concurrent claimers never get the same pair: the row is
+    locked with SKIP LOCKED where supported and the delete count decides
+    who won on backends without row locks.
+    """
+    from securechatapp.models import PooledKeyPair
+
+    for _ in range(5):
+        with transaction.atomic():
+            row = (PooledKeyPair.objects.select_for_update(skip_locked=True)
+                   .order_by('id').values('id', 'private_key', 'public_key').first())
+            if row is None:
+                return None
+            deleted, _ = PooledKeyPair.objects.filter(id=row['id']).delete()
+        if deleted:
+            metrics.incr('keypool.claimed')
+            key_pool_service.notify_claimed()
+            return row['private_key'], row['public_key']
+    return None
+
+
+def obtain_key_pair():
+    """Key pair for a new user, from the pool if possible"""
+    # encryption imports this module
+    from securechatapp.encryption import EncryptionManager
+
+    pair = claim_key_pair()
+    if pair is None:
+        metrics.incr('keypool.inline_generated')
+        pair = EncryptionManager.generate_key_pair()
+    return pair
+
+
+def fill_pool(target, batch_size=10):
+    """Generate key pairs until the pool holds at least target. Returns how many were added."""
+    from securechatapp.encryption import EncryptionManager
+    from securechatapp.models import PooledKeyPair
+
+    added = 0
+    while True:
+        missing = target - pool_level()
+        if missing <= 0:
+            return added
+        pairs = [EncryptionManager.generate_key_pair() for _ in range(min(batch_size, missing))]
+        PooledKeyPair.objects.bulk_create([
+            PooledKeyPair(private_key=private_key, public_key=public_key)
+            for private_key, public_key in pairs
+        ])
+        key_pool_service.adjust_level(len(pairs))
+        added += len(pairs)
+
+
+class KeyPoolService:
+    """
+    Background thread that tops the pool back up to KEY_POOL_TARGET whenever
+    it drops below KEY_POOL_LOW_WATER, and at least every `interval` seconds.
+    Runs from the fill_key_pool --watch command, or inside the web process
+    when KEY_POOL_AUTO_REFILL is set.
+    """
+
+    def __init__(self):
+        self.target = getattr(settings, 'KEY_POOL_TARGET', 50)
+        self.low_water = getattr(settings, 'KEY_POOL_LOW_WATER', 10)
+        self.auto_refill = getattr(settings, 'KEY_POOL_AUTO_REFILL', False)
+        self.level_ttl = getattr(settings, 'KEY_POOL_LEVEL_TTL', 30)
+        self._level = None
+        self._level_at = 0.0
+        self._level_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._claims = 0
+
+    def start(self, interval=60):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='key-pool', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def notify_claimed(self):
+        # Estimate the level from claims since the last fill, no query here
+        if self.auto_refill and self._thread is None:
+            self.start()
+        self._claims += 1
+        self.adjust_level(-1)
+        if self.target - self._claims < self.low_water:
+            self._wakeup.set()
+
+    def level(self):
+        """
+        Pool level for the keypool.level gauge. Counted at most every
+        KEY_POOL_LEVEL_TTL seconds, claims and fills in this process keep it
+        current in between; other processes' show up on the next count.
+        """
+        with self._level_lock:
+            if self._level is None or time.monotonic() - self._level_at > self.level_ttl:
+                self._level = pool_level()
+                self._level_at = time.monotonic()
+            return self._level
+
+    def adjust_level(self, delta):
+        with self._level_lock:
+            if self._level is not None:
+                self._level = max(0, self._level + delta)
+
+    def _run(self, interval):
+        from django.db import connection
+
+        while not self._stop.is_set():
+            self._claims = 0
+            try:
+                added = fill_pool(self.target)
+                if added:
+                    print(f"Key pool refilled with {added} key pairs")
+            except Exception as e:
+                print(f"Error refilling key pool: {e}")
+            finally:
+                connection.close()
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+
+key_pool_service = KeyPoolService()
+metrics.register_gauge('keypool.level', key_pool_service.level)
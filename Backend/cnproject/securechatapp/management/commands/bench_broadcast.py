@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from securechatapp import benchmarks, frames
+
+DEFAULT_ROOM_SIZES = [2, 10, 100, 1000]
+
+
+def delivery_receipts_event():
+    return {
+        'type': 'delivery_receipts',
+        'message_ids': list(range(1000, 1020)),
+        'sender': 'alice',
+        'sender_channel_name': 'specific.bench!alice',
+    }
+
+
+def receiver_frame(event):
+    return {
+        'type': 'delivery-receipts',
+        'message_ids': event['message_ids'],
+        'sender': event['sender'],
+    }
+
+
+class Command(BaseCommand):
+    help = "Serialization CPU per room broadcast, encoding per receiver against encoding once, by room size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='broadcast_bench.json')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--room-sizes', type=int, nargs='+', default=DEFAULT_ROOM_SIZES)
+        benchmarks.add_compare_arguments(parser)
+
+    def handle(self, *args, **options):
+        results = []
+        backends = {}
+        for name in frames.BACKENDS:
+            try:
+                backends[name] = frames.load_backend(name)
+            except ImportError:
+                self.stdout.write(f"Skipping {name}, not installed")
+        self.stdout.write(f"Configured backend: {frames.backend_name}")
+
+        for name, dumps in backends.items():
+            for size in options['room_sizes']:
+                def per_receiver():
+                    event = delivery_receipts_event()
+                    for _ in range(size):
+                        dumps(receiver_frame(event))
+
+                def encode_once():
+                    event = delivery_receipts_event()
+                    event['frame'] = dumps(receiver_frame(event))
+                    for _ in range(size):
+                        frames.frame_text(event, lambda: receiver_frame(event))
+
+                for op, func in (('per_receiver', per_receiver), ('encode_once', encode_once)):
+                    stats = benchmarks.measure(func, options['iterations'])
+                    stats.update(op=f'{op}_{name}', size=size, us_per_broadcast=stats['mean_ms'] * 1000)
+                    results.append(stats)
+                    self.stdout.write(
+                        f"{op + '_' + name + '[' + str(size) + ']':32} {stats['us_per_broadcast']:>10.1f} us/broadcast  "
+                        f"{stats['ops_per_sec']:>10.1f} broadcasts/s"
+                    )
+
+        benchmarks.finish(self, options, 'broadcast', results)
@@ -0,0 +1,89 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from securechatapp import benchmarks
+from securechatapp.unixlayer import ChannelBroker, UnixSocketChannelLayer
+
+MESSAGE = {
+    'type': 'chat_message',
+    'message': {'id': 1, 'sender': 'alice', 'timestamp': '2025-01-01T00:00:00Z', 'chat_room': 1},
+    'sender_channel_name': 'specific.bench!sender',
+    'sender_username': 'alice',
+    'message_id': 1,
+    'payload': b'\x02' + b'x' * 200,
+}
+
+
+def run_broker(path, capacity):
+    asyncio.run(ChannelBroker(path, capacity=capacity).serve_forever())
+
+
+class Command(BaseCommand):
+    help = "Throughput of the Unix socket channel layer against InMemoryChannelLayer, written as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='channel_layer_bench.json')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--batch', type=int, default=500,
+                            help="Messages sent before receiving them in the send/receive test")
+        parser.add_argument('--group-sizes', type=int, nargs='+', default=[2, 10, 100])
+        benchmarks.add_compare_arguments(parser)
+
+    def handle(self, *args, **options):
+        batch = options['batch']
+        capacity = max(batch, max(options['group_sizes'])) + 1
+        path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+        broker = multiprocessing.Process(target=run_broker, args=(path, capacity), daemon=True)
+        broker.start()
+        while not os.path.exists(path):
+            time.sleep(0.05)
+
+        loop = asyncio.new_event_loop()
+        results = []
+        try:
+            for name, layer in (
+                ('inmemory', InMemoryChannelLayer(capacity=capacity)),
+                ('unix', UnixSocketChannelLayer(path)),
+            ):
+                for op, size, coro in self.scenarios(loop, layer, batch, options['group_sizes']):
+                    stats = benchmarks.measure(lambda: loop.run_until_complete(coro()), options['iterations'],
+                                               units_per_call=size)
+                    stats.update(op=f'{name}_{op}', size=size)
+                    results.append(stats)
+                    self.stdout.write(
+                        f"{name + '_' + op + '[' + str(size) + ']':40} {stats['ops_per_sec']:>12.1f} msgs/s  "
+                        f"p50 {stats['p50_ms']:8.3f} ms  p99 {stats['p99_ms']:8.3f} ms"
+                    )
+                loop.run_until_complete(layer.close())
+        finally:
+            loop.close()
+            broker.terminate()
+
+        benchmarks.finish(self, options, 'channel_layer', results)
+
+    def scenarios(self, loop, layer, batch, group_sizes):
+        """(op, messages per run, coroutine function) for one layer"""
+        channel = loop.run_until_complete(layer.new_channel())
+
+        async def send_receive():
+            await asyncio.gather(*(layer.send(channel, MESSAGE) for _ in range(batch)))
+            for _ in range(batch):
+                await layer.receive(channel)
+
+        yield 'send_receive', batch, send_receive
+
+        for size in group_sizes:
+            group = f'bench_{size}'
+            members = [loop.run_until_complete(layer.new_channel()) for _ in range(size)]
+            for member in members:
+                loop.run_until_complete(layer.group_add(group, member))
+
+            async def group_fanout(group=group, members=members):
+                await layer.group_send(group, MESSAGE)
+                await asyncio.gather(*(layer.receive(member) for member in members))
+
+            yield 'group_send', size, group_fanout
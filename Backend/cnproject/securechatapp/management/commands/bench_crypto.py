@@ -0,0 +1,83 @@
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Random import get_random_bytes
+from django.core.management.base import BaseCommand
+from securechatapp import benchmarks
+from securechatapp.encryption import EncryptionManager
+from securechatapp.keycache import KeyCache, key_cache
+from securechatapp.sessionkeys import session_keys
+
+DEFAULT_SIZES = [16, 256, 1024, 4096, 16384, 65536]
+BENCH_USER_ID = -1
+BENCH_KID = 2 ** 63
+
+
+class Command(BaseCommand):
+    help = "Microbenchmarks for the EncryptionManager crypto path, written as JSON for comparing runs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='crypto_bench.json')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--keygen-iterations', type=int, default=5)
+        parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                            help="Message sizes in bytes")
+        parser.add_argument('--history-size', type=int, default=1000,
+                            help="Messages per history decryption run")
+        benchmarks.add_compare_arguments(parser)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        results = []
+
+        def record(op, stats, size=None):
+            stats.update(op=op, size=size)
+            results.append(stats)
+            label = f"{op}[{size}]" if size is not None else op
+            self.stdout.write(
+                f"{label:40} {stats['ops_per_sec']:>12.1f} ops/s  "
+                f"p50 {stats['p50_ms']:8.3f} ms  p99 {stats['p99_ms']:8.3f} ms"
+            )
+
+        record('generate_key_pair', benchmarks.measure(
+            EncryptionManager.generate_key_pair, options['keygen_iterations'], warmup=0))
+
+        private_pem, public_pem = EncryptionManager.generate_key_pair()
+        record('key_import_private', benchmarks.measure(lambda: RSA.import_key(private_pem), iterations))
+        record('key_import_public', benchmarks.measure(lambda: RSA.import_key(public_pem), iterations))
+        record('key_cache_lookup', benchmarks.measure(lambda: key_cache.get(private_pem, BENCH_USER_ID), iterations))
+        cold_cache = KeyCache(maxsize=1)
+        record('key_cache_miss', benchmarks.measure(
+            lambda: (cold_cache.clear(), cold_cache.get(private_pem, BENCH_USER_ID)), iterations))
+
+        # Session key registered in memory only, nothing is written to the database
+        aes_key = get_random_bytes(16)
+        session_keys.remember(BENCH_KID, key_cache.get(public_pem, BENCH_USER_ID).cipher.encrypt(aes_key))
+
+        for size in options['sizes']:
+            message = 'x' * size
+            record('encrypt_message', benchmarks.measure(
+                lambda: EncryptionManager.encrypt_message(message, public_pem, BENCH_USER_ID), iterations), size)
+            wrapped = EncryptionManager.encrypt_message(message, public_pem, BENCH_USER_ID)
+            record('decrypt_message', benchmarks.measure(
+                lambda: EncryptionManager.decrypt_message(wrapped, private_pem, BENCH_USER_ID), iterations), size)
+            record('encrypt_session', benchmarks.measure(
+                lambda: EncryptionManager.encrypt_with_session_key(message, BENCH_KID, aes_key), iterations), size)
+            sessioned = EncryptionManager.encrypt_with_session_key(message, BENCH_KID, aes_key)
+            record('decrypt_session', benchmarks.measure(
+                lambda: EncryptionManager.decrypt_message(sessioned, private_pem, BENCH_USER_ID), iterations), size)
+
+        history_size = options['history_size']
+        history_iterations = max(3, iterations // 50)
+        resolver = lambda message: (private_pem, BENCH_USER_ID)
+        for op, encrypt in (
+            ('history_per_message', lambda m: EncryptionManager.encrypt_message(m, public_pem, BENCH_USER_ID)),
+            ('history_session', lambda m: EncryptionManager.encrypt_with_session_key(m, BENCH_KID, aes_key)),
+        ):
+            history = [encrypt(f"message {i} " + 'x' * 100) for i in range(history_size)]
+            record(f'{op}_decrypt_loop', benchmarks.measure(
+                lambda: [EncryptionManager.decrypt_message(m, private_pem, BENCH_USER_ID) for m in history],
+                history_iterations, units_per_call=history_size), history_size)
+            record(f'{op}_decrypt_many', benchmarks.measure(
+                lambda: EncryptionManager.decrypt_many(history, resolver),
+                history_iterations, units_per_call=history_size), history_size)
+
+        benchmarks.finish(self, options, 'crypto', results)
@@ -0,0 +1,82 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.functions import Length
+from securechatapp.models import Message
+from securechatapp import envelope
+
+
+def table_size():
+    """On-disk size of the message table, or the summed column sizes where the backend can't tell"""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_total_relation_size(%s)", [Message._meta.db_table])
+            return cursor.fetchone()[0]
+    totals = Message.objects.aggregate(content=Sum(Length('content')), payload=Sum(Length('payload')))
+    return (totals['content'] or 0) + (totals['payload'] or 0)
+
+
+def history_throughput(sample_size):
+    """Messages per second for loading and parsing the envelopes of the newest rows"""
+    started = time.perf_counter()
+    rows = list(Message.objects.order_by('-id').values('content', 'payload')[:sample_size])
+    for row in rows:
+        try:
+            envelope.decode(row)
+        except Exception:
+            pass
+    elapsed = time.perf_counter() - started
+    return len(rows) / elapsed if rows and elapsed else 0.0
+
+
+class Command(BaseCommand):
+    help = ("Convert JSON message envelopes in Message.content to the binary format in Message.payload. "
+            "Converted rows are skipped, so the command can be stopped and re-run at any time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--start-id', type=int, default=0,
+                            help="Resume after this message id")
+        parser.add_argument('--sample-size', type=int, default=2000,
+                            help="Rows used to measure history-load throughput")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        size_before = table_size()
+        throughput_before = history_throughput(options['sample_size'])
+
+        last_id = options['start_id']
+        converted = skipped = 0
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    Message.objects.filter(id__gt=last_id, payload__isnull=True)
+                    .exclude(content='').order_by('id').only('id', 'content')[:batch_size]
+                )
+                if not rows:
+                    break
+                updated = []
+                for message in rows:
+                    try:
+                        message.payload = envelope.to_binary(envelope.decode(message.content))
+                    except Exception:
+                        # Not an encrypted envelope, e.g. a plain message posted over REST
+                        skipped += 1
+                        continue
+                    message.content = ''
+                    updated.append(message)
+                Message.objects.bulk_update(updated, ['payload', 'content'])
+            converted += len(updated)
+            last_id = rows[-1].id
+            self.stdout.write(f"Converted {converted} messages, last id {last_id}")
+
+        size_after = table_size()
+        throughput_after = history_throughput(options['sample_size'])
+        self.stdout.write(self.style.SUCCESS(f"Done: {converted} converted, {skipped} skipped"))
+        self.stdout.write(f"Table size: {size_before} -> {size_after} bytes")
+        if connection.vendor == 'postgresql':
+            self.stdout.write("Dead tuples keep their space until the table is vacuumed")
+        self.stdout.write(
+            f"History load and parse: {throughput_before:.0f} -> {throughput_after:.0f} messages/sec"
+        )
@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from securechatapp.keypool import fill_pool, pool_level, key_pool_service
+
+
+class Command(BaseCommand):
+    help = "Pre-generate RSA key pairs so signup and first connect can claim one instead of generating inline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', type=int, default=key_pool_service.target,
+                            help="Number of unused key pairs to keep in the pool")
+        parser.add_argument('--watch', action='store_true',
+                            help="Keep running and refill the pool as keys are claimed")
+        parser.add_argument('--interval', type=int, default=30,
+                            help="Seconds between refills when --watch is set")
+
+    def handle(self, *args, **options):
+        target = options['target']
+        if not options['watch']:
+            started = time.perf_counter()
+            added = fill_pool(target)
+            self.stdout.write(self.style.SUCCESS(
+                f"Added {added} key pairs in {time.perf_counter() - started:.1f}s, pool level is {pool_level()}"
+            ))
+            return
+
+        key_pool_service.target = target
+        key_pool_service.start(interval=options['interval'])
+        self.stdout.write(f"Keeping the key pool at {target} key pairs, press Ctrl+C to stop")
+        try:
+            key_pool_service.join()
+        except KeyboardInterrupt:
+            key_pool_service.stop()
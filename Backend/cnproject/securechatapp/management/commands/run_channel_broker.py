@@ -0,0 +1,38 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from securechatapp.unixlayer import ChannelBroker, default_socket_path
+
+
+def configured_path():
+    """Socket path of the default channel layer when it is a UnixSocketChannelLayer"""
+    layer = getattr(settings, 'CHANNEL_LAYERS', {}).get('default', {})
+    if layer.get('BACKEND', '').endswith('UnixSocketChannelLayer'):
+        return layer.get('CONFIG', {}).get('path') or default_socket_path()
+    return default_socket_path()
+
+
+class Command(BaseCommand):
+    help = "Run the local channel layer broker that the workers on this host share over a Unix socket"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=configured_path())
+        parser.add_argument('--capacity', type=int, default=100,
+                            help="Messages a channel can hold before sends to it fail")
+        parser.add_argument('--expiry', type=int, default=60,
+                            help="Seconds before an unreceived message is dropped")
+        parser.add_argument('--group-expiry', type=int, default=86400,
+                            help="Seconds before a group membership lapses")
+
+    def handle(self, *args, **options):
+        broker = ChannelBroker(
+            options['path'],
+            capacity=options['capacity'],
+            expiry=options['expiry'],
+            group_expiry=options['group_expiry'],
+        )
+        self.stdout.write(f"Channel broker listening on {options['path']}, press Ctrl+C to stop")
+        try:
+            asyncio.run(broker.serve_forever())
+        except KeyboardInterrupt:
+            pass
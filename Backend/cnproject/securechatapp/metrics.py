@@ -0,0 +1,33 @@
+import threading
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and gauges. Gauges are callables that are read
+    when a snapshot is taken, so services register them once at start up.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def register_gauge(self, name, func):
+        self._gauges[name] = func
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self._counters)
+        for name, func in list(self._gauges.items()):
+            try:
+                data[name] = func()
+            except Exception as e:
+                print(f"Error reading gauge {name}: {e}")
+        return data
+
+
+metrics = MetricsRegistry()
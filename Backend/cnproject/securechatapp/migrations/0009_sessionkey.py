@@ -0,0 +1,26 @@
+# Generated by Django 5.2 on 2026-10-18 06:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securechatapp', '0008_alter_encryptionkey_private_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionKey',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('wrapped_key', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat_room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='securechatapp.chatroom')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='received_session_keys', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sent_session_keys', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
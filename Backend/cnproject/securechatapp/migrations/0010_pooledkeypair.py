@@ -0,0 +1,22 @@
+# Generated by Django 5.2 on 2026-10-18 06:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securechatapp', '0009_sessionkey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledKeyPair',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('public_key', models.TextField()),
+                ('private_key', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 06:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securechatapp', '0010_pooledkeypair'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='payload',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2 on 2026-10-18 06:43
+
+import hashlib
+from collections import defaultdict
+from django.db import migrations, models
+
+
+def backfill_member_keys(apps, schema_editor):
+    # Same keys as ChatRoom.make_member_key(). Rooms that duplicate an older
+    # direct room keep a NULL key so the unique constraint can be added.
+    ChatRoom = apps.get_model('securechatapp', 'ChatRoom')
+    ChatRoomMembership = apps.get_model('securechatapp', 'ChatRoomMembership')
+    members = defaultdict(set)
+    for room_id, user_id in ChatRoomMembership.objects.values_list('chat_room_id', 'user_id').iterator():
+        members[room_id].add(user_id)
+    seen = set()
+    updated = []
+    for room in ChatRoom.objects.order_by('id').only('id', 'is_group').iterator():
+        user_ids = sorted(members.get(room.id, ()))
+        if not room.is_group:
+            key = f"dm:{user_ids[0]}:{user_ids[1]}" if len(user_ids) == 2 else None
+            if key in seen:
+                key = None
+            seen.add(key)
+        elif user_ids:
+            key = "grp:" + hashlib.sha1(",".join(map(str, user_ids)).encode()).hexdigest()
+        else:
+            key = None
+        if key:
+            room.member_key = key
+            updated.append(room)
+    ChatRoom.objects.bulk_update(updated, ['member_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securechatapp', '0012_readwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='member_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_member_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatroom',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_group', False)), fields=('member_key',), name='unique_direct_room_members'),
+        ),
+    ]
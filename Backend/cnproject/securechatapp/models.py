@@ -1,10 +1,15 @@
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager, Group, Permission
+import hashlib
 from django.db import models
 from django.contrib.auth.models import BaseUserManager
 from django.utils import timezone
-from Cryptodome.PublicKey import RSA
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from securechatapp.keycache import key_cache
+from securechatapp.sessionkeys import session_keys
+from securechatapp.keydirectory import key_directory
+from securechatapp.authcache import auth_cache, token_versions
+from securechatapp.keypool import obtain_key_pair
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, username, password=None, **extra_fields):
         if not email:
@@ -36,6 +41,8 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
+    # Access tokens carry this as their "tv" claim, bumping it revokes them
+    token_version = models.PositiveIntegerField(default=0)
 
     
     date_joined = models.DateTimeField(default=timezone.now)
@@ -54,10 +61,20 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
 
+    def change_password(self, raw_password):
+        """Set and save a new password, tokens issued before it stop working"""
+        # Not in set_password(): check_password() calls it to upgrade the hash on login
+        self.set_password(raw_password)
+        self.token_version += 1
+        self.save(update_fields=['password', 'token_version'])
+
+    def revoke_tokens(self):
+        """Log out everywhere, tokens issued so far stop working"""
+        self.token_version += 1
+        self.save(update_fields=['token_version'])
+
     def create(self, **kwargs):
-        key = RSA.generate(2048)
-        private_key_pem = key.export_key().decode()
-        public_key_pem = key.publickey().export_key().decode()
+        private_key_pem, public_key_pem = obtain_key_pair()
         EncryptionKey.objects.create(user=self, public_key=public_key_pem, private_key=private_key_pem)
 
         return self
@@ -69,9 +86,8 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 @receiver(post_save, sender=CustomUser)
 def generate_rsa_keys(sender, instance, created, **kwargs):
     if created:
-        key = RSA.generate(2048)
-        private_key_pem = key.export_key().decode()
-        public_key_pem = key.publickey().export_key().decode()
+        # Claims a pre-generated pair, generates inline only if the pool is empty
+        private_key_pem, public_key_pem = obtain_key_pair()
 
         EncryptionKey.objects.create(
             user=instance,
@@ -83,6 +99,33 @@ class ChatRoom(models.Model):
     name = models.CharField(max_length=255, blank=True, null=True)
     is_group = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Canonical member set, see make_member_key(), unique for direct rooms
+    member_key = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['member_key'], condition=models.Q(is_group=False),
+                                    name='unique_direct_room_members'),
+        ]
+
+    @staticmethod
+    def make_member_key(user_ids, is_group=False):
+        """
+        "dm:<low id>:<high id>" for a direct room, a hash of the sorted member
+        ids for a group. None for a direct room that doesn't have two members.
+        """
+        user_ids = sorted(set(int(user_id) for user_id in user_ids))
+        if not is_group:
+            return f"dm:{user_ids[0]}:{user_ids[1]}" if len(user_ids) == 2 else None
+        if not user_ids:
+            return None
+        return "grp:" + hashlib.sha1(",".join(map(str, user_ids)).encode()).hexdigest()
+
+    def refresh_member_key(self):
+        """Recompute member_key after the memberships changed"""
+        user_ids = self.memberships.values_list('user_id', flat=True)
+        self.member_key = ChatRoom.make_member_key(user_ids, self.is_group)
+        ChatRoom.objects.filter(id=self.id).update(member_key=self.member_key)
 
 class ChatRoomMembership(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -94,12 +137,27 @@ class Message(models.Model):
     id = models.AutoField(primary_key=True)
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
-    content = models.TextField()  # Encrypted text
+    content = models.TextField(blank=True, default='')  # Legacy JSON envelope, empty for new rows
+    payload = models.BinaryField(null=True, blank=True)  # Binary envelope, see securechatapp.envelope
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
     is_delivered = models.BooleanField(default=False)
 
 
+class ReadWatermark(models.Model):
+    # "Read up to message id X" for one user in one room, only ever moves forward
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    chat_room = models.ForeignKey(ChatRoom, related_name='read_watermarks', on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat_room'], name='unique_read_watermark'),
+        ]
+
+
 class TypingIndicator(models.Model):
     id = models.AutoField(primary_key=True)
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
@@ -115,4 +173,39 @@ class EncryptionKey(models.Model):
     private_key = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
-post_save.connect(generate_rsa_keys, sender=CustomUser)
\ No newline at end of file
+class SessionKey(models.Model):
+    # AES key shared by a run of messages in one conversation, wrapped with
+    # the recipient's public RSA key. Messages reference it by id ("kid").
+    id = models.AutoField(primary_key=True)
+    chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    sender = models.ForeignKey(CustomUser, related_name='sent_session_keys', on_delete=models.CASCADE)
+    recipient = models.ForeignKey(CustomUser, related_name='received_session_keys', on_delete=models.CASCADE)
+    wrapped_key = models.TextField()  # base64, RSA-OAEP
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class PooledKeyPair(models.Model):
+    # Pre-generated RSA key pair waiting to be claimed by a new user
+    id = models.AutoField(primary_key=True)
+    public_key = models.TextField()
+    private_key = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+post_save.connect(generate_rsa_keys, sender=CustomUser)
+
+
+@receiver(post_save, sender=EncryptionKey)
+@receiver(post_delete, sender=EncryptionKey)
+def invalidate_cached_keys(sender, instance, **kwargs):
+    # Parsed keys are cached per user, drop them whenever the key row changes
+    key_cache.invalidate_user(instance.user_id)
+    session_keys.invalidate_recipient(instance.user_id)
+    key_directory.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_user_caches(sender, instance, **kwargs):
+    # The key directory is also keyed by username, which may have changed
+    key_directory.invalidate(instance.id, instance.username)
+    auth_cache.invalidate_user(instance.id)
+    token_versions.invalidate(instance.id)
\ No newline at end of file
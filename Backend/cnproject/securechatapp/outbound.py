@@ -0,0 +1,171 @@
+import asyncio
+import weakref
+from collections import deque
+from django.conf import settings
+from securechatapp.metrics import metrics
+
+# Closed with this code when the client can't keep up, the last frame says where to resume
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# Closed with this code when a frame could not be written, the client resumes with since
+WRITE_ERROR_CLOSE_CODE = 1011
+
+DROPPABLE_TYPES = ('writing-indicator', 'online-acknowledge', 'reply-online-acknowledge', 'offline-acknowledge')
+
+_queues = weakref.WeakSet()
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one websocket, written by a single task
+    so handlers never wait on a slow client. The queue is bounded by
+    OUTBOUND_QUEUE_MAX_FRAMES and OUTBOUND_QUEUE_MAX_BYTES. When it is full
+    and OUTBOUND_SLOW_CONSUMER_POLICY is 'drop', typing and presence frames
+    are dropped first; if that doesn't make room, or the policy is 'close',
+    the queue is replaced by a resume hint and the socket is closed.
+
+    Clients that connect with ?batch=1 get the frames that piled up during
+    one write as a single batch frame. If a write fails, the socket is
+    closed with WRITE_ERROR_CLOSE_CODE.
+    """
+
+    def __init__(self, consumer, batch=False):
+        self.consumer = consumer
+        self.codec = consumer.codec
+        self.batch = batch
+        self.max_frames = getattr(settings, 'OUTBOUND_QUEUE_MAX_FRAMES', 256)
+        self.max_bytes = getattr(settings, 'OUTBOUND_QUEUE_MAX_BYTES', 1024 * 1024)
+        self.max_batch = getattr(settings, 'OUTBOUND_BATCH_MAX_FRAMES', 32)
+        self.policy = getattr(settings, 'OUTBOUND_SLOW_CONSUMER_POLICY', 'drop')
+        self.droppable = set(getattr(settings, 'OUTBOUND_DROPPABLE_TYPES', DROPPABLE_TYPES))
+        self._frames = deque()
+        self._bytes = 0
+        self._ready = asyncio.Event()
+        self._writer = None
+        self.closing = False
+        # Highest message id written per room, for the resume hint
+        self.written = {}
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        _queues.add(self)
+
+    @property
+    def depth(self):
+        return len(self._frames)
+
+    def put(self, data, frame_type, resume=None):
+        """Queue an encoded frame. resume is (room_id, message_id) for frames that carry a message."""
+        if self.closing:
+            return
+        size = len(data)
+        droppable = frame_type in self.droppable
+        if self._full(size):
+            if self.policy == 'drop':
+                if droppable:
+                    self._drop(1)
+                    return
+                self._evict_droppable(size)
+            if self._full(size):
+                self._overflow()
+                return
+        self._frames.append((data, droppable, size, resume))
+        self._bytes += size
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._ready.set()
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write_forever())
+
+    def _full(self, size):
+        return len(self._frames) >= self.max_frames or (self._frames and self._bytes + size > self.max_bytes)
+
+    def _drop(self, count):
+        self.dropped += count
+        metrics.incr('outbound.frames_dropped', count)
+
+    def _evict_droppable(self, size):
+        kept = deque()
+        evicted = 0
+        for entry in self._frames:
+            if entry[1] and self._full(size):
+                self._bytes -= entry[2]
+                evicted += 1
+                continue
+            kept.append(entry)
+        self._frames = kept
+        if evicted:
+            self._drop(evicted)
+
+    def _overflow(self):
+        self._drop(len(self._frames))
+        self._frames.clear()
+        self._bytes = 0
+        self.closing = True
+        metrics.incr('outbound.slow_consumer_closes')
+        hint = self.codec.encode({
+            'type': 'slow-consumer',
+            'message': "Too far behind, reconnect and resume from these messages.",
+            'resume': [{'room': room_id, 'message_id': message_id} for room_id, message_id in self.written.items()],
+        })
+        self._frames.append((hint, False, len(hint), None))
+        self._bytes = len(hint)
+        self._ready.set()
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write_forever())
+
+    def _take(self):
+        count = min(len(self._frames), self.max_batch) if self.batch else 1
+        entries = [self._frames.popleft() for _ in range(count)]
+        self._bytes -= sum(entry[2] for entry in entries)
+        for _, _, _, resume in entries:
+            if resume is not None:
+                room_id, message_id = resume
+                self.written[room_id] = max(message_id, self.written.get(room_id, message_id))
+        return [entry[0] for entry in entries]
+
+    async def _write_forever(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self._frames:
+                    batch = self._take()
+                    data = batch[0] if len(batch) == 1 else self.codec.batch(batch)
+                    if len(batch) > 1:
+                        metrics.incr('outbound.batches')
+                    if self.codec.binary:
+                        await self.consumer.send(bytes_data=data)
+                    else:
+                        await self.consumer.send(text_data=data)
+                    self.sent += len(batch)
+                if self.closing:
+                    await self.consumer.close(code=SLOW_CONSUMER_CLOSE_CODE)
+                    return
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Frames after a lost one would leave a silent gap, end the connection instead
+            print(f"ERROR: writing to websocket {self.consumer.channel_name} failed, closing it: {e}")
+            metrics.incr('outbound.write_errors')
+            self.closing = True
+            self._frames.clear()
+            self._bytes = 0
+            try:
+                await self.consumer.close(code=WRITE_ERROR_CLOSE_CODE)
+            except Exception as close_error:
+                print(f"Error closing websocket: {close_error}")
+
+    def stop(self):
+        if self._writer is not None:
+            self._writer.cancel()
+        if self.dropped:
+            print(f"Outbound queue for {self.consumer.channel_name}: sent {self.sent}, "
+                  f"dropped {self.dropped}, max depth {self.max_depth}")
+
+    def stats(self):
+        return {'depth': self.depth, 'bytes': self._bytes, 'max_depth': self.max_depth,
+                'sent': self.sent, 'dropped': self.dropped}
+
+
+metrics.register_gauge('outbound.connections', lambda: len(_queues))
+metrics.register_gauge('outbound.queued_frames', lambda: sum(queue.depth for queue in list(_queues)))
+metrics.register_gauge('outbound.max_queue_depth', lambda: max((queue.max_depth for queue in list(_queues)), default=0))
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import uuid
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from securechatapp.metrics import metrics
+
+
+class PresenceRegistry:
+    """
+    Open sockets per user and per room in this process. A user with several
+    tabs is online until the last one closes, and only the first and last
+    socket in a room are announced to it. is_online/last_seen changes are
+    collected and written every PRESENCE_FLUSH_INTERVAL seconds in one
+    bulk update. Each worker process only knows its own sockets.
+    """
+
+    def __init__(self, flush_interval=None):
+        self.flush_interval = flush_interval or getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 5.0)
+        # Tags presence events so other processes can tell local joins apart
+        self.process_id = uuid.uuid4().hex
+        self._users = {}
+        self._rooms = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def connect(self, user_id, username, room_id):
+        """Count a new socket. Returns True when the user was not in the room on this process before."""
+        with self._lock:
+            self._users[user_id] = self._users.get(user_id, 0) + 1
+            if self._users[user_id] == 1:
+                self._dirty[user_id] = (True, timezone.now())
+            room = self._rooms.setdefault(room_id, {})
+            room[username] = room.get(username, 0) + 1
+            joined = room[username] == 1
+        self._ensure_flusher()
+        return joined
+
+    def disconnect(self, user_id, username, room_id):
+        """Count a closed socket. Returns True when it was the user's last one in the room."""
+        with self._lock:
+            self._users[user_id] = self._users.get(user_id, 1) - 1
+            if self._users[user_id] <= 0:
+                del self._users[user_id]
+                self._dirty[user_id] = (False, timezone.now())
+            room = self._rooms.get(room_id, {})
+            room[username] = room.get(username, 1) - 1
+            left = room[username] <= 0
+            if left:
+                del room[username]
+                if not room:
+                    self._rooms.pop(room_id, None)
+        self._ensure_flusher()
+        return left
+
+    def online_in_room(self, room_id):
+        """Usernames with an open socket in the room"""
+        return list(self._rooms.get(room_id, ()))
+
+    def is_online(self, user_id):
+        return user_id in self._users
+
+    def flush(self):
+        """Write pending is_online/last_seen changes, returns how many users were updated"""
+        from securechatapp.models import CustomUser
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        try:
+            CustomUser.objects.bulk_update(
+                [CustomUser(id=user_id, is_online=is_online, last_seen=last_seen)
+                 for user_id, (is_online, last_seen) in dirty.items()],
+                ['is_online', 'last_seen'], batch_size=500,
+            )
+        except Exception:
+            # Retried with the next flush unless a newer change came in meanwhile
+            with self._lock:
+                for user_id, change in dirty.items():
+                    self._dirty.setdefault(user_id, change)
+            raise
+        metrics.incr('presence.flushes')
+        metrics.incr('presence.users_written', len(dirty))
+        return len(dirty)
+
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_forever())
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await database_sync_to_async(self.flush)()
+            except Exception as e:
+                print(f"Error writing presence: {e}")
+            if not self._users and not self._dirty:
+                return
+
+
+presence = PresenceRegistry()
+metrics.register_gauge('presence.online_users', lambda: len(presence._users))
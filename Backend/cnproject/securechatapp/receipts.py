@@ -0,0 +1,105 @@
+import asyncio
+from django.conf import settings
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from securechatapp.metrics import metrics
+from securechatapp.models import Message, ReadWatermark
+from securechatapp.writebehind import message_writer
+
+
+class ReceiptAggregator:
+    """
+    Buffers message ids for one connection and hands them to flush_func as a
+    single sorted list, either DELIVERY_RECEIPT_WINDOW seconds after the
+    first id arrived or as soon as DELIVERY_RECEIPT_MAX_BATCH ids are waiting.
+    """
+
+    def __init__(self, flush_func, window=None, max_batch=None):
+        self.flush_func = flush_func
+        self.window = window if window is not None else getattr(settings, 'DELIVERY_RECEIPT_WINDOW', 0.25)
+        self.max_batch = max_batch or getattr(settings, 'DELIVERY_RECEIPT_MAX_BATCH', 200)
+        self.pending = set()
+        self._timer = None
+
+    def add(self, message_id):
+        if not message_id:
+            return
+        self.pending.add(message_id)
+        if len(self.pending) >= self.max_batch:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.window)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        # Taken before anything can raise, ids added during the flush wait for the next one
+        message_ids, self.pending = self.pending, set()
+        try:
+            message_ids = sorted(message_ids)
+            metrics.incr('receipts.flushes')
+            metrics.incr('receipts.message_ids', len(message_ids))
+            await self.flush_func(message_ids)
+        except Exception as e:
+            print(f"Error flushing receipts: {e}")
+
+
+def newest_message_id(room_id):
+    """Highest message id in a room, counting messages still queued for write-behind"""
+    pending = message_writer.newest_pending(room_id)
+    newest = Message.objects.filter(chat_room_id=room_id).order_by('-id').values_list('id', flat=True).first()
+    return max(pending or 0, newest or 0) or None
+
+
+def advance_read_watermark(user_id, room_id, message_id):
+    """
+    Move a user's read watermark forward to message_id, clamped to the
+    room's newest message so a bogus id can't mark future messages read.
+    The conditional UPDATE never moves it back, so late or duplicate
+    receipts are no-ops. Returns the id the watermark moved to, None when
+    it didn't move.
+    """
+    newest = newest_message_id(room_id)
+    if newest is None:
+        return None
+    message_id = min(message_id, newest)
+    for _ in range(2):
+        if ReadWatermark.objects.filter(
+            user_id=user_id, chat_room_id=room_id, last_read_message_id__lt=message_id
+        ).update(last_read_message_id=message_id, updated_at=timezone.now()):
+            return message_id
+        _, created = ReadWatermark.objects.get_or_create(
+            user_id=user_id, chat_room_id=room_id, defaults={'last_read_message_id': message_id}
+        )
+        if created:
+            return message_id
+    return None
+
+
+def room_watermarks(room_id):
+    """{user_id: last read message id} for every member who has read something"""
+    return dict(ReadWatermark.objects.filter(chat_room_id=room_id).values_list('user_id', 'last_read_message_id'))
+
+
+def is_read(message_id, sender_id, watermarks):
+    """A message counts as read once any member other than its sender has read up to it"""
+    return any(last_read >= message_id for user_id, last_read in watermarks.items() if user_id != sender_id)
+
+
+def with_unread_counts(rooms, user):
+    """Annotate a ChatRoom queryset with unread_count for user, in the same query"""
+    last_read = ReadWatermark.objects.filter(user=user, chat_room=OuterRef('pk')).values('last_read_message_id')[:1]
+    return rooms.annotate(
+        read_up_to=Coalesce(Subquery(last_read), Value(0)),
+    ).annotate(
+        unread_count=Count('message', filter=Q(message__id__gt=F('read_up_to')) & ~Q(message__sender=user)),
+    )
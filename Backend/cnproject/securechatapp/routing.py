@@ -2,6 +2,7 @@ from django.urls import path
 # from .consumers import *
 from securechatapp.consumer import * 
 websocket_urlpatterns = [
+    path('chat/', MultiplexConsumer.as_asgi()),
     path('chat/<str:chatwithusername>/', ChatConsumer.as_asgi()),
     # path('chat/group/<str:group_id>/', ChatConsumer.as_asgi()),
     # path('ws/notification/', NotificationConsumer.as_asgi()),
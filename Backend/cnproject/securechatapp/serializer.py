@@ -2,6 +2,7 @@ from rest_framework import serializers
 from securechatapp.models import CustomUser, ChatRoomMembership, ChatRoom, Message, TypingIndicator, EncryptionKey
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth import authenticate
+from securechatapp.authenticate import add_user_claims
 
 
 
@@ -32,6 +33,13 @@ class CustomUserSerializer(serializers.ModelSerializer):
         user.save()
 
         return user
+
+    def update(self, instance, validated_data):
+        password = validated_data.pop('password', None)
+        instance = super().update(instance, validated_data)
+        if password is not None:
+            instance.change_password(password)
+        return instance
 class ChatRoomMembershipSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatRoomMembership
@@ -120,6 +128,11 @@ class EncryptionKeySerializer(serializers.ModelSerializer):
 class EmailTokenObtainPairSerializer(TokenObtainPairSerializer):
     username_field = 'email'
 
+    @classmethod
+    def get_token(cls, user):
+        # Claims for stateless REST authentication, see JWT_STATELESS_USER
+        return add_user_claims(super().get_token(user), user)
+
     def validate(self, attrs):
         email = attrs.get("email")
         password = attrs.get("password")
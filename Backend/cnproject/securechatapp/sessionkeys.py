@@ -0,0 +1,133 @@
+import base64
+import threading
+import time
+from django.conf import settings
+from Cryptodome.Random import get_random_bytes
+from securechatapp.keycache import key_cache
+from securechatapp.lru import LRUCache
+
+
+class ActiveSession:
+    __slots__ = ('kid', 'aes_key', 'recipient_id', 'created', 'count')
+
+    def __init__(self, kid, aes_key, recipient_id):
+        self.kid = kid
+        self.aes_key = aes_key
+        self.recipient_id = recipient_id
+        self.created = time.monotonic()
+        self.count = 0
+
+
+class SessionKeyManager:
+    """
+    Hands out per-conversation AES session keys so a message only costs an
+    AES encryption. A session is keyed by (sender, recipient, room) and is
+    rotated after SESSION_KEY_MAX_MESSAGES messages or SESSION_KEY_MAX_AGE
+    seconds. Readers unwrap each session key once and keep it in an LRU.
+    """
+
+    def __init__(self):
+        self.max_messages = getattr(settings, 'SESSION_KEY_MAX_MESSAGES', 1000)
+        self.max_age = getattr(settings, 'SESSION_KEY_MAX_AGE', 3600)
+        cache_size = getattr(settings, 'SESSION_KEY_CACHE_SIZE', 4096)
+        self._active = {}
+        self._lock = threading.Lock()
+        # kid -> wrapped key bytes, saves a query when a reader needs it
+        self._wrapped = LRUCache(cache_size)
+        # (kid, private key fingerprint) -> unwrapped AES key
+        self._unwrapped = LRUCache(cache_size)
+
+    def current(self, sender_id, recipient_id, room_id):
+        """
+        Return (kid, aes_key) for the live session of a conversation and count
+        one message against it, or None when a new session has to be created.
+        Never touches the database so it is safe to call from async code.
+        """
+        with self._lock:
+            session = self._active.get((sender_id, recipient_id, room_id))
+            if session is None:
+                return None
+            if session.count >= self.max_messages or time.monotonic() - session.created >= self.max_age:
+                del self._active[(sender_id, recipient_id, room_id)]
+                return None
+            session.count += 1
+            return session.kid, session.aes_key
+
+    def rotate(self, sender_id, recipient_id, room_id, recipient_public_key):
+        """Create, store and activate a fresh session key. Hits the database."""
+        from securechatapp.models import SessionKey
+
+        aes_key = get_random_bytes(16)
+        wrapped_key = key_cache.get(recipient_public_key, recipient_id).cipher.encrypt(aes_key)
+        row = SessionKey.objects.create(
+            chat_room_id=room_id,
+            sender_id=sender_id,
+            recipient_id=recipient_id,
+            wrapped_key=base64.b64encode(wrapped_key).decode('utf-8'),
+        )
+        self.remember(row.id, wrapped_key)
+
+        session = ActiveSession(row.id, aes_key, recipient_id)
+        session.count = 1
+        with self._lock:
+            self._active[(sender_id, recipient_id, room_id)] = session
+        return session.kid, session.aes_key
+
+    def remember(self, kid, wrapped_key):
+        """Make a wrapped session key available to unwrap() without a query"""
+        self._wrapped.set(kid, wrapped_key)
+
+    def missing(self, kids):
+        """Session key ids whose wrapped key is not loaded yet"""
+        return [kid for kid in set(kids) if kid not in self._wrapped]
+
+    def wrapped(self, kids):
+        """Loaded wrapped keys for the given ids, by id"""
+        found = {}
+        for kid in set(kids):
+            wrapped_key = self._wrapped.get(kid)
+            if wrapped_key is not None:
+                found[kid] = wrapped_key
+        return found
+
+    def prefetch(self, kids):
+        """Load wrapped keys for the given ids in one query. Hits the database."""
+        from securechatapp.models import SessionKey
+
+        kids = self.missing(kids)
+        if not kids:
+            return
+        for kid, wrapped_key in SessionKey.objects.filter(id__in=kids).values_list('id', 'wrapped_key'):
+            self.remember(kid, base64.b64decode(wrapped_key))
+
+    def prefetch_room(self, room_id):
+        """Load every wrapped session key of a room in one query. Hits the database."""
+        from securechatapp.models import SessionKey
+
+        for kid, wrapped_key in SessionKey.objects.filter(chat_room_id=room_id).values_list('id', 'wrapped_key'):
+            if kid not in self._wrapped:
+                self.remember(kid, base64.b64decode(wrapped_key))
+
+    def unwrap(self, kid, private_key, user_id=None):
+        """
+        Return the AES key for a session key id. The wrapped key must already
+        be loaded, see prefetch().
+        """
+        parsed = key_cache.get(private_key, user_id)
+        aes_key = self._unwrapped.get((kid, parsed.fingerprint))
+        if aes_key is None:
+            wrapped_key = self._wrapped.get(kid)
+            if wrapped_key is None:
+                raise KeyError(f"Session key {kid} is not loaded")
+            aes_key = parsed.cipher.decrypt(wrapped_key)
+            self._unwrapped.set((kid, parsed.fingerprint), aes_key)
+        return aes_key
+
+    def invalidate_recipient(self, user_id):
+        """Stop using sessions wrapped for a key that has just been replaced"""
+        with self._lock:
+            for conversation in [c for c, s in self._active.items() if s.recipient_id == user_id]:
+                del self._active[conversation]
+
+
+session_keys = SessionKeyManager()
@@ -1,3 +1,864 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+from concurrent.futures import Executor, Future
+from datetime import timedelta
+from unittest import mock
+from django.db import OperationalError
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory, force_authenticate
+from securechatapp import envelope, frames
+from securechatapp.authcache import AuthCache, auth_cache, token_versions
+from securechatapp.authenticate import JWTAuthFromCookie, add_user_claims
+from securechatapp.consumer import ChatConsumer, MultiplexConsumer
+from securechatapp.cryptoservice import CryptoService
+from securechatapp.encryption import EncryptionManager
+from securechatapp.events import message_event
+from securechatapp.keycache import KeyCache, key_cache
+from securechatapp.keydirectory import KeyDirectory, key_directory
+from securechatapp.keypool import claim_key_pair, key_pool_service
+from securechatapp.models import CustomUser, ChatRoom, ChatRoomMembership, EncryptionKey, Message, PooledKeyPair, ReadWatermark
+from securechatapp.outbound import OutboundQueue, SLOW_CONSUMER_CLOSE_CODE, WRITE_ERROR_CLOSE_CODE
+from securechatapp.presence import PresenceRegistry
+from securechatapp.receipts import ReceiptAggregator, advance_read_watermark, with_unread_counts
+from securechatapp.serializer import EmailTokenObtainPairSerializer, MessageSerializer
+from securechatapp.sessionkeys import SessionKeyManager, session_keys
+from securechatapp.typingstate import TypingTracker
+from securechatapp.unixlayer import ChannelBroker, check_socket_dir, make_socket_dir
+from securechatapp.views import ChatRoomMembershipView
+from securechatapp.writebehind import MessageIdAllocator, MessageSpool, MessageWriter
 
-# Create your tests here.
+
+def create_members(test):
+    test.alice = CustomUser.objects.create_user(email='alice@example.com', username='alice', password='secret')
+    test.bob = CustomUser.objects.create_user(email='bob@example.com', username='bob', password='secret')
+    test.room = ChatRoom.objects.create(name='alice-bob')
+    ChatRoomMembership.objects.create(user=test.alice, chat_room=test.room)
+    ChatRoomMembership.objects.create(user=test.bob, chat_room=test.room)
+
+
+class MessageEventTests(TestCase):
+    def setUp(self):
+        create_members(self)
+
+    def serializer_event(self, message):
+        # What the consumer sent before, reduced from the full MessageSerializer
+        data = MessageSerializer(message).data
+        return {
+            'id': data['id'],
+            'sender': data['sender']['username'],
+            'content': data['content'],
+            'timestamp': data['timestamp'],
+            'is_read': data['is_read'],
+            'is_delivered': data['is_delivered'],
+            'chat_room': data['chat_room']['id'],
+        }
+
+    def test_matches_message_serializer(self):
+        for message in (
+            Message.objects.create(sender=self.alice, chat_room_id=self.room.id, payload=b'\x02payload',
+                                   timestamp=timezone.now()),
+            Message.objects.create(sender=self.bob, chat_room=self.room, content='{"legacy": true}',
+                                   is_read=True, is_delivered=True),
+        ):
+            self.assertEqual(message_event(message), self.serializer_event(message))
+            self.assertEqual(message_event(message, message.sender.username), self.serializer_event(message))
+
+    def test_no_queries_per_send(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.alice}
+        # Built the way create_message builds it, with only the room id known
+        message = Message.objects.create(sender=self.alice, chat_room_id=self.room.id, payload=b'\x02payload',
+                                         timestamp=timezone.now(), is_read=False, is_delivered=False)
+        with self.assertNumQueries(0):
+            event = consumer.serialize_message(message)
+        self.assertEqual(event, self.serializer_event(message))
+
+
+class KeyCacheTests(TestCase):
+    def setUp(self):
+        create_members(self)
+        self.bob_private, self.bob_public = EncryptionManager.get_or_create_user_key(self.bob)
+
+    def test_parses_each_key_once(self):
+        cache = KeyCache()
+        parsed = cache.get(self.bob_private, self.bob.id)
+        self.assertIs(cache.get(self.bob_private, self.bob.id), parsed)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Keyed by user too, the same PEM for another user is parsed again
+        self.assertIsNot(cache.get(self.bob_private, self.alice.id), parsed)
+
+    def test_key_change_drops_users_entries(self):
+        parsed = key_cache.get(self.bob_private, self.bob.id)
+        EncryptionKey.objects.get(user=self.bob).save()
+        self.assertIsNot(key_cache.get(self.bob_private, self.bob.id), parsed)
+
+
+class EncryptionTests(TestCase):
+    def setUp(self):
+        create_members(self)
+        # Created with the users
+        self.alice_private, self.alice_public = EncryptionManager.get_or_create_user_key(self.alice)
+        self.bob_private, self.bob_public = EncryptionManager.get_or_create_user_key(self.bob)
+
+    def assertReencodes(self, payload):
+        self.assertEqual(envelope.to_binary(envelope.decode(payload)), payload)
+
+    def test_wrapped_round_trip(self):
+        payload = EncryptionManager.encrypt_message('hi bob', self.bob_public, self.bob.id)
+        self.assertEqual(payload[0], envelope.VERSION_WRAPPED)
+        self.assertReencodes(payload)
+        self.assertEqual(EncryptionManager.decrypt_message(payload, self.bob_private, self.bob.id), {'content': 'hi bob'})
+
+    def test_session_envelope(self):
+        kid, aes_key = session_keys.rotate(self.alice.id, self.bob.id, self.room.id, self.bob_public)
+        payload = EncryptionManager.encrypt_with_session_key('hi bob', kid, aes_key)
+        self.assertEqual(payload[0], envelope.VERSION_SESSION)
+        self.assertEqual(envelope.decode(payload).kid, kid)
+        self.assertReencodes(payload)
+
+    def test_multi_round_trip(self):
+        payload = EncryptionManager.encrypt_for_recipients(
+            'hi all', [(self.alice.id, self.alice_public), (self.bob.id, self.bob_public)]
+        )
+        self.assertEqual(payload[0], envelope.VERSION_MULTI)
+        self.assertReencodes(payload)
+        self.assertEqual(EncryptionManager.decrypt_message(payload, self.alice_private, self.alice.id), {'content': 'hi all'})
+        self.assertEqual(EncryptionManager.decrypt_message(payload, self.bob_private, self.bob.id), {'content': 'hi all'})
+        with self.assertRaises(KeyError):
+            envelope.decode(payload).wrapped_key_for(self.bob.id + 100)
+
+    def test_legacy_json_content(self):
+        wrapped = envelope.decode(EncryptionManager.encrypt_message('old row', self.bob_public, self.bob.id))
+        content = json.dumps({
+            'key': base64.b64encode(wrapped.wrapped_key).decode(),
+            'iv': base64.b64encode(wrapped.iv).decode(),
+            'message': base64.b64encode(wrapped.ciphertext).decode(),
+        })
+        self.assertEqual(EncryptionManager.decrypt_message(content, self.bob_private, self.bob.id), {'content': 'old row'})
+        self.assertEqual(envelope.decode({'payload': None, 'content': content}).ciphertext, wrapped.ciphertext)
+
+    def test_decrypt_many_returns_none_for_bad_rows(self):
+        good = EncryptionManager.encrypt_message('first', self.bob_public, self.bob.id)
+        kid, aes_key = session_keys.rotate(self.alice.id, self.bob.id, self.room.id, self.bob_public)
+        session = EncryptionManager.encrypt_with_session_key('second', kid, aes_key)
+        for_alice = EncryptionManager.encrypt_message('not for bob', self.alice_public, self.alice.id)
+        results = EncryptionManager.decrypt_many(
+            [good, b'\x09unknown version', for_alice, 'not json', session],
+            lambda item: (self.bob_private, self.bob.id),
+        )
+        self.assertEqual(results, [{'content': 'first'}, None, None, None, {'content': 'second'}])
+
+
+class SessionKeyTests(TestCase):
+    def setUp(self):
+        create_members(self)
+        self.bob_private, self.bob_public = EncryptionManager.get_or_create_user_key(self.bob)
+        self.manager = SessionKeyManager()
+
+    def test_round_trip(self):
+        kid, aes_key = session_keys.rotate(self.alice.id, self.bob.id, self.room.id, self.bob_public)
+        payload = EncryptionManager.encrypt_with_session_key('hi bob', kid, aes_key)
+        self.assertEqual(EncryptionManager.decrypt_message(payload, self.bob_private, self.bob.id), {'content': 'hi bob'})
+
+    def test_rotates_after_max_messages(self):
+        self.manager.max_messages = 2
+        kid, aes_key = self.manager.rotate(self.alice.id, self.bob.id, self.room.id, self.bob_public)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.manager.current(self.alice.id, self.bob.id, self.room.id), (kid, aes_key))
+            self.assertIsNone(self.manager.current(self.alice.id, self.bob.id, self.room.id))
+
+    def test_unwraps_once(self):
+        kid, aes_key = session_keys.rotate(self.alice.id, self.bob.id, self.room.id, self.bob_public)
+        with self.assertRaises(KeyError):
+            self.manager.unwrap(kid, self.bob_private, self.bob.id)
+        with self.assertNumQueries(1):
+            self.manager.prefetch([kid])
+        with self.assertNumQueries(0):
+            self.manager.prefetch([kid])
+        self.assertEqual(self.manager.unwrap(kid, self.bob_private, self.bob.id), aes_key)
+        # Served from the unwrapped cache, the wrapped key is not needed again
+        self.manager._wrapped.pop(kid)
+        self.assertEqual(self.manager.unwrap(kid, self.bob_private, self.bob.id), aes_key)
+
+    def test_new_recipient_key_ends_sessions(self):
+        session_keys.rotate(self.alice.id, self.bob.id, self.room.id, self.bob_public)
+        self.assertIsNotNone(session_keys.current(self.alice.id, self.bob.id, self.room.id))
+        EncryptionKey.objects.get(user=self.bob).save()
+        self.assertIsNone(session_keys.current(self.alice.id, self.bob.id, self.room.id))
+
+
+class InlineExecutor(Executor):
+    """Runs pool work in the calling thread, so its queries count there"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+class CryptoServiceTests(TransactionTestCase):
+    def setUp(self):
+        create_members(self)
+        self.bob_private, self.bob_public = EncryptionManager.get_or_create_user_key(self.bob)
+        self.service = CryptoService()
+        self.service._executor = InlineExecutor()
+
+    def test_workers_get_session_keys_with_the_work(self):
+        kid, aes_key = session_keys.rotate(self.alice.id, self.bob.id, self.room.id, self.bob_public)
+        payloads = [EncryptionManager.encrypt_with_session_key(text, kid, aes_key) for text in ('one', 'two')]
+        session_keys._wrapped.clear()
+        session_keys._unwrapped.clear()
+        # Loaded on a sync_to_async thread, nothing queries on the worker
+        with self.assertNumQueries(0):
+            results = asyncio.run(self.service.decrypt_batch(payloads, self.bob_private, self.bob.id))
+        self.assertEqual(results, [{'content': 'one'}, {'content': 'two'}])
+        self.assertEqual(self.service.stats()['in_flight'], {'live': 0, 'bulk': 0})
+
+
+class KeyPoolTests(TestCase):
+    def setUp(self):
+        PooledKeyPair.objects.bulk_create([
+            PooledKeyPair(private_key=f'private {i}', public_key=f'public {i}') for i in range(2)
+        ])
+        key_pool_service._level = None
+        self.addCleanup(setattr, key_pool_service, '_level', None)
+
+    def test_claim_takes_pairs_oldest_first(self):
+        self.assertEqual(claim_key_pair(), ('private 0', 'public 0'))
+        self.assertEqual(claim_key_pair(), ('private 1', 'public 1'))
+        self.assertIsNone(claim_key_pair())
+        self.assertFalse(PooledKeyPair.objects.exists())
+
+    def test_level_follows_claims_without_counting(self):
+        self.assertEqual(key_pool_service.level(), 2)
+        claim_key_pair()
+        with self.assertNumQueries(0):
+            self.assertEqual(key_pool_service.level(), 1)
+
+
+class HistoryPageTests(TransactionTestCase):
+    def setUp(self):
+        create_members(self)
+        key_directory.clear()
+        bob_public = EncryptionKey.objects.get(user=self.bob).public_key
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {'user': self.bob, 'url_route': {'kwargs': {'chatwithusername': 'alice'}}}
+        sent_at = timezone.now() - timedelta(minutes=1)
+        self.ids = []
+        for i, offset in enumerate([0, 1, 1, 1, 2]):
+            payload = EncryptionManager.encrypt_message(f'm{i}', bob_public, self.bob.id)
+            message = Message.objects.create(sender=self.alice, chat_room=self.room, payload=payload)
+            # Three messages share a timestamp, the id breaks the tie
+            Message.objects.filter(id=message.id).update(timestamp=sent_at + timedelta(seconds=offset))
+            self.ids.append(message.id)
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=2)
+    def test_pages_cover_history_once(self):
+        pages = []
+        cursor = None
+        while True:
+            messages, cursor, has_more = asyncio.run(self.consumer.fetch_chat_history(self.room.id, before=cursor))
+            pages.append([m['id'] for m in messages])
+            if not has_more:
+                break
+        self.assertEqual(pages, [self.ids[3:], self.ids[1:3], self.ids[:1]])
+        self.assertIsNone(cursor)
+
+
+class ReceiptAggregatorTests(SimpleTestCase):
+    def test_batches_sorted_unique_ids(self):
+        flushed = []
+
+        async def run():
+            async def flush(message_ids):
+                flushed.append(message_ids)
+
+            aggregator = ReceiptAggregator(flush, window=0.01, max_batch=3)
+            for message_id in (5, 2, 5, 0, None):
+                aggregator.add(message_id)
+            await asyncio.sleep(0.05)
+            # A full batch goes out without waiting for the window
+            for message_id in (9, 7, 8):
+                aggregator.add(message_id)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        self.assertEqual(flushed, [[2, 5], [7, 8, 9]])
+
+    def test_failed_flush_clears_pending(self):
+        async def run():
+            async def flush(message_ids):
+                raise RuntimeError('channel layer down')
+
+            aggregator = ReceiptAggregator(flush, window=60)
+            aggregator.add(1)
+            await aggregator.flush()
+            return aggregator.pending
+
+        self.assertEqual(asyncio.run(run()), set())
+
+
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        create_members(self)
+        self.messages = [Message.objects.create(sender=self.alice, chat_room=self.room, content='{}') for _ in range(3)]
+
+    def watermark(self):
+        return ReadWatermark.objects.get(user=self.bob, chat_room=self.room).last_read_message_id
+
+    def test_never_moves_back(self):
+        first, second, third = (message.id for message in self.messages)
+        self.assertEqual(advance_read_watermark(self.bob.id, self.room.id, second), second)
+        self.assertIsNone(advance_read_watermark(self.bob.id, self.room.id, first))
+        self.assertIsNone(advance_read_watermark(self.bob.id, self.room.id, second))
+        self.assertEqual(self.watermark(), second)
+        self.assertEqual(advance_read_watermark(self.bob.id, self.room.id, third), third)
+
+    def test_clamped_to_newest_message(self):
+        other_room = ChatRoom.objects.create(name='elsewhere')
+        newer_elsewhere = Message.objects.create(sender=self.alice, chat_room=other_room, content='{}')
+        self.assertEqual(advance_read_watermark(self.bob.id, self.room.id, newer_elsewhere.id + 1000), self.messages[-1].id)
+        self.assertEqual(self.watermark(), self.messages[-1].id)
+        self.assertIsNone(advance_read_watermark(self.bob.id, ChatRoom.objects.create(name='empty').id, 5))
+
+    def test_unread_counts(self):
+        Message.objects.create(sender=self.bob, chat_room=self.room, content='{}')
+        advance_read_watermark(self.bob.id, self.room.id, self.messages[0].id)
+        empty = ChatRoom.objects.create(name='empty')
+        rooms = ChatRoom.objects.filter(id__in=[self.room.id, empty.id]).order_by('id')
+        with self.assertNumQueries(1):
+            counts = [(room.id, room.unread_count) for room in with_unread_counts(rooms, self.bob)]
+        # Own messages are never unread
+        self.assertEqual(counts, [(self.room.id, 2), (empty.id, 0)])
+        self.assertEqual([room.unread_count for room in with_unread_counts(rooms, self.alice)], [1, 0])
+
+    def test_invalid_read_receipt_is_ignored(self):
+        consumer = ChatConsumer()
+        consumer.read_aggregator = ReceiptAggregator(None)
+        asyncio.run(consumer.handle_read_receipt('not a number'))
+        asyncio.run(consumer.handle_read_receipt(None))
+        self.assertEqual(consumer.read_aggregator.pending, set())
+
+
+class TypingTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.tracker = TypingTracker(interval=2, ttl=6)
+
+    def test_coalesces_within_interval(self):
+        self.assertTrue(self.tracker.update(1, 'alice', True, now=100))
+        self.assertFalse(self.tracker.update(1, 'alice', True, now=101))
+        # Held back, released by the sweeper once the interval is over
+        self.assertFalse(self.tracker.update(1, 'alice', False, now=101.5))
+        self.assertEqual(self.tracker.sweep(now=101.9), [])
+        self.assertEqual(self.tracker.sweep(now=102), [(1, 'alice', False)])
+
+    def test_stale_typing_expires(self):
+        self.tracker.update(1, 'alice', True, now=100)
+        self.assertEqual(self.tracker.sweep(now=105), [])
+        self.assertTrue(self.tracker.is_typing(1, 'alice'))
+        self.assertEqual(self.tracker.sweep(now=106), [(1, 'alice', False)])
+        self.assertFalse(self.tracker.is_typing(1, 'alice'))
+        self.tracker.sweep(now=108)
+        self.assertEqual(self.tracker._rooms, {})
+
+
+class MemberKeyTests(TransactionTestCase):
+    def setUp(self):
+        create_members(self)
+        self.room.refresh_member_key()
+
+    def test_direct_room_found_by_member_key(self):
+        self.room.delete()
+        # Created first, so going by id order alone would pick it
+        group = ChatRoom.objects.create(name='group', is_group=True)
+        direct = ChatRoom.objects.create(name='alice-bob')
+        for room in (group, direct):
+            ChatRoomMembership.objects.create(user=self.alice, chat_room=room)
+            ChatRoomMembership.objects.create(user=self.bob, chat_room=room)
+        direct.refresh_member_key()
+        consumer = ChatConsumer()
+        consumer.scope = {'user': self.bob}
+        self.assertEqual(asyncio.run(consumer.get_room_name('alice')), str(direct.id))
+        self.assertFalse(consumer.is_group)
+
+    def test_leaving_into_an_existing_pair(self):
+        carol = CustomUser.objects.create_user(email='carol@example.com', username='carol', password='secret')
+        crowded = ChatRoom.objects.create(name='alice-bob-carol')
+        for user in (self.alice, self.bob, carol):
+            ChatRoomMembership.objects.create(user=user, chat_room=crowded)
+        crowded.refresh_member_key()
+        request = APIRequestFactory().delete('/', {'chat_room_id': crowded.id}, format='json')
+        force_authenticate(request, user=carol)
+        response = ChatRoomMembershipView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ChatRoomMembership.objects.filter(user=carol, chat_room=crowded).exists())
+        crowded.refresh_from_db()
+        self.assertIsNone(crowded.member_key)
+        self.assertEqual(ChatRoom.objects.get(member_key=self.room.member_key).name, 'alice-bob')
+
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        create_members(self)
+        self.writer = MessageWriter()
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        self.spool_path = os.path.join(spool_dir, 'spool.log')
+        self.writer.spool = MessageSpool(self.spool_path, fsync=False)
+        self.writer.failed = MessageSpool(self.spool_path + '.failed', fsync=False)
+
+    def message(self, message_id, **fields):
+        fields.setdefault('timestamp', timezone.now() - timedelta(seconds=30))
+        return Message(id=message_id, sender=self.alice, chat_room=self.room, payload=b'\x02payload', **fields)
+
+    def test_sends_use_the_reserved_block(self):
+        allocator = MessageIdAllocator(block_size=10, max_age=60)
+        first = allocator.next_id()
+        with self.assertNumQueries(0):
+            ids = [allocator.next_id() for _ in range(9)]
+        self.assertEqual(ids, list(range(first + 1, first + 10)))
+        self.assertEqual(allocator.remaining(), 0)
+
+    def test_keeps_broadcast_timestamp(self):
+        message = self.message(self.writer.ids.next_id())
+        self.writer._write([message])
+        self.assertEqual(Message.objects.get(id=message.id).timestamp, message.timestamp)
+
+    def test_taken_id_is_set_aside(self):
+        allocator = MessageIdAllocator()
+        message_id = allocator.next_id()
+        Message.objects.create(id=message_id, sender=self.bob, chat_room=self.room, content='inserted elsewhere')
+        message = self.message(message_id)
+        other = self.message(allocator.next_id())
+        self.writer._write([message, other])
+        # Clients have it under this id, it is never moved to another one
+        self.assertEqual(message.id, message_id)
+        self.assertEqual(Message.objects.get(id=message_id).content, 'inserted elsewhere')
+        self.assertTrue(Message.objects.filter(id=other.id).exists())
+        self.assertEqual([m.id for m in self.writer.failed.read()], [message_id])
+
+    def test_retries_while_database_is_unavailable(self):
+        self.writer.interval = 0
+        insert = self.writer._insert
+        calls = []
+
+        def flaky_insert(batch):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                raise OperationalError('connection refused')
+            insert(batch)
+
+        message = self.message(self.writer.ids.next_id())
+        with mock.patch.object(self.writer, '_insert', flaky_insert), mock.patch('securechatapp.writebehind.connection.close'):
+            self.assertTrue(self.writer._store([message]))
+        self.assertEqual(calls, [1, 1])
+        self.assertTrue(Message.objects.filter(id=message.id).exists())
+
+    def test_stopped_writer_leaves_batch_in_spool(self):
+        self.writer._stop.set()
+        with mock.patch.object(self.writer, '_insert', side_effect=OperationalError('connection refused')), \
+                mock.patch('securechatapp.writebehind.connection.close'):
+            self.assertFalse(self.writer._store([self.message(self.writer.ids.next_id())]))
+
+    def test_replay_spool(self):
+        inserted = Message.objects.create(sender=self.alice, chat_room=self.room, payload=b'\x02inserted')
+        taken = Message.objects.create(sender=self.bob, chat_room=self.room, content='inserted elsewhere')
+        fresh = self.message(taken.id + 1)
+        clashing = self.message(taken.id)
+        # Left behind by an earlier process
+        earlier = MessageSpool(self.spool_path, fsync=False)
+        for message in (inserted, fresh, clashing):
+            earlier.append(message)
+        earlier.close()
+
+        self.writer._replay_spool()
+        self.assertEqual(Message.objects.filter(payload=b'\x02inserted').count(), 1)
+        self.assertEqual(Message.objects.get(id=fresh.id).timestamp, fresh.timestamp)
+        self.assertEqual(Message.objects.get(id=taken.id).content, 'inserted elsewhere')
+        self.assertEqual([m.id for m in self.writer.failed.read()], [taken.id])
+        self.assertEqual(os.path.getsize(self.spool_path), 0)
+
+
+class SocketDirTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'securechat', 'channels.sock')
+
+    def test_creates_private_dir(self):
+        make_socket_dir(self.path)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(self.path)).st_mode), 0o700)
+
+    def test_refuses_shared_dirs(self):
+        os.mkdir(os.path.dirname(self.path), 0o755)
+        os.chmod(os.path.dirname(self.path), 0o755)
+        with self.assertRaises(PermissionError):
+            make_socket_dir(self.path)
+        with self.assertRaises(PermissionError):
+            asyncio.run(ChannelBroker(os.path.join(tempfile.gettempdir(), 'channels.sock')).serve_forever())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_refuses_dirs_of_other_users(self):
+        make_socket_dir(self.path)
+        with mock.patch('securechatapp.unixlayer.os.getuid', return_value=os.getuid() + 1):
+            with self.assertRaises(PermissionError):
+                check_socket_dir(self.path)
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        create_members(self)
+        self.registry = PresenceRegistry()
+        patcher = mock.patch.object(self.registry, '_ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_online_until_last_socket_closes(self):
+        self.assertTrue(self.registry.connect(self.alice.id, 'alice', self.room.id))
+        self.assertFalse(self.registry.connect(self.alice.id, 'alice', self.room.id))
+        self.assertEqual(self.registry.online_in_room(self.room.id), ['alice'])
+        self.assertFalse(self.registry.disconnect(self.alice.id, 'alice', self.room.id))
+        self.assertTrue(self.registry.is_online(self.alice.id))
+        self.assertTrue(self.registry.disconnect(self.alice.id, 'alice', self.room.id))
+        self.assertFalse(self.registry.is_online(self.alice.id))
+        self.assertEqual(self.registry.online_in_room(self.room.id), [])
+
+    def test_flush_writes_latest_state_once(self):
+        self.registry.connect(self.alice.id, 'alice', self.room.id)
+        self.registry.connect(self.bob.id, 'bob', self.room.id)
+        self.registry.disconnect(self.bob.id, 'bob', self.room.id)
+        self.assertEqual(self.registry.flush(), 2)
+        self.assertEqual(dict(CustomUser.objects.values_list('username', 'is_online')), {'alice': True, 'bob': False})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.flush(), 0)
+
+
+class FrameTests(SimpleTestCase):
+    frame = {
+        'type': 'chat_message',
+        'message': {'id': 7, 'sender': 'alice', 'content': 'hi', 'is_read': False, 'chat_room': 1},
+        'not_coded': [1, {'type': 'unknown-type'}],
+    }
+
+    def test_broadcast_is_encoded_once(self):
+        event = frames.broadcast({'type': 'read_watermark', 'room_id': 3}, {'type': 'read-watermark', 'message_id': 5})
+        self.assertEqual(json.loads(event['frame']), {'type': 'read-watermark', 'message_id': 5, 'room': 3})
+        # Receivers send the encoded text as is
+        self.assertIs(frames.frame_text(event, lambda: self.fail("frame built again")), event['frame'])
+        self.assertEqual(frames.frame_text({}, lambda: {'type': 'online'}), frames.encode({'type': 'online'}))
+
+    def test_batches(self):
+        codecs = dict(frames.load_binary_codecs(['securechat.msgpack', 'securechat.cbor']), json=frames.json_codec)
+        for name, codec in codecs.items():
+            with self.subTest(codec=name):
+                batch = codec.batch([codec.encode(self.frame), codec.encode({'type': 'writing-indicator'})])
+                self.assertEqual(codec.decode(batch),
+                                 {'type': 'batch', 'frames': [self.frame, {'type': 'writing-indicator'}]})
+
+    def test_binary_codecs(self):
+        codecs = frames.load_binary_codecs(['securechat.msgpack', 'securechat.cbor'])
+        if not codecs:
+            self.skipTest("Neither msgpack nor cbor2 is installed")
+        for name, codec in codecs.items():
+            with self.subTest(codec=name):
+                encoded = codec.encode(self.frame)
+                self.assertLess(len(encoded), len(frames.json_codec.encode(self.frame)))
+                self.assertEqual(codec.decode(encoded), self.frame)
+                self.assertEqual(codec.decode(codec.encode({'type': 'chunk', 'data': b'\x00\xff'})),
+                                 {'type': 'chunk', 'data': b'\x00\xff'})
+
+    def test_negotiate(self):
+        self.assertIs(frames.negotiate(['graphql-ws', 'unknown']), frames.json_codec)
+        self.assertIs(frames.negotiate(None), frames.json_codec)
+        for name, codec in frames.binary_codecs.items():
+            self.assertIs(frames.negotiate(['graphql-ws', name]), codec)
+
+    def test_broadcast_encodes_other_protocols_on_receipt(self):
+        codecs = frames.load_binary_codecs(['securechat.msgpack', 'securechat.cbor'])
+        if not codecs:
+            self.skipTest("Neither msgpack nor cbor2 is installed")
+        event = frames.broadcast({'type': 'read_watermark', 'room_id': 3}, {'type': 'read-watermark', 'message_id': 5})
+        self.assertNotIn('binary_frames', event)
+        for name, codec in codecs.items():
+            with self.subTest(codec=name):
+                encoded = frames.event_frame(event, codec, lambda: {'type': 'read-watermark', 'message_id': 5})
+                self.assertEqual(codec.decode(encoded), {'type': 'read-watermark', 'message_id': 5, 'room': 3})
+
+
+class MultiplexTests(TransactionTestCase):
+    def setUp(self):
+        create_members(self)
+        self.consumer = MultiplexConsumer()
+        self.consumer.scope = {'user': self.bob}
+        self.consumer.sessions = {}
+        self.sent = []
+
+        async def send_frame(frame, message_id=None):
+            self.sent.append(frame)
+        self.consumer.send_frame = send_frame
+
+    def test_memberships(self):
+        group = ChatRoom.objects.create(name='group', is_group=True)
+        ChatRoomMembership.objects.create(user=self.alice, chat_room=group)
+        ChatRoomMembership.objects.create(user=self.bob, chat_room=group)
+        ChatRoomMembership.objects.create(user=self.alice, chat_room=ChatRoom.objects.create(name='alice only'))
+        asyncio.run(self.consumer.load_memberships())
+        self.assertEqual(self.consumer.memberships, {self.room.id: (False, ['alice']), group.id: (True, ['alice'])})
+
+    def test_subscribe_refuses_other_rooms(self):
+        other = ChatRoom.objects.create(name='elsewhere')
+        ChatRoomMembership.objects.create(user=self.alice, chat_room=other)
+
+        async def subscribe():
+            await self.consumer.load_memberships()
+            await self.consumer.subscribe(other.id)
+        asyncio.run(subscribe())
+        self.assertEqual(self.sent, [{'type': 'subscribe-error', 'room': other.id, 'message': "Not a member of this room"}])
+        self.assertEqual(self.consumer.sessions, {})
+
+
+class FakeSocket:
+    codec = frames.json_codec
+    channel_name = 'test'
+
+    def __init__(self, fail_sends=0):
+        self.sent = []
+        self.closed = None
+        self.fail_sends = fail_sends
+
+    async def send(self, text_data=None, bytes_data=None):
+        if self.fail_sends:
+            self.fail_sends -= 1
+            raise ConnectionResetError('connection reset')
+        self.sent.append(json.loads(text_data))
+
+    async def close(self, code=None):
+        self.closed = code
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def put(self, queue, frame, message_id=None):
+        queue.put(frames.json_codec.encode(frame), frame['type'], (1, message_id) if message_id else None)
+
+    async def test_frames_written_together_are_batched(self):
+        socket = FakeSocket()
+        queue = OutboundQueue(socket, batch=True)
+        for message_id in (1, 2, 3):
+            self.put(queue, {'type': 'chat_message', 'id': message_id}, message_id)
+        await asyncio.sleep(0.01)
+        queue.stop()
+        self.assertEqual(socket.sent, [{'type': 'batch', 'frames': [
+            {'type': 'chat_message', 'id': 1}, {'type': 'chat_message', 'id': 2}, {'type': 'chat_message', 'id': 3},
+        ]}])
+        self.assertEqual(queue.written, {1: 3})
+
+    @override_settings(OUTBOUND_QUEUE_MAX_FRAMES=3)
+    async def test_slow_consumer(self):
+        socket = FakeSocket()
+        queue = OutboundQueue(socket)
+        self.put(queue, {'type': 'writing-indicator'})
+        self.put(queue, {'type': 'chat_message', 'id': 1}, 1)
+        self.put(queue, {'type': 'chat_message', 'id': 2}, 2)
+        # Full: typing frames go first
+        self.put(queue, {'type': 'chat_message', 'id': 3}, 3)
+        self.assertEqual((queue.depth, queue.dropped), (3, 1))
+        # Nothing left to drop, the client is told where to resume
+        self.put(queue, {'type': 'chat_message', 'id': 4}, 4)
+        await asyncio.sleep(0.01)
+        self.assertEqual(socket.sent, [{
+            'type': 'slow-consumer',
+            'message': "Too far behind, reconnect and resume from these messages.",
+            'resume': [],
+        }])
+        self.assertEqual(socket.closed, SLOW_CONSUMER_CLOSE_CODE)
+
+    async def test_write_error_closes_socket(self):
+        socket = FakeSocket(fail_sends=1)
+        queue = OutboundQueue(socket)
+        self.put(queue, {'type': 'chat_message', 'id': 1}, 1)
+        self.put(queue, {'type': 'chat_message', 'id': 2}, 2)
+        await asyncio.sleep(0.01)
+        self.assertEqual(socket.closed, WRITE_ERROR_CLOSE_CODE)
+        self.assertTrue(queue._writer.done())
+        # Nothing is queued for a socket that is going away
+        self.put(queue, {'type': 'chat_message', 'id': 3}, 3)
+        self.assertEqual((socket.sent, queue.depth), ([], 0))
+
+
+class KeyDirectoryTests(TestCase):
+    def setUp(self):
+        create_members(self)
+        self.directory = KeyDirectory()
+
+    def test_cached_after_first_lookup(self):
+        with self.assertNumQueries(1):
+            entry = self.directory.get('alice')
+        with self.assertNumQueries(0):
+            self.assertIs(self.directory.get('alice'), entry)
+            self.assertIs(self.directory.get_id(self.alice.id), entry)
+        self.assertEqual(entry.public_key, EncryptionKey.objects.get(user=self.alice).public_key)
+
+    def test_warm_room_loads_members_at_once(self):
+        with self.assertNumQueries(1):
+            self.directory.warm_room(self.room.id)
+        with self.assertNumQueries(0):
+            self.assertEqual({self.directory.get('alice').user_id, self.directory.get('bob').user_id},
+                             {self.alice.id, self.bob.id})
+
+    def test_rename_drops_old_username(self):
+        key_directory.get('alice')
+        self.alice.username = 'alicia'
+        self.alice.save()
+        self.assertIsNone(key_directory.cached('alice'))
+        self.assertEqual(key_directory.get('alicia').user_id, self.alice.id)
+
+
+class AuthCacheTests(TransactionTestCase):
+    def setUp(self):
+        create_members(self)
+        self.cache = AuthCache()
+
+    def test_token_decoded_once(self):
+        decode = mock.Mock(return_value={'user_id': str(self.alice.id), 'exp': time.time() + 60})
+        self.assertEqual(self.cache.user_id_for('token', decode), self.alice.id)
+        self.assertEqual(self.cache.user_id_for('token', decode), self.alice.id)
+        self.assertEqual(decode.call_count, 1)
+        # Expired tokens are not remembered
+        decode.return_value = {'user_id': self.alice.id, 'exp': time.time() - 1}
+        self.cache.user_id_for('expired', decode)
+        self.cache.user_id_for('expired', decode)
+        self.assertEqual(decode.call_count, 3)
+
+    def test_concurrent_handshakes_share_a_lookup(self):
+        async def handshakes():
+            return await asyncio.gather(*[self.cache.get_user(self.alice.id) for _ in range(5)])
+
+        with mock.patch.object(self.cache, '_load', wraps=self.cache._load) as load:
+            users = asyncio.run(handshakes())
+            self.assertEqual({user.id for user in users}, {self.alice.id})
+            self.assertEqual(load.call_count, 1)
+            asyncio.run(self.cache.get_user(self.alice.id))
+            self.assertEqual(load.call_count, 1)
+
+    def test_saved_user_is_dropped(self):
+        asyncio.run(auth_cache.get_user(self.alice.id))
+        self.assertIsNotNone(auth_cache.users.get(self.alice.id))
+        self.alice.save()
+        self.assertIsNone(auth_cache.users.get(self.alice.id))
+
+
+class IncrementalSyncTests(TransactionTestCase):
+    def setUp(self):
+        create_members(self)
+        key_directory.clear()
+        self.keys = dict(EncryptionKey.objects.values_list('user_id', 'public_key'))
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {'user': self.bob, 'url_route': {'kwargs': {'chatwithusername': 'alice'}}}
+
+    def send(self, sender, recipient, content, **fields):
+        payload = EncryptionManager.encrypt_message(content, self.keys[recipient.id], recipient.id)
+        return Message.objects.create(sender=sender, chat_room=self.room, payload=payload, **fields).id
+
+    def sync(self, since):
+        return asyncio.run(self.consumer.fetch_sync(self.room.id, since))
+
+    def test_newer_messages_and_undelivered(self):
+        first = self.send(self.alice, self.bob, 'one', is_delivered=True)
+        own = self.send(self.bob, self.alice, 'two')
+        Message.objects.create(sender=self.alice, chat_room=self.room, payload=b'\x09broken')
+        newer = self.send(self.alice, self.bob, 'three')
+        ReadWatermark.objects.create(user=self.alice, chat_room=self.room, last_read_message_id=own)
+        sync = self.sync(own)
+        self.assertEqual([(m['id'], m['sender'], m['content']) for m in sync['messages']], [(newer, 'alice', 'three')])
+        self.assertEqual(sync['undelivered'], [own])
+        self.assertEqual(sync['read_watermarks'], [{'sender': 'alice', 'message_id': own}])
+        self.assertEqual(self.sync(first)['undelivered'], [])
+
+    def test_newer_by_timestamp_not_id(self):
+        # A worker with an older id block stored a message sent after since
+        late = self.send(self.alice, self.bob, 'late')
+        since = self.send(self.alice, self.bob, 'since')
+        Message.objects.filter(id=late).update(timestamp=timezone.now() + timedelta(seconds=1))
+        self.assertEqual([m['id'] for m in self.sync(since)['messages']], [late])
+        self.assertEqual(self.sync(late)['messages'], [])
+
+    def test_falls_back_to_full_page(self):
+        since = self.send(self.alice, self.bob, 'one')
+        other_room = ChatRoom.objects.create(name='elsewhere')
+        elsewhere = Message.objects.create(sender=self.alice, chat_room=other_room, content='{}').id
+        self.assertIsNone(self.sync(elsewhere))
+        self.assertIsNone(self.sync(elsewhere + 1000))
+        self.send(self.alice, self.bob, 'two')
+        self.send(self.alice, self.bob, 'three')
+        with override_settings(CHAT_SYNC_MAX_MESSAGES=1):
+            self.assertIsNone(self.sync(since))
+            own = [self.send(self.bob, self.alice, 'mine') for _ in range(2)]
+            self.assertIsNone(self.sync(own[-1]))
+
+
+@override_settings(JWT_STATELESS_USER=True)
+class StatelessUserTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(email='alice@example.com', username='alice', password='secret')
+        token_versions.versions.clear()
+
+    def authenticate(self, token):
+        request = RequestFactory().get('/api/user', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return JWTAuthFromCookie().authenticate(request)[0]
+
+    def token(self, user):
+        return EmailTokenObtainPairSerializer.get_token(user).access_token
+
+    def test_claims(self):
+        token = add_user_claims({}, self.alice)
+        self.assertEqual(token, {'username': 'alice', 'is_active': True, 'tv': self.alice.token_version})
+        access = EmailTokenObtainPairSerializer.get_token(self.alice).access_token
+        self.assertEqual((access['username'], access['tv']), ('alice', self.alice.token_version))
+
+    def test_answers_claims_without_queries(self):
+        token = self.token(self.alice)
+        self.authenticate(token)
+        with self.assertNumQueries(0):
+            user = self.authenticate(token)
+            self.assertEqual((user.id, user.pk, user.username, user.is_active), (self.alice.id, self.alice.id, 'alice', True))
+            self.assertTrue(user.is_authenticated)
+            self.assertIsInstance(user, CustomUser)
+            self.assertEqual(user, self.alice)
+            ChatRoomMembership.objects.filter(user=user)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'alice@example.com')
+            self.assertEqual(user.fullname, '')
+
+    def test_revoked_tokens_are_rejected(self):
+        for revoke in (lambda user: user.revoke_tokens(), lambda user: user.change_password('changed')):
+            user = CustomUser.objects.get(id=self.alice.id)
+            old_token = self.token(user)
+            self.assertEqual(self.authenticate(old_token).id, self.alice.id)
+            revoke(user)
+            with self.assertRaisesMessage(AuthenticationFailed, "Token has been revoked"):
+                self.authenticate(old_token)
+            self.assertEqual(self.authenticate(self.token(user)).id, self.alice.id)
+        self.assertTrue(CustomUser.objects.get(id=self.alice.id).check_password('changed'))
+
+    def test_hash_upgrade_keeps_tokens_valid(self):
+        token = self.token(self.alice)
+        user = CustomUser.objects.get(id=self.alice.id)
+        # What check_password() does when the hasher changed
+        user.set_password('secret')
+        user.save(update_fields=['password'])
+        self.assertEqual(self.authenticate(token).id, self.alice.id)
+
+    def test_inactive_users_are_rejected(self):
+        self.alice.is_active = False
+        self.alice.save()
+        with self.assertRaisesMessage(AuthenticationFailed, "User is inactive"):
+            self.authenticate(self.token(self.alice))
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from securechatapp import frames
+from securechatapp.metrics import metrics
+
+
+class TypingState:
+    __slots__ = ('is_typing', 'expires_at', 'forwarded_at', 'forwarded_state')
+
+    def __init__(self):
+        self.is_typing = False
+        self.expires_at = 0.0
+        self.forwarded_at = 0.0
+        self.forwarded_state = False
+
+
+class TypingTracker:
+    """
+    Process-wide typing state per (room, user). Keystroke frames only update
+    the state, the room hears about it when the state differs from what was
+    last forwarded, at most once per TYPING_INDICATOR_INTERVAL per user.
+    Typing that gets no update for TYPING_INDICATOR_TTL seconds expires and
+    is forwarded as stopped by a sweeper task.
+    """
+
+    def __init__(self, interval=None, ttl=None):
+        self.interval = interval if interval is not None else getattr(settings, 'TYPING_INDICATOR_INTERVAL', 2.0)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'TYPING_INDICATOR_TTL', 6.0)
+        self._rooms = {}
+        self._sweeper = None
+
+    def update(self, room_id, username, is_typing, now=None):
+        """Record a typing frame, returns True when it should be forwarded now"""
+        now = time.monotonic() if now is None else now
+        metrics.incr('typing.received')
+        state = self._rooms.setdefault(room_id, {}).get(username)
+        if state is None:
+            state = self._rooms[room_id][username] = TypingState()
+        state.is_typing = is_typing
+        if is_typing:
+            state.expires_at = now + self.ttl
+        return self._take_forward(state, now)
+
+    def _take_forward(self, state, now):
+        if now - state.forwarded_at < self.interval:
+            return False
+        if state.is_typing == state.forwarded_state and not state.is_typing:
+            return False
+        # A still-typing user is re-forwarded once per interval as a keepalive
+        state.forwarded_at = now
+        state.forwarded_state = state.is_typing
+        metrics.incr('typing.forwarded')
+        return True
+
+    def sweep(self, now=None):
+        """
+        Expire stale typing state and release changes held back by the
+        interval. Returns (room_id, username, is_typing) events to forward.
+        """
+        now = time.monotonic() if now is None else now
+        events = []
+        for room_id, users in list(self._rooms.items()):
+            for username, state in list(users.items()):
+                if state.is_typing and state.expires_at <= now:
+                    state.is_typing = False
+                if state.is_typing != state.forwarded_state and self._take_forward(state, now):
+                    events.append((room_id, username, state.is_typing))
+                if not state.is_typing and not state.forwarded_state and now - state.forwarded_at >= self.interval:
+                    del users[username]
+            if not users:
+                del self._rooms[room_id]
+        return events
+
+    def is_typing(self, room_id, username):
+        state = self._rooms.get(room_id, {}).get(username)
+        return bool(state and state.is_typing)
+
+    def ensure_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep_forever())
+
+    async def _sweep_forever(self):
+        channel_layer = get_channel_layer()
+        tick = max(0.1, min(self.interval, self.ttl) / 2)
+        while self._rooms:
+            await asyncio.sleep(tick)
+            for room_id, username, is_typing in self.sweep():
+                try:
+                    await channel_layer.group_send(f'chat_{room_id}', typing_event(room_id, username, is_typing))
+                except Exception as e:
+                    print(f"Error forwarding typing state: {e}")
+
+
+def typing_event(room_id, username, is_typing):
+    message = f"{username} is typing..." if is_typing else f"{username} stopped typing"
+    return frames.broadcast({
+        'type': 'writing_indicator',
+        'message': message,
+        'sender': username,
+        'is_typing': is_typing,
+        'room_id': room_id,
+    }, {
+        'type': 'writing-indicator',
+        'message': message,
+        'sender': username,
+        'is_typing': is_typing,
+    })
+
+typing_tracker = TypingTracker()
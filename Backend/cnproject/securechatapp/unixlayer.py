@@ -0,0 +1,294 @@
+"""
+Channel layer shared by the workers on one host through a broker process.
+
+    python manage.py run_channel_broker
+
+The broker holds an InMemoryChannelLayer, so capacity, expiry and group
+semantics are the same as in a single process. Workers connect with
+UnixSocketChannelLayer over a Unix domain socket. Frames are a u32 length
+followed by a marshal-encoded tuple, and all frames produced in one event
+loop iteration go out in a single write. marshal is only safe between
+trusted peers, so the socket lives in a directory only the app user can
+reach: securechat/ under $XDG_RUNTIME_DIR, or under run/ in the project
+when that is not set. The broker creates it 0700, and neither side uses a
+socket directory that another user owns or can get into.
+"""
+import asyncio
+import itertools
+import marshal
+import os
+import random
+import stat
+import string
+import struct
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from django.conf import settings
+
+_LENGTH = struct.Struct('>I')
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(getattr(settings, 'BASE_DIR', os.getcwd()), 'run')
+    return os.path.join(runtime_dir, 'securechat', 'channels.sock')
+
+
+def check_socket_dir(path):
+    """Raise PermissionError unless the socket's directory is private to the current user"""
+    directory = os.path.dirname(os.path.abspath(path))
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"Socket directory {directory} is not a directory")
+    if info.st_uid != os.getuid():
+        raise PermissionError(f"Socket directory {directory} is owned by another user")
+    if info.st_mode & 0o077:
+        raise PermissionError(f"Socket directory {directory} is open to other users, it must be mode 0700")
+
+
+def make_socket_dir(path):
+    """Create the socket's directory 0700 if it is missing, then check it"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+    check_socket_dir(path)
+
+
+class FrameWriter:
+    """Queues frames and writes everything queued in one loop iteration at once"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._frames = []
+
+    def write(self, *frame):
+        data = marshal.dumps(frame)
+        if not self._frames:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._frames.append(_LENGTH.pack(len(data)))
+        self._frames.append(data)
+
+    def _flush(self):
+        frames, self._frames = self._frames, []
+        if not self.writer.is_closing():
+            self.writer.write(b''.join(frames))
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(_LENGTH.size)
+    return marshal.loads(await reader.readexactly(_LENGTH.unpack(header)[0]))
+
+
+class ChannelBroker:
+    """Serves an InMemoryChannelLayer to worker processes over a Unix socket"""
+
+    def __init__(self, path=None, **layer_config):
+        self.path = path or default_socket_path()
+        self.layer = InMemoryChannelLayer(**layer_config)
+        self.connections = 0
+
+    async def serve_forever(self):
+        # Refuses to start in a directory others can reach, nobody else can get at the socket
+        make_socket_dir(self.path)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        out = FrameWriter(writer)
+        receives = {}
+        try:
+            while True:
+                op, request_id, *args = await read_frame(reader)
+                if op == 'receive':
+                    task = asyncio.ensure_future(self.layer.receive(args[0]))
+                    receives[request_id] = task
+                    task.add_done_callback(lambda task, request_id=request_id: self._received(out, receives, request_id, task))
+                elif op == 'cancel':
+                    task = receives.pop(args[0], None)
+                    if task is not None:
+                        task.cancel()
+                elif op == 'group_send':
+                    # No reply, a full channel in the group is skipped like in-process
+                    await self.layer.group_send(*args)
+                else:
+                    await self._call(out, op, request_id, args)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            for task in receives.values():
+                task.cancel()
+            writer.close()
+
+    async def _call(self, out, op, request_id, args):
+        try:
+            if op == 'send':
+                await self.layer.send(*args)
+            elif op == 'group_add':
+                await self.layer.group_add(*args)
+            elif op == 'group_discard':
+                await self.layer.group_discard(*args)
+            elif op == 'flush':
+                await self.layer.flush()
+            else:
+                raise ValueError(f"Unknown operation {op}")
+            out.write('ok', request_id)
+        except ChannelFull:
+            out.write('full', request_id)
+        except Exception as e:
+            out.write('error', request_id, str(e))
+
+    def _received(self, out, receives, request_id, task):
+        receives.pop(request_id, None)
+        if not task.cancelled() and task.exception() is None:
+            out.write('message', request_id, task.result())
+
+
+class BrokerConnection:
+    """One worker event loop's connection to the broker"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.out = FrameWriter(writer)
+        self.pending = {}
+        # Messages that arrived for a receive() that was cancelled meanwhile
+        self.abandoned = {}
+        self.leftovers = {}
+        self.request_ids = itertools.count()
+        self.reader_task = asyncio.ensure_future(self._read())
+
+    def request(self, op, *args):
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.out.write(op, request_id, *args)
+        return request_id, future
+
+    def notify(self, op, *args):
+        self.out.write(op, None, *args)
+
+    @property
+    def closed(self):
+        return self.reader_task.done()
+
+    async def _read(self):
+        try:
+            while True:
+                reply, request_id, *args = await read_frame(self.reader)
+                channel = self.abandoned.pop(request_id, None)
+                if channel is not None:
+                    self.leftovers.setdefault(channel, []).append(args[0])
+                    continue
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((reply, args))
+        except asyncio.CancelledError:
+            error = "connection closed"
+        except Exception as e:
+            error = e
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Lost connection to the channel broker: {error}"))
+        self.pending.clear()
+
+    def close(self):
+        self.reader_task.cancel()
+        self.out.writer.close()
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer client for ChannelBroker. Capacity and expiry are enforced
+    by the broker; its settings come from the run_channel_broker options.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path=None, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = path or default_socket_path()
+        self._connections = {}
+        self._connecting = {}
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is not None and not connection.closed:
+            return connection
+        for closed in [other for other in self._connections if other.is_closed()]:
+            del self._connections[closed]
+            self._connecting.pop(closed, None)
+        # Concurrent first calls on a loop share one connection
+        async with self._connecting.setdefault(loop, asyncio.Lock()):
+            connection = self._connections.get(loop)
+            if connection is None or connection.closed:
+                # Whoever controls the directory could stand in for the broker
+                check_socket_dir(self.path)
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                connection = self._connections[loop] = BrokerConnection(reader, writer)
+        return connection
+
+    async def _call(self, op, *args):
+        connection = await self._connection()
+        _, future = connection.request(op, *args)
+        reply, args = await future
+        if reply == 'error':
+            raise RuntimeError(f"Channel broker: {args[0]}")
+        return reply
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if await self._call('send', channel, message) == 'full':
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        connection = await self._connection()
+        leftovers = connection.leftovers.get(channel)
+        if leftovers:
+            message = leftovers.pop(0)
+            if not leftovers:
+                del connection.leftovers[channel]
+            return message
+        request_id, future = connection.request('receive', channel)
+        try:
+            _, args = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Delivered just as we were cancelled, keep it for the next receive()
+                connection.leftovers.setdefault(channel, []).append(future.result()[1][0])
+            else:
+                # A message already on its way is kept the same way
+                connection.pending.pop(request_id, None)
+                connection.abandoned[request_id] = channel
+                connection.notify('cancel', request_id)
+            raise
+        return args[0]
+
+    async def new_channel(self, prefix='specific.'):
+        return '%sunix!%s' % (prefix, ''.join(random.choice(string.ascii_letters) for _ in range(12)))
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._call('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._call('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        (await self._connection()).notify('group_send', group, message)
+
+    async def flush(self):
+        await self._call('flush')
+
+    async def close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
@@ -13,4 +13,5 @@ urlpatterns = [
     path('user', views.User.as_view(), name='User'),
     path('chatroom', views.chatRoomView.as_view(), name='ChatRoom'),
     path('chat/username', views.get_username_for_chatroom, name='get_username_for_chatroom'),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -5,13 +5,17 @@ from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken, TokenError
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from securechatapp.serializer import EmailTokenObtainPairSerializer
 from securechatapp.models import CustomUser, ChatRoomMembership, ChatRoom, Message, TypingIndicator, EncryptionKey
 from securechatapp.serializer import CustomUserSerializer, ChatRoomMembershipSerializer, MessageSerializer, ChatRoomSerializer
 from django.shortcuts import get_object_or_404
-from django.db.models import Count
-from rest_framework.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import ValidationError, AuthenticationFailed
+from securechatapp.metrics import metrics
+from securechatapp.receipts import with_unread_counts
+from securechatapp.authenticate import check_token_version
+from django.conf import settings
 
 User = get_user_model()
 
@@ -64,7 +68,14 @@ class CookieTokenRefreshView(APIView):
 
         try:
             token = RefreshToken(refresh_token)
-            access_token = str(token.access_token)
+            access = token.access_token
+            if getattr(settings, 'JWT_STATELESS_USER', False) and 'tv' in token:
+                # Revoked refresh tokens stop here, and the claims get the current row
+                try:
+                    _, access['is_active'], access['username'] = check_token_version(int(token['user_id']), token['tv'])
+                except AuthenticationFailed as e:
+                    return Response({'error': str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+            access_token = str(access)
 
             response = Response({'message': 'Token refreshed'}, status=status.HTTP_200_OK)
             response.set_cookie(
@@ -83,6 +94,9 @@ class CookieTokenRefreshView(APIView):
 
 class LogoutView(APIView):
     def post(self, request):
+        if request.data.get('everywhere') and request.user.is_authenticated:
+            # Revokes every token of the user, not just the cookies of this browser
+            request.user.revoke_tokens()
         logout(request)
         response = Response({'message': 'Logged out successfully.'}, status=status.HTTP_200_OK)
         response.delete_cookie('access_token')
@@ -190,13 +204,16 @@ class chatRoomView(APIView):
             chat_rooms_user = ChatRoomMembership.objects.filter(user=user)
             chat_rooms_user_ids = chat_rooms_user.values_list('chat_room_id', flat=True)
             chat_rooms = ChatRoom.objects.filter(id__in=chat_rooms_user_ids).order_by('-created_at')
-            for room in chat_rooms:
-                room.members = room.memberships.values_list('user__username', flat=True)
-            if not chat_rooms.exists():
+            # Unread counts come from the user's read watermarks, in the same query
+            chat_rooms = list(with_unread_counts(chat_rooms, user))
+            if not chat_rooms:
                 return Response({'message': 'No chat rooms found'}, status=status.HTTP_404_NOT_FOUND)
             serializer = ChatRoomSerializer(chat_rooms, many=True)
+            data = serializer.data
+            for room, room_data in zip(chat_rooms, data):
+                room_data['unread_count'] = room.unread_count
             
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            return Response(data, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
@@ -230,25 +247,31 @@ class chatRoomView(APIView):
             if(data.get('is_group') == True and ChatRoom.objects.filter(name=data.get('name')).exists()):
                 return Response({'error': 'Group chat with this name already exists.'}, status=status.HTTP_400_BAD_REQUEST)
             # Check if all user IDs exist
+            user_ids = dict(CustomUser.objects.filter(username__in=member_ids).values_list('username', 'id'))
             for username in member_ids:
-                if not CustomUser.objects.filter(username=username).exists():
+                if username not in user_ids:
                     return Response({'error': f'User with username {username} does not exist.'}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Check for existing chat room (non-group) with same members
-            possible_rooms = ChatRoom.objects.annotate(num_members=Count('memberships')).filter(num_members=len(member_ids))
-            for room in possible_rooms:
-                room_member_ids = sorted(room.memberships.values_list('user_id', flat=True))
-                if room_member_ids == sorted(member_ids) and data.get('is_group') == False:
-                    return Response({'error': 'You already have a chat room with this user(s).'}, status=status.HTTP_400_BAD_REQUEST)
+            # Check for existing chat room (non-group) with same members, one indexed lookup
+            member_key = ChatRoom.make_member_key(user_ids.values(), bool(data.get('is_group')))
+            if data.get('is_group') == False and ChatRoom.objects.filter(member_key=member_key, is_group=False).exists():
+                return Response({'error': 'You already have a chat room with this user(s).'}, status=status.HTTP_400_BAD_REQUEST)
 
             # Prepare members list for serializer
             data['members_input'] = [{'user': uid} for uid in member_ids]
             
             serializer = ChatRoomSerializer(data=data, context={'request': request})
             if serializer.is_valid():
-                chat_room = serializer.save()
-                for member_data in data['members_input']:
-                    ChatRoomMembership.objects.create(chat_room=chat_room, user_id=CustomUser.objects.get(username=member_data['user']).id)
+                try:
+                    with transaction.atomic():
+                        chat_room = serializer.save(member_key=member_key)
+                        ChatRoomMembership.objects.bulk_create([
+                            ChatRoomMembership(chat_room=chat_room, user_id=user_ids[member_data['user']])
+                            for member_data in data['members_input']
+                        ])
+                except IntegrityError:
+                    # Lost a race with a request creating the same direct room
+                    return Response({'error': 'You already have a chat room with this user(s).'}, status=status.HTTP_400_BAD_REQUEST)
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
 
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -272,7 +295,13 @@ class ChatRoomMembershipView(APIView):
         user = request.user
         chat_room_id = request.data.get('chat_room_id')
         chat_room = get_object_or_404(ChatRoom, id=chat_room_id)
-        membership, created = ChatRoomMembership.objects.get_or_create(user=user, chat_room=chat_room)
+        try:
+            with transaction.atomic():
+                membership, created = ChatRoomMembership.objects.get_or_create(user=user, chat_room=chat_room)
+                if created:
+                    chat_room.refresh_member_key()
+        except IntegrityError:
+            return Response({'message': 'You already have a chat room with these members'}, status=status.HTTP_400_BAD_REQUEST)
         if created:
             return Response({'message': 'Joined chat room successfully'}, status=status.HTTP_201_CREATED)
         return Response({'message': 'Already a member of this chat room'}, status=status.HTTP_400_BAD_REQUEST)
@@ -283,7 +312,14 @@ class ChatRoomMembershipView(APIView):
         chat_room = get_object_or_404(ChatRoom, id=chat_room_id)
         membership = ChatRoomMembership.objects.filter(user=user, chat_room=chat_room).first()
         if membership:
-            membership.delete()
+            with transaction.atomic():
+                membership.delete()
+                try:
+                    with transaction.atomic():
+                        chat_room.refresh_member_key()
+                except IntegrityError:
+                    # The remaining members already have a direct room, that one stays theirs
+                    ChatRoom.objects.filter(id=chat_room.id).update(member_key=None)
             return Response({'message': 'Left chat room successfully'}, status=status.HTTP_200_OK)
         return Response({'message': 'Not a member of this chat room'}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -376,4 +412,11 @@ def get_username_for_chatroom(request):
             'already_in_chat': shared_rooms
         })
 
-    return Response({'users': data}, status=status.HTTP_200_OK)
\ No newline at end of file
+    return Response({'users': data}, status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(metrics.snapshot(), status=status.HTTP_200_OK)
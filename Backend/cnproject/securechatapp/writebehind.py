@@ -0,0 +1,363 @@
+"""
+Write-behind persistence for chat messages.
+
+With MESSAGE_WRITE_BEHIND on, a message gets its id up front from
+MessageIdAllocator, is broadcast straight away and is inserted later by
+the MessageWriter thread in batches. Each message is appended to a local
+spool file first, so messages accepted before a crash are inserted when
+the next process starts. Every process needs its own spool path.
+
+Batches are retried while the database is unreachable and the spool is only
+trimmed once they are in. A message that can't be inserted at all, e.g.
+because its id is taken, is never given another id: clients already have
+it under this one. It is logged as an error and kept in <spool>.failed.
+
+Each worker hands out ids from its own block, so ids of different workers
+are not in send order. Blocks are dropped after MESSAGE_ID_BLOCK_MAX_AGE
+seconds, which bounds how far out of order they get. Read watermarks
+compare ids and can be off by that much; since=<message_id> sync goes by
+the timestamp of that message.
+"""
+import atexit
+import base64
+import json
+import os
+import queue
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DataError, DatabaseError, IntegrityError, InterfaceError, OperationalError, connection, transaction
+from django.utils.dateparse import parse_datetime
+from securechatapp.metrics import metrics
+
+
+class MessageIdAllocator:
+    """
+    Hands out Message ids from blocks of MESSAGE_ID_BLOCK_SIZE reserved in
+    one round trip, so a send only waits on the database when its block is
+    used up or older than MESSAGE_ID_BLOCK_MAX_AGE seconds. On PostgreSQL the
+    block comes from the table's own id sequence, so ids never clash with
+    rows inserted elsewhere. Other backends count up from the current
+    maximum id, which is only safe when nothing else inserts messages.
+    """
+
+    def __init__(self, block_size=None, max_age=None):
+        self.block_size = block_size or getattr(settings, 'MESSAGE_ID_BLOCK_SIZE', 100)
+        self.max_age = max_age if max_age is not None else getattr(settings, 'MESSAGE_ID_BLOCK_MAX_AGE', 1.0)
+        self._ids = []
+        self._reserved_at = 0.0
+        self._next_local = None
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """Ids left in the current block, 0 once it is too old to use"""
+        if time.monotonic() - self._reserved_at > self.max_age:
+            return 0
+        return len(self._ids)
+
+    def next_id(self):
+        """Next id, reserves a new block when the current one is used up or too old (hits the database)"""
+        with self._lock:
+            if not self.remaining():
+                self._ids = self._reserve(self.block_size)
+                self._ids.reverse()
+                self._reserved_at = time.monotonic()
+            return self._ids.pop()
+
+    def _reserve(self, count):
+        from securechatapp.models import Message
+
+        table = Message._meta.db_table
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                    [table, count],
+                )
+                return [row[0] for row in cursor.fetchall()]
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT MAX(id) FROM {connection.ops.quote_name(table)}")
+            # Skip past rows inserted elsewhere since the last block
+            self._next_local = max(self._next_local or 0, (cursor.fetchone()[0] or 0) + 1)
+        start = self._next_local
+        self._next_local += count
+        return list(range(start, start + count))
+
+
+class MessageSpool:
+    """Append-only file of messages not yet known to be in the database"""
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._pending = 0
+
+    def append(self, message):
+        record = json.dumps({
+            'id': message.id,
+            'sender_id': message.sender_id,
+            'chat_room_id': message.chat_room_id,
+            'payload': base64.b64encode(message.payload).decode() if message.payload is not None else None,
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+        })
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(record + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._pending += 1
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._file.tell():
+            # Start on a fresh line after a record torn by a crash
+            self._file.write('\n')
+
+    def committed(self, count):
+        """count spooled messages reached the database, truncate the file once all have"""
+        with self._lock:
+            self._pending -= count
+            if self._pending <= 0:
+                self._pending = 0
+                if self._file is None:
+                    self._open()
+                self._file.truncate(0)
+                self._file.seek(0)
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+
+    def read(self):
+        """Messages left by an earlier process. A torn last line is skipped."""
+        from securechatapp.models import Message
+
+        if not os.path.exists(self.path):
+            return []
+        messages = []
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                payload = record.pop('payload')
+                messages.append(Message(
+                    payload=base64.b64decode(payload) if payload is not None else None,
+                    timestamp=parse_datetime(record.pop('timestamp')),
+                    **record
+                ))
+        return messages
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class MessageWriter:
+    """
+    Background thread inserting queued messages with bulk_create, at most
+    MESSAGE_WRITE_BEHIND_MAX_BATCH per statement and at least every
+    MESSAGE_WRITE_BEHIND_INTERVAL seconds. The queue is bounded by
+    MESSAGE_WRITE_BEHIND_QUEUE_SIZE; when it is full, senders wait for room.
+    """
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'MESSAGE_WRITE_BEHIND', False)
+        self.interval = getattr(settings, 'MESSAGE_WRITE_BEHIND_INTERVAL', 0.05)
+        self.max_batch = getattr(settings, 'MESSAGE_WRITE_BEHIND_MAX_BATCH', 500)
+        self.queue = queue.Queue(getattr(settings, 'MESSAGE_WRITE_BEHIND_QUEUE_SIZE', 10000))
+        spool_path = getattr(settings, 'MESSAGE_WRITE_BEHIND_SPOOL', 'message_spool.log')
+        self.spool = MessageSpool(spool_path, getattr(settings, 'MESSAGE_WRITE_BEHIND_FSYNC', True)) if spool_path else None
+        self.failed = MessageSpool(spool_path + '.failed', self.spool.fsync) if spool_path else None
+        self.ids = MessageIdAllocator()
+        # Queued or in-flight messages by id, for updates that arrive before the insert
+        self._pending = {}
+        # Guards _pending, only held for dict operations so the event loop never waits on an insert
+        self._pending_lock = threading.Lock()
+        # Held while a batch is inserted
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._thread is None:
+            # Flush the queue on a clean shutdown instead of leaving it to the spool
+            atexit.register(self.stop)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write out everything queued and stop the thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.spool:
+            self.spool.close()
+
+    async def submit(self, message):
+        """Spool and queue a message that already has its id"""
+        self.start()
+        if self.spool:
+            await sync_to_async(self.spool.append, thread_sensitive=False)(message)
+        with self._pending_lock:
+            self._pending[message.id] = message
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            metrics.incr('writebehind.queue_full')
+            await sync_to_async(self.queue.put, thread_sensitive=False)(message)
+
+    def mark_delivered(self, message_ids, room_id, reader_id):
+        """
+        Apply a delivery receipt to messages that are not inserted yet. Call
+        before the UPDATE: a batch being inserted holds the lock, so its rows
+        exist by the time this returns.
+        """
+        with self._lock, self._pending_lock:
+            for message_id in message_ids:
+                message = self._pending.get(message_id)
+                if message is not None and message.chat_room_id == room_id and message.sender_id != reader_id:
+                    message.is_delivered = True
+
+    def newest_pending(self, room_id):
+        """Highest id of a room's messages that are not inserted yet, None if there are none"""
+        with self._pending_lock:
+            return max((message.id for message in self._pending.values() if message.chat_room_id == room_id), default=None)
+
+    def _take_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, batch):
+        """Insert a batch in one transaction, raises if any row can't be inserted"""
+        from securechatapp.models import Message
+
+        timestamps = [message.timestamp for message in batch]
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+                # bulk_create stamps auto_now_add fields with the insert time,
+                # keep the timestamps clients were sent
+                self._restore_timestamps(batch, timestamps)
+                Message.objects.bulk_update(batch, ['timestamp'])
+        except DatabaseError:
+            self._restore_timestamps(batch, timestamps)
+            raise
+
+    @staticmethod
+    def _restore_timestamps(batch, timestamps):
+        for message, timestamp in zip(batch, timestamps):
+            message.timestamp = timestamp
+
+    def _write(self, batch):
+        """Insert a batch, rows that are rejected on their own are set aside"""
+        try:
+            self._insert(batch)
+            return
+        except (IntegrityError, DataError):
+            pass
+        # One at a time to find the rejected rows
+        for message in batch:
+            try:
+                self._insert([message])
+            except (IntegrityError, DataError) as e:
+                self._set_aside(message, e)
+
+    def _set_aside(self, message, error):
+        # Already broadcast under this id, so it is not moved to another one
+        metrics.incr('writebehind.failed_messages')
+        print(f"ERROR: message {message.id} could not be stored and was set aside: {error}")
+        if self.failed:
+            self.failed.append(message)
+
+    def _store(self, batch):
+        """
+        Write a batch, retrying while the database is unreachable. Returns
+        False if the writer is stopped first, the batch then stays in the spool.
+        """
+        delay = self.interval
+        while True:
+            try:
+                with self._lock:
+                    self._write(batch)
+                return True
+            except (OperationalError, InterfaceError) as e:
+                connection.close()
+                if self._stop.is_set():
+                    print(f"Database unavailable while stopping, {len(batch)} messages left in the spool: {e}")
+                    return False
+                metrics.incr('writebehind.retries')
+                print(f"Database unavailable, retrying message batch in {delay:.2f}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    def _replay_spool(self):
+        from securechatapp.models import Message
+
+        messages = self.spool.read()
+        if messages:
+            print(f"Replaying {len(messages)} spooled messages")
+            for start in range(0, len(messages), self.max_batch):
+                batch = messages[start:start + self.max_batch]
+                # Rows inserted before the crash are skipped, a different
+                # message under the same id is rejected by _write()
+                existing = {
+                    row[0]: row[1:] for row in Message.objects.filter(id__in=[m.id for m in batch])
+                    .values_list('id', 'sender_id', 'chat_room_id', 'timestamp')
+                }
+                batch = [
+                    message for message in batch
+                    if existing.get(message.id) != (message.sender_id, message.chat_room_id, message.timestamp)
+                ]
+                if batch and not self._store(batch):
+                    return
+        self.spool.committed(0)
+
+    def _run(self):
+        try:
+            if self.spool:
+                self._replay_spool()
+        except Exception as e:
+            print(f"Error replaying message spool: {e}")
+            connection.close()
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self._take_batch()
+            if not batch:
+                continue
+            try:
+                if self._store(batch):
+                    metrics.incr('writebehind.flushes')
+                    metrics.incr('writebehind.messages', len(batch))
+                    if self.spool:
+                        self.spool.committed(len(batch))
+            except Exception as e:
+                # Not trimmed from the spool, inserted on the next start
+                print(f"ERROR: writing message batch failed, {len(batch)} messages left in the spool: {e}")
+                connection.close()
+            finally:
+                with self._pending_lock:
+                    for message in batch:
+                        self._pending.pop(message.id, None)
+
+
+message_writer = MessageWriter()
+metrics.register_gauge('writebehind.queued', message_writer.queue.qsize)
@@ -25,6 +25,9 @@ export function ChatContainer({ receiverUsername, currentUser, accessToken }: Ch
     isConnected,
     isReceiverOnline,
     isLoading,
+    hasMoreHistory,
+    isLoadingMore,
+    loadMoreHistory,
     sendMessage,
     setMessages,
     sendTypingIndicator
@@ -84,6 +87,9 @@ export function ChatContainer({ receiverUsername, currentUser, accessToken }: Ch
           initialMessages={messages} 
           roomId={chatRoom.id} 
           currentUser={currentUser}
+          hasMore={hasMoreHistory}
+          isLoadingMore={isLoadingMore}
+          onLoadMore={loadMoreHistory}
         />
       )}
       <ChatInput 
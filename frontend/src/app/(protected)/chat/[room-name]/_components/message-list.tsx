@@ -2,6 +2,7 @@
 
 import { useEffect, useRef, useState } from "react"
 import { ScrollArea } from "@/components/ui/scroll-area"
+import { Button } from "@/components/ui/button"
 import { Avatar, AvatarFallback, AvatarImage } from "@/components/ui/avatar"
 import type { Message, User } from "@/lib/types"
 import { getInitials, formatMessageTime } from "@/lib/utils"
@@ -11,9 +12,12 @@ interface MessageListProps {
   initialMessages: Message[]
   roomId: number
   currentUser: User
+  hasMore?: boolean
+  isLoadingMore?: boolean
+  onLoadMore?: () => void
 }
 
-export function MessageList({ initialMessages, roomId, currentUser }: MessageListProps) {
+export function MessageList({ initialMessages, roomId, currentUser, hasMore, isLoadingMore, onLoadMore }: MessageListProps) {
   const [messages, setMessages] = useState<Message[]>(initialMessages)
   const [typingUsers, setTypingUsers] = useState<string[]>([])
   const bottomRef = useRef<HTMLDivElement | null>(null)
@@ -22,9 +26,12 @@ export function MessageList({ initialMessages, roomId, currentUser }: MessageLis
     setMessages(initialMessages)
   }, [initialMessages])
 
+  // Only new messages at the bottom scroll, not older pages loaded at the top
+  const lastMessageId = messages[messages.length - 1]?.id
+
   useEffect(() => {
     bottomRef.current?.scrollIntoView({ behavior: "smooth" })
-  }, [messages, typingUsers])
+  }, [lastMessageId, typingUsers])
 
   const isMessageFromCurrentUser = (message: Message) => {
     return message.sender === currentUser.username
@@ -34,6 +41,14 @@ export function MessageList({ initialMessages, roomId, currentUser }: MessageLis
     <div className="flex-1 overflow-hidden">
       <ScrollArea className="h-full p-4">
         <div className="space-y-4">
+          {hasMore && (
+            <div className="flex justify-center">
+              <Button variant="ghost" size="sm" onClick={onLoadMore} disabled={isLoadingMore}>
+                {isLoadingMore ? "Loading..." : "Load older messages"}
+              </Button>
+            </div>
+          )}
+
           {messages.map((message, index) => {
             const isSentByCurrentUser = isMessageFromCurrentUser(message)
 
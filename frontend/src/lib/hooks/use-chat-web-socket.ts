@@ -1,5 +1,5 @@
 import { useState, useEffect } from "react";
-import { webSocketService } from "@/utils/web-socket";
+import { webSocketService, HistoryCursor } from "@/utils/web-socket";
 import { Message, User } from "@/lib/types";
 
 export function useChatWebSocket(receiverUsername: string, currentUser: User, accessToken: string) {
@@ -7,6 +7,9 @@ export function useChatWebSocket(receiverUsername: string, currentUser: User, ac
   const [messages, setMessages] = useState<Message[]>([]);
   const [isReceiverOnline, setIsReceiverOnline] = useState(false);
   const [isLoading, setIsLoading] = useState(true);
+  const [historyCursor, setHistoryCursor] = useState<HistoryCursor | null>(null);
+  const [hasMoreHistory, setHasMoreHistory] = useState(false);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
 
   useEffect(() => {
     if (!receiverUsername || !accessToken) return;
@@ -41,16 +44,30 @@ export function useChatWebSocket(receiverUsername: string, currentUser: User, ac
     });
 
     // Handle chat history
-    const chatHistoryUnsubscribe = webSocketService.onChatHistory((historyMessages) => {
+    const chatHistoryUnsubscribe = webSocketService.onChatHistory((historyMessages, cursor, hasMore) => {
       setMessages(historyMessages);
+      setHistoryCursor(cursor);
+      setHasMoreHistory(hasMore);
       setIsLoading(false);
     });
 
+    // Handle older pages requested with loadMoreHistory
+    const chatHistoryPageUnsubscribe = webSocketService.onChatHistoryPage((olderMessages, cursor, hasMore) => {
+      setMessages((prev) => [
+        ...olderMessages.filter((older) => !prev.some((m) => m.id === older.id)),
+        ...prev,
+      ]);
+      setHistoryCursor(cursor);
+      setHasMoreHistory(hasMore);
+      setIsLoadingMore(false);
+    });
+
     return () => {
       messageUnsubscribe();
       onlineStatusUnsubscribe();
       deliveryReceiptUnsubscribe();
       chatHistoryUnsubscribe();
+      chatHistoryPageUnsubscribe();
       webSocketService.disconnect();
       setIsConnected(false);
     };
@@ -62,6 +79,12 @@ export function useChatWebSocket(receiverUsername: string, currentUser: User, ac
     return true;
   };
 
+  const loadMoreHistory = () => {
+    if (!isConnected || !historyCursor || isLoadingMore) return;
+    setIsLoadingMore(true);
+    webSocketService.loadMore(historyCursor);
+  };
+
   const sendTypingIndicator = (isTyping: boolean) => {
     if (!isConnected) return;
     webSocketService.sendTypingIndicator(isTyping);
@@ -73,6 +96,9 @@ export function useChatWebSocket(receiverUsername: string, currentUser: User, ac
     isConnected,
     isReceiverOnline,
     isLoading,
+    hasMoreHistory,
+    isLoadingMore,
+    loadMoreHistory,
     sendMessage,
     sendTypingIndicator,
   };
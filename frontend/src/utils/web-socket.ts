@@ -3,8 +3,10 @@ import { Message } from "@/lib/types";
 
 type MessageCallback = (message: Message) => void;
 type OnlineStatusCallback = (username: string, isOnline: boolean) => void;
-type DeliveryReceiptCallback = (messageId: number, serializedMessage: Message) => void;
-type ChatHistoryCallback = (messages: Message[]) => void;
+type DeliveryReceiptCallback = (messageId: number, serializedMessage?: Message) => void;
+// Points at the oldest message of a history page, sent back in load_more
+export type HistoryCursor = { timestamp: string; id: number };
+type ChatHistoryCallback = (messages: Message[], cursor: HistoryCursor | null, hasMore: boolean) => void;
 
 class WebSocketService {
   private socket: WebSocket | null = null;
@@ -12,6 +14,7 @@ class WebSocketService {
   private onlineStatusCallbacks: OnlineStatusCallback[] = [];
   private deliveryReceiptCallbacks: DeliveryReceiptCallback[] = [];
   private chatHistoryCallbacks: ChatHistoryCallback[] = [];
+  private chatHistoryPageCallbacks: ChatHistoryCallback[] = [];
   private reconnectAttempts = 0;
   private maxReconnectAttempts = 5;
   private reconnectTimeout: NodeJS.Timeout | null = null;
@@ -71,9 +74,20 @@ class WebSocketService {
             callback(data.message_id, data.serialized_message)
           );
           break;
+        case "delivery-receipts":
+          data.message_ids.forEach((messageId: number) =>
+            // Batched receipts carry only ids
+            this.deliveryReceiptCallbacks.forEach((callback) => callback(messageId))
+          );
+          break;
         case "chat_history":
           this.chatHistoryCallbacks.forEach((callback) =>
-            callback(data.messages)
+            callback(data.messages, data.cursor, data.has_more)
+          );
+          break;
+        case "chat_history_page":
+          this.chatHistoryPageCallbacks.forEach((callback) =>
+            callback(data.messages, data.cursor, data.has_more)
           );
           break;
       }
@@ -105,6 +119,16 @@ class WebSocketService {
     }
   }
 
+  loadMore(cursor: HistoryCursor, pages: number = 1) {
+    if (this.socket?.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify({
+        type: "load_more",
+        cursor,
+        pages
+      }));
+    }
+  }
+
   sendTypingIndicator(isTyping: boolean) {
     if (this.socket?.readyState === WebSocket.OPEN) {
       this.socket.send(JSON.stringify({
@@ -142,6 +166,13 @@ class WebSocketService {
     };
   }
 
+  onChatHistoryPage(callback: ChatHistoryCallback) {
+    this.chatHistoryPageCallbacks.push(callback);
+    return () => {
+      this.chatHistoryPageCallbacks = this.chatHistoryPageCallbacks.filter(cb => cb !== callback);
+    };
+  }
+
   disconnect() {
     if (this.reconnectTimeout) {
       clearTimeout(this.reconnectTimeout);